@@ -29,6 +29,10 @@ different mechanism for making HTTP requests.
   ProxiedHttpClient: Contains a request method which connects to a proxy using
       settings stored in operating system environment variables then 
       performs an HTTP call to the endpoint server.
+
+  ConnectionPool: Keeps idle HTTP/1.1 keep-alive connections so that
+      HttpClient objects can reuse them instead of opening a new TCP (and TLS)
+      connection for every request.
 """
 
 
@@ -37,7 +41,10 @@ __author__ = 'api.jscudder (Jeff Scudder)'
 
 import types
 import os
+import time
+import select
 import httplib
+import threading
 import atom.url
 import atom.http_interface
 import socket
@@ -62,6 +69,80 @@ class TestConfigurationError(Exception):
 
 
 DEFAULT_CONTENT_TYPE = 'application/atom+xml'
+# Default limits for the keep-alive connections kept by each HttpClient.
+DEFAULT_MAX_IDLE_CONNECTIONS = 10
+DEFAULT_IDLE_TIMEOUT = 60
+# The requests which may be sent twice, and so may go over a reused
+# connection.
+IDEMPOTENT_OPERATIONS = ('GET', 'HEAD', 'DELETE')
+
+
+class ConnectionPool(object):
+  """Keeps idle keep-alive connections, keyed by (scheme, host, port).
+
+  A connection is checked out for the duration of one request and is put
+  back once the response body has been read completely. Connections which
+  have been idle for longer than idle_timeout seconds, or whose socket shows
+  that the server has hung up, are closed instead of being handed out again.
+  The pool is safe to share between threads.
+  """
+
+  def __init__(self, max_idle=DEFAULT_MAX_IDLE_CONNECTIONS,
+               idle_timeout=DEFAULT_IDLE_TIMEOUT):
+    """
+    Args:
+      max_idle: int The maximum number of idle connections kept for any one
+          (scheme, host, port). Extra connections are closed when released.
+      idle_timeout: int or float Seconds after which an idle connection is
+          assumed to have been dropped by the server.
+    """
+    self.max_idle = max_idle
+    self.idle_timeout = idle_timeout
+    self._idle = {}
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    """Returns a live idle connection for key, or None if there is none."""
+    now = time.time()
+    stale = []
+    connection = None
+    self._lock.acquire()
+    try:
+      idle = self._idle.get(key)
+      while idle:
+        candidate, released_at = idle.pop()
+        if now - released_at < self.idle_timeout and not _is_stale(candidate):
+          connection = candidate
+          break
+        stale.append(candidate)
+    finally:
+      self._lock.release()
+    for candidate in stale:
+      candidate.close()
+    return connection
+
+  def put(self, key, connection):
+    """Returns a connection whose last response has been fully read."""
+    self._lock.acquire()
+    try:
+      idle = self._idle.setdefault(key, [])
+      if len(idle) < self.max_idle:
+        idle.append((connection, time.time()))
+        return
+    finally:
+      self._lock.release()
+    connection.close()
+
+  def clear(self):
+    """Closes all idle connections."""
+    self._lock.acquire()
+    try:
+      idle, self._idle = self._idle, {}
+    finally:
+      self._lock.release()
+    for connections in idle.values():
+      for connection, released_at in connections:
+        connection.close()
 
 
 class HttpClient(atom.http_interface.GenericHttpClient):
@@ -69,9 +150,10 @@ class HttpClient(atom.http_interface.GenericHttpClient):
   # http_code.HttpClient. Used in unit tests to inject a mock client.
   v2_http_client = None
 
-  def __init__(self, headers=None):
+  def __init__(self, headers=None, connection_pool=None):
     self.debug = False
     self.headers = headers or {}
+    self.connection_pool = connection_pool or ConnectionPool()
 
   def request(self, operation, url, data=None, headers=None):
     """Performs an HTTP call to the server, supports GET, POST, PUT, and 
@@ -129,8 +211,41 @@ class HttpClient(atom.http_interface.GenericHttpClient):
         raise atom.http_interface.UnparsableUrlObject('Unable to parse url '
             'parameter because it was not a string or atom.url.Url')
     
-    connection = self._prepare_connection(url, all_headers)
+    # A request sent over a reused connection which the server has silently
+    # dropped is sent again on a new one. Requests which must not be sent
+    # twice, like a POST the server may already have carried out, and bodies
+    # which cannot be sent twice always get a fresh connection instead.
+    pooled = (str(operation).upper() in IDEMPOTENT_OPERATIONS
+              and _is_replayable(data))
+    connection, reused = self._get_connection(url, all_headers,
+                                              pooled=pooled)
+    try:
+      response = self._send_request(connection, operation, url, data,
+                                    all_headers)
+    except (socket.error, httplib.HTTPException):
+      connection.close()
+      if not reused:
+        raise
+      # The server closed the idle keep-alive connection, reconnect and retry.
+      connection = self._prepare_connection(url, all_headers)
+      response = self._send_request(connection, operation, url, data,
+                                    all_headers)
+    return _PooledResponse(response, self.connection_pool,
+                           _connection_key(url), connection)
+
+  def _get_connection(self, url, headers, pooled=True):
+    """Returns a (connection, reused) tuple for the given URL.
+
+    An idle connection from the pool is used when one is available, otherwise
+    a new connection is made by _prepare_connection.
+    """
+    if pooled:
+      connection = self.connection_pool.get(_connection_key(url))
+      if connection is not None:
+        return connection, True
+    return self._prepare_connection(url, headers), False
 
+  def _send_request(self, connection, operation, url, data, all_headers):
     if self.debug:
       connection.debuglevel = 1
 
@@ -207,6 +322,16 @@ class ProxiedHttpClient(HttpClient):
   After connecting to the proxy server, the request is completed as in 
   HttpClient.request.
   """
+  def _get_connection(self, url, headers, pooled=True):
+    # Plain HTTP requests to a proxy need the proxy credentials on every
+    # request, including those sent over a reused connection.
+    proxy_settings = os.environ.get('%s_proxy' % url.protocol)
+    if proxy_settings and url.protocol != 'https':
+      proxy_auth = _get_proxy_auth(proxy_settings)
+      if proxy_auth:
+        headers['Proxy-Authorization'] = proxy_auth.strip()
+    return HttpClient._get_connection(self, url, headers, pooled=pooled)
+
   def _prepare_connection(self, url, headers):
     proxy_settings = os.environ.get('%s_proxy' % url.protocol)
     if not proxy_settings:
@@ -345,6 +470,89 @@ def _get_proxy_net_location(proxy_settings):
     return proxy_settings
 
 
+class _PooledResponse(object):
+  """Wraps an httplib.HTTPResponse to recycle its connection.
+
+  Once the body has been read to the end the connection is returned to the
+  pool, unless the server asked for it to be closed. Every other attribute
+  is looked up on the wrapped response.
+  """
+
+  def __init__(self, response, pool, key, connection):
+    self._response = response
+    self._pool = pool
+    self._key = key
+    self._connection = connection
+    self.status = response.status
+    self.reason = response.reason
+    self._check_complete()
+
+  def __getattr__(self, name):
+    return getattr(self._response, name)
+
+  def read(self, amt=None):
+    if amt is None:
+      data = self._response.read()
+    else:
+      data = self._response.read(amt)
+    self._check_complete()
+    return data
+
+  def close(self):
+    self._response.close()
+    if self._connection is not None:
+      # The body may not have been read to the end, so the connection can't
+      # carry another request.
+      self._connection.close()
+      self._connection = None
+
+  def _check_complete(self):
+    if self._connection is None or not self._response.isclosed():
+      return
+    connection, self._connection = self._connection, None
+    if self._response.will_close:
+      connection.close()
+    else:
+      self._pool.put(self._key, connection)
+
+
+def _connection_key(url):
+  port = url.port
+  if not port:
+    if url.protocol == 'https':
+      port = 443
+    else:
+      port = 80
+  return (url.protocol, url.host, int(port))
+
+
+def _is_stale(connection):
+  """Tells if an idle connection was closed by the server.
+
+  An idle keep-alive socket should have nothing to read; if it is readable
+  the server has either hung up or sent something we did not ask for.
+  """
+  sock = connection.sock
+  if sock is None:
+    return True
+  try:
+    readable = select.select([sock], [], [], 0)[0]
+  except (select.error, socket.error, ValueError):
+    return True
+  return bool(readable)
+
+
+def _is_replayable(data):
+  if data is None or isinstance(data, types.StringTypes):
+    return True
+  if isinstance(data, list):
+    for data_part in data:
+      if not isinstance(data_part, types.StringTypes):
+        return False
+    return True
+  return False
+
+
 def _send_data_part(data, connection):
   if isinstance(data, types.StringTypes):
     connection.send(data)
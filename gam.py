@@ -27,7 +27,7 @@ __author__ = 'jay@ditoweb.com (Jay Lee)'
 __version__ = '2.3'
 __license__ = 'Apache License 2.0 (http://www.apache.org/licenses/LICENSE-2.0)'
 
-import sys, os, time, datetime, random, cgi, socket, urllib, csv, getpass, platform, re, webbrowser, pickle
+import sys, os, time, datetime, random, cgi, socket, urllib, csv, getpass, platform, re, webbrowser, pickle, threading, sqlite3, shlex, traceback, gzip, tempfile
 import xml.dom.minidom
 from sys import exit
 import gdata.apps.service
@@ -39,6 +39,11 @@ try:
   import gdata.apps.adminaudit.service
 except ImportError:
   pass
+try:
+  import json
+except ImportError:
+  # Python 2.5, see requireJson()
+  json = None
 import gdata.apps.multidomain.service
 import gdata.apps.orgs.service
 import gdata.apps.res_cal.service
@@ -49,9 +54,17 @@ import gdata.apps.reporting.service
 
 import gdata.auth
 import atom
+import atom.http
 import gdata.contacts
 import gdata.contacts.service
 from hashlib import sha1
+import gamlib.cache
+import gamlib.download
+import gamlib.output
+import gamlib.reports
+import gamlib.server
+import gamlib.throttle
+import gamlib.workers
 
 
 def showUsage():
@@ -68,6 +81,13 @@ gam info domain
 gam create user jsmith firstname John lastname Smith password secretpass
 gam update user jsmith suspended on
 gam.exe update group announcements add member jsmith
+gam workers 20 ou /Staff signature "Staff of Example Inc."
+gam workers auto all users imap on
+gam resume print users firstname lastname ou
+gam print groups name format jsonl file groups.jsonl.gz
+gam workers 10 batch commands.txt
+gam report accounts from 2012-05-01 to 2012-05-31 file accounts.csv
+gam serve
 ...
 
 '''
@@ -93,180 +113,433 @@ def commonAppsObjInit(appsObj):
     appsObj.debug = True
   return appsObj
 
-def tryOAuth(gdataObject):
-  global domain
+# oauth.txt is read once per process and every service object shares one
+# connection pooling HTTP client. Service objects stay loaded in service_pool
+# for as long as gam runs. Callers change the domain of service objects, so a
+# thread checks out its own of each class and hands them back once its command
+# or worker thread is done, see getServiceObject() and releaseServiceObjects()
+oauth_token = None
+shared_http_client = None
+service_lock = threading.Lock()
+service_pool = {}
+service_objects = threading.local()
+
+# Number of users per-user commands work on at once, see runForUsers(). With
+# "workers auto" max_workers threads run and an AIMDLimiter adapts the number
+# of requests in flight to the responses.
+num_workers = 1
+adaptive_workers = False
+max_workers = 50
+try:
+  max_workers = int(os.environ['GAM_MAX_WORKERS'])
+except (KeyError, ValueError):
+  pass
+
+def setWorkers(value):
+  global num_workers, adaptive_workers
+  if value.lower() == 'auto':
+    num_workers = max_workers
+    adaptive_workers = True
+    return
+  try:
+    num_workers = int(value)
+  except ValueError:
+    print 'Error: workers must be a number or auto, not %s' % value
+    sys.exit(2)
+  adaptive_workers = False
+
+def getNumWorkers():
+  # doBatch() runs the users of its commands one at a time, without changing
+  # the setting of other commands
+  return getattr(gamlib.workers.context, 'num_workers', num_workers)
+
+# Requests per second gam sends to each API, see gamlib.throttle.RateLimiter.
+# Requests are only rate limited when GAM_RATE_LIMITS is set, to "on" for the
+# default limits or to the limits to change, e.g.
+# GAM_RATE_LIMITS=emailsettings=5,audit=2
+def setRateLimits(value):
+  try:
+    rates = gamlib.throttle.ParseRateLimits(value)
+  except ValueError, e:
+    print 'Error: invalid GAM_RATE_LIMITS, %s' % e
+    sys.exit(2)
+  gdata.service.GDataService.rate_limiter = gamlib.throttle.RateLimiter(rates)
+
+# GAM_CACHE turns on the cache of directory listings in cache.gam, see
+# gamlib.cache. Set it to "on" or to the seconds listings stay fresh, e.g.
+# GAM_CACHE=600 or GAM_CACHE=users=600,groups=3600
+def setCache(value):
+  try:
+    ttls = gamlib.cache.ParseCacheTtls(value)
+  except ValueError, e:
+    print 'Error: invalid GAM_CACHE, %s' % e
+    sys.exit(2)
+  try:
+    cache = gamlib.cache.DirectoryCache(getGamPath()+'cache.gam', ttls)
+  except sqlite3.Error, e:
+    print 'Error: cannot open cache %s, %s' % (getGamPath()+'cache.gam', e)
+    sys.exit(2)
+  gdata.service.GDataService.directory_cache = cache
+
+# Pages of a feed fetched ahead while gam works on the current page, see
+# gdata.service.ReadAhead. GAM_PREFETCH sets the depth, 0 turns it off.
+def setPrefetch(value):
+  try:
+    depth = int(value)
+  except ValueError:
+    print 'Error: GAM_PREFETCH must be a number, not %s' % value
+    sys.exit(2)
+  gdata.service.GDataService.prefetch_depth = depth
+
+# the threads fetching pages ahead take over the context of the command they
+# fetch for, so what they print goes where the command's output goes
+gdata.service.ReadAhead.start_thread = staticmethod(gamlib.workers.StartThread)
+
+# "gam journal <command>" records the pages of the feeds the command lists in
+# a journal, "gam resume <command>" does the same but first reads back the
+# pages recorded by an earlier run of the same command which failed, and
+# continues each listing from where that run stopped. The journal is deleted
+# once the command succeeds.
+page_journal = None
+
+def requireJson(feature):
+  # The json module came with Python 2.6, gam itself still runs on 2.5
+  if json is None:
+    print '%s requires Python 2.6 or 2.7' % feature
+    sys.exit(3)
+
+def startJournal(resume):
+  global page_journal
+  requireJson('gam journal and gam resume')
+  command = ' '.join(sys.argv[1:])
+  journal_file = getGamPath()+'journal-%s.gam' % sha1(command).hexdigest()[:12]
+  if resume and os.path.isfile(journal_file):
+    sys.stderr.write("Resuming from the pages recorded in %s\n" % journal_file)
+  else:
+    sys.stderr.write("Recording pages in %s\n" % journal_file)
+  try:
+    page_journal = gdata.apps.service.PageJournal(journal_file, resume=resume)
+  except IOError, e:
+    print 'Error: cannot open journal %s, %s' % (journal_file, e)
+    sys.exit(2)
+  gdata.apps.service.PropertyService.page_journal = page_journal
+  gdata.apps.service.AppsService.page_journal = page_journal
+
+def finishJournal():
+  global page_journal
+  if page_journal is not None:
+    page_journal.Remove()
+    page_journal = None
+    gdata.apps.service.PropertyService.page_journal = None
+    gdata.apps.service.AppsService.page_journal = None
+
+# Seconds waitUntil() waits at most for a change to show up, GAM_WAIT_SECONDS
+# overrides it and 0 checks only once
+max_wait = 10
+try:
+  max_wait = float(os.environ['GAM_WAIT_SECONDS'])
+except (KeyError, ValueError):
+  pass
+
+# Seconds doDelegates() still waits once a change it waits for shows up, as a
+# change can show up in one place before it has reached all of Google's
+DELEGATION_SETTLE = 5
+
+def waitUntil(check, delay=1, settle=0):
+  # Calls check() until it returns True, waiting twice as long after each
+  # try but no more than max_wait seconds in all, then waits settle seconds
+  # more. Returns False if check() never returned True.
+  waited = 0
+  while True:
+    if check():
+      if settle > 0:
+        time.sleep(settle)
+      return True
+    if waited >= max_wait:
+      return False
+    delay = min(delay, max_wait - waited)
+    time.sleep(delay)
+    waited += delay
+    delay = delay * 2
+
+def getOAuthToken():
+  global domain, oauth_token
+  if oauth_token is not None:
+    return oauth_token
   oauth_filename = 'oauth.txt'
   try:
     oauth_filename = os.environ['OAUTHFILE']
   except KeyError:
     pass
-  if os.path.isfile(getGamPath()+oauth_filename):
-    oauthfile = open(getGamPath()+oauth_filename, 'rb')
+  if not os.path.isfile(getGamPath()+oauth_filename):
+    return None
+  oauthfile = open(getGamPath()+oauth_filename, 'rb')
+  domain = oauthfile.readline()[0:-1]
+  try:
+    token = pickle.load(oauthfile)
+    oauthfile.close()
+  except ImportError: # Deals with tokens created by windows on old GAM versions. Rewrites them with binary mode set
+    oauthfile = open(getGamPath()+oauth_filename, 'r')
     domain = oauthfile.readline()[0:-1]
-    try:
-      token = pickle.load(oauthfile)
-      oauthfile.close()
-    except ImportError: # Deals with tokens created by windows on old GAM versions. Rewrites them with binary mode set
-      oauthfile = open(getGamPath()+oauth_filename, 'r')
-      domain = oauthfile.readline()[0:-1]
-      token = pickle.load(oauthfile)
-      oauthfile.close()
-      f = open(getGamPath()+oauth_filename, 'wb')
-      f.write('%s\n' % (domain,))
-      pickle.dump(token, f)
-      f.close()
-    gdataObject.domain = domain
-    gdataObject.SetOAuthInputParameters(gdata.auth.OAuthSignatureMethod.HMAC_SHA1, consumer_key=token.oauth_input_params._consumer.key, consumer_secret=token.oauth_input_params._consumer.secret)
-    token.oauth_input_params = gdataObject._oauth_input_params
-    gdataObject.SetOAuthToken(token)
-    return True
-  else:
+    token = pickle.load(oauthfile)
+    oauthfile.close()
+    f = open(getGamPath()+oauth_filename, 'wb')
+    f.write('%s\n' % (domain,))
+    pickle.dump(token, f)
+    f.close()
+  token.oauth_input_params = gdata.auth.OAuthInputParams(gdata.auth.OAuthSignatureMethod.HMAC_SHA1, token.oauth_input_params._consumer.key, consumer_secret=token.oauth_input_params._consumer.secret)
+  oauth_token = token
+  return oauth_token
+
+def tryOAuth(gdataObject):
+  token = getOAuthToken()
+  if token is None:
     return False
+  gdataObject.domain = domain
+  gdataObject._oauth_input_params = token.oauth_input_params
+  gdataObject.SetOAuthToken(token)
+  return True
 
-def getAppsObject():
-  apps = gdata.apps.service.AppsService()
-  if not tryOAuth(apps):
+def getServiceObject(service_class, **kwargs):
+  global shared_http_client
+  try:
+    serviceObj = service_objects.__dict__[service_class]
+  except KeyError:
+    service_lock.acquire()
+    try:
+      if shared_http_client is None:
+        shared_http_client = atom.http.ProxiedHttpClient()
+      try:
+        serviceObj = service_pool[service_class].pop()
+      except (KeyError, IndexError):
+        serviceObj = None
+    finally:
+      service_lock.release()
+    if serviceObj is None:
+      serviceObj = service_class(**kwargs)
+      serviceObj.http_client = shared_http_client
+      if not tryOAuth(serviceObj):
+        doRequestOAuth()
+        tryOAuth(serviceObj)
+      serviceObj = commonAppsObjInit(serviceObj)
+    service_objects.__dict__[service_class] = serviceObj
+  # callers change the domain to work on other domains, start from the primary one again
+  serviceObj.domain = domain
+  # the limiter of the command this thread works for, see runForUsers()
+  serviceObj.concurrency_limiter = getattr(gamlib.workers.context, 'concurrency_limiter', None)
+  return serviceObj
+
+def releaseServiceObjects():
+  # Hands the service objects of this thread back to service_pool for the
+  # next command or thread
+  service_lock.acquire()
+  try:
+    for service_class, serviceObj in service_objects.__dict__.items():
+      service_pool.setdefault(service_class, []).append(serviceObj)
+  finally:
+    service_lock.release()
+  service_objects.__dict__.clear()
+
+gamlib.workers.AddThreadCleanup(releaseServiceObjects)
+
+def runForUsers(users, func):
+  # Calls func(user, i, count) for each user, on getNumWorkers() threads when
+  # there is more than one. Output still comes out in the order of users.
+  users = list(users)
+  count = len(users)
+  workers = getNumWorkers()
+  if workers < 2 or count < 2:
+    i = 1
+    for user in users:
+      func(user, i, count)
+      i = i + 1
+    return
+  if getOAuthToken() is None:
     doRequestOAuth()
-    tryOAuth(apps)
-  apps = commonAppsObjInit(apps)
-  return apps
+  # the worker threads take the limiter over from this thread and put it on
+  # their service objects, concurrent commands each have their own
+  previous_limiter = getattr(gamlib.workers.context, 'concurrency_limiter', None)
+  limiter = None
+  if adaptive_workers:
+    limiter = gamlib.throttle.AIMDLimiter(maximum=workers)
+    gamlib.workers.context.concurrency_limiter = limiter
+  try:
+    failures = gamlib.workers.RunTasks(func, users, workers)
+  finally:
+    gamlib.workers.context.concurrency_limiter = previous_limiter
+    if limiter is not None:
+      sys.stderr.write('Settled on %s requests at once (peak %s, slowed down %s times)\n' % (limiter.GetLimit(), limiter.peak, limiter.decreases))
+  if failures > 0:
+    sys.stderr.write('Error: %s of %s users failed\n' % (failures, count))
+    sys.exit(1)
+
+def getAppsObject():
+  return getServiceObject(gdata.apps.service.AppsService)
 
 def getProfilesObject():
-  profiles = gdata.contacts.service.ContactsService(contact_list='domain')
+  profiles = getServiceObject(gdata.contacts.service.ContactsService, contact_list='domain')
   profiles.ssl = True
-  if not tryOAuth(profiles):
-    doRequestOAuth()
-    tryOAuth(profiles)
-  profiles = commonAppsObjInit(profiles)
   return profiles
 
 def getCalendarObject():
-  calendars = gdata.calendar.service.CalendarService()
+  calendars = getServiceObject(gdata.calendar.service.CalendarService)
   calendars.ssl = True
-  if not tryOAuth(calendars):
-    doRequestOAuth()
-    tryOAuth(calendars)
-  calendars = commonAppsObjInit(calendars)
   return calendars
 
 def getGroupSettingsObject():
-  groupsettings = gdata.apps.groupsettings.service.GroupSettingsService()
-  if not tryOAuth(groupsettings):
-    doRequestOAuth()
-    tryOAuth(groupsettings)
-  groupsettings = commonAppsObjInit(groupsettings)
-  return groupsettings
+  return getServiceObject(gdata.apps.groupsettings.service.GroupSettingsService)
 
 def getEmailSettingsObject():
-  emailsettings = gdata.apps.emailsettings.service.EmailSettingsService()
-  if not tryOAuth(emailsettings):
-    doRequestOAuth()
-    tryOAuth(emailsettings)
-  emailsettings = emailsettings = commonAppsObjInit(emailsettings)
-  return emailsettings
+  return getServiceObject(gdata.apps.emailsettings.service.EmailSettingsService)
 
 def getAdminSettingsObject():
-  global domain
-  adminsettings = gdata.apps.adminsettings.service.AdminSettingsService()
-  if not tryOAuth(adminsettings):
-    doRequestOAuth()
-    tryOAuth(adminsettings)
-  adminsettings = commonAppsObjInit(adminsettings)
-  return adminsettings
+  return getServiceObject(gdata.apps.adminsettings.service.AdminSettingsService)
   
 def getGroupsObject():
-  global domain
-  groupsObj = gdata.apps.groups.service.GroupsService()
-  if not tryOAuth(groupsObj):
-    doRequestOAuth()
-    tryOAuth(groupsObj)
-  groupsObj = commonAppsObjInit(groupsObj)
-  return groupsObj
+  return getServiceObject(gdata.apps.groups.service.GroupsService)
 
 def getAuditObject():
-  auditObj = gdata.apps.audit.service.AuditService()
-  if not tryOAuth(auditObj):
-    doRequestOAuth()
-    tryOAuth(auditObj)
-  auditObj = commonAppsObjInit(auditObj)
-  return auditObj
+  return getServiceObject(gdata.apps.audit.service.AuditService)
 
 def getAdminAuditObject():
   try:
-    adminAuditObj = gdata.apps.adminaudit.service.AdminAuditService()
+    service_class = gdata.apps.adminaudit.service.AdminAuditService
   except AttributeError:
     print "gam audit admin commands require Python 2.6 or 2.7"
     sys.exit(3)
-  if not tryOAuth(adminAuditObj):
-    doRequestOAuth()
-    tryOAuth(adminAuditObj)
-  adminAuditObj = commonAppsObjInit(adminAuditObj)
-  return adminAuditObj
+  return getServiceObject(service_class)
 
 def getMultiDomainObject():
-  multidomainObj = gdata.apps.multidomain.service.MultiDomainService()
-  if not tryOAuth(multidomainObj):
-    doRequestOAuth()
-    tryOAuth(multidomainObj)
-  multidomainObj = commonAppsObjInit(multidomainObj)
-  return multidomainObj
+  return getServiceObject(gdata.apps.multidomain.service.MultiDomainService)
 
 def getOrgObject():
-  orgObj = gdata.apps.orgs.service.OrganizationService()
-  if not tryOAuth(orgObj):
-    doRequestOAuth()
-    tryOAuth(orgObj)
-  orgObj = commonAppsObjInit(orgObj)
-  return orgObj
+  return getServiceObject(gdata.apps.orgs.service.OrganizationService)
 
 def getResCalObject():
-  resCalObj = gdata.apps.res_cal.service.ResCalService()
-  if not tryOAuth(resCalObj):
-    doRequestOAuth()
-    tryOAuth(resCalObj)
-  resCalObj = commonAppsObjInit(resCalObj)
-  return resCalObj
+  return getServiceObject(gdata.apps.res_cal.service.ResCalService)
 
 def getRepObject():
-  repObj = gdata.apps.reporting.service.ReportService()
-  if not tryOAuth(repObj):
-    doRequestOAuth()
-    tryOAuth(repObj)
-  repObj = commonAppsObjInit(repObj)
-  return repObj
-
-def _reporthook(numblocks, blocksize, filesize, url=None):
-    #print "reporthook(%s, %s, %s)" % (numblocks, blocksize, filesize)
-    base = os.path.basename(url)
-    #XXX Should handle possible filesize=-1.
-    try:
-        percent = min((numblocks*blocksize*100)/filesize, 100)
-    except:
-        percent = 100
-    if numblocks != 0:
-        sys.stdout.write("\b"*70)
-    sys.stdout.write(str(percent)+'% ')
-    #print str(percent)+"%\b\b"
-
-def geturl(url, dst):
-    if sys.stdout.isatty():
-        urllib.urlretrieve(url, dst,
-                           lambda nb, bs, fs, url=url: _reporthook(nb,bs,fs,url))
-        sys.stdout.write('\n')
-    else:
-        urllib.urlretrieve(url, dst)
+  return getServiceObject(gdata.apps.reporting.service.ReportService)
+
+# Files of an export or activity request downloaded at once when gam runs
+# with a single worker
+DOWNLOAD_WORKERS = 4
+
+def downloadRequestFiles(results, prefix, extension):
+  # Downloads the fileUrlN files of a completed audit request to
+  # <prefix>N<extension>. Partial files left by an earlier run are resumed
+  # and every file is checked against the size the server reports.
+  count = int(results['numberOfFiles'])
+  downloads = [(results['fileUrl'+str(i)], prefix+str(i)+extension) for i in range(count)]
+  print 'Downloading %s files...' % count
+  workers = getNumWorkers()
+  if workers < 2:
+    workers = DOWNLOAD_WORKERS
+  failures = 0
+  for path, error in gamlib.download.DownloadFiles(downloads, workers):
+    if error is not None:
+      print 'Error: %s failed: %s' % (path, error)
+      failures += 1
+  if failures:
+    print 'Error: %s of %s files failed, run the command again to resume them' % (failures, count)
+    sys.exit(1)
+
+# Threads downloading the days of "gam report ... from ... to ..." when gam
+# runs with a single worker
+REPORT_WORKERS = 4
 
 def showReport():
+  # gam report <name> [<date>|from <date> to <date>] [file <path>] [gzip]
+  # writes each page of the report as it arrives, to stdout or to the file
   report = sys.argv[2].lower()
-  date = page = None
-  if len(sys.argv) > 3:
-    date = sys.argv[3]
-  rep = getRepObject()
-  report_data = rep.retrieve_report(report=report, date=date)
-  sys.stdout.write(report_data)
+  date = start_date = end_date = report_file = None
+  compress = False
+  i = 3
+  while i < len(sys.argv):
+    if sys.argv[i].lower() == 'file':
+      report_file = sys.argv[i+1]
+      i = i + 2
+    elif sys.argv[i].lower() == 'gzip':
+      compress = True
+      i = i + 1
+    elif sys.argv[i].lower() == 'from':
+      start_date = sys.argv[i+1]
+      i = i + 2
+    elif sys.argv[i].lower() == 'to':
+      end_date = sys.argv[i+1]
+      i = i + 2
+    else:
+      date = sys.argv[i]
+      i = i + 1
+  if report_file is None:
+    out = sys.stdout
+  else:
+    try:
+      if compress or report_file.endswith('.gz'):
+        out = gzip.open(report_file, 'wb')
+      else:
+        out = open(report_file, 'wb')
+    except IOError, e:
+      print 'Error: cannot write %s, %s' % (report_file, e)
+      sys.exit(2)
+  try:
+    if start_date is not None or end_date is not None:
+      showReportRange(report, start_date or end_date, end_date or start_date, out)
+    else:
+      rep = getRepObject()
+      for report_page in rep.retrieve_report_pages(report=report, date=date):
+        out.write(report_page)
+        out.flush()
+  finally:
+    if out is not sys.stdout:
+      out.close()
+
+def showReportRange(report, start_date, end_date, out):
+  # Writes the reports of the days from start_date to end_date as one CSV
+  # with a date column. The days are downloaded at once into the report
+  # cache under the gam path. Reports which have been generated are kept
+  # there and never downloaded again, empty ones are downloaded every time.
+  try:
+    dates = gamlib.reports.DateRange(gamlib.reports.ParseDate(start_date), gamlib.reports.ParseDate(end_date))
+  except ValueError:
+    print 'Error: report dates must look like 2012-05-31, not %s and %s' % (start_date, end_date)
+    sys.exit(2)
+  cache = gamlib.reports.ReportCache(getGamPath()+'reports')
+  report_domain = getRepObject().domain
+  latest = gamlib.reports.LatestReportDate()
+  def getReport(date):
+    def call():
+      if cache.Has(report_domain, report, date):
+        return cache.GetPath(report_domain, report, date), False, None
+      rep = getRepObject()
+      rep.domain = report_domain
+      try:
+        path, stored = cache.Store(report_domain, report, date, rep.retrieve_report_pages(report=report, date=date), keep=date <= latest)
+        return path, not stored, None
+      except gdata.service.RequestError, e:
+        return None, False, e
+    return call
+  cached = len([date for date in dates if cache.Has(report_domain, report, date)])
+  sys.stderr.write('Getting %s %s reports, %s of them cached...\n' % (len(dates), report, cached))
+  workers = getNumWorkers()
+  if workers < 2:
+    workers = REPORT_WORKERS
+  results = gamlib.workers.CallConcurrently([getReport(date) for date in dates], workers)
+  try:
+    failed = False
+    for date, (path, temporary, error) in zip(dates, results):
+      if error is not None:
+        sys.stderr.write('Error: could not get the %s report of %s, %s\n' % (report, date, error))
+        failed = True
+    if failed:
+      sys.exit(1)
+    gamlib.reports.MergeReports([(date, path) for date, (path, temporary, error) in zip(dates, results)], out)
+  finally:
+    for path, temporary, error in results:
+      if temporary:
+        os.remove(path)
 
 def doDelegates(users):
-  emailsettings = getEmailSettingsObject()
   if sys.argv[4].lower() == 'to':
     delegate = sys.argv[5].lower()
     #delegate needs to be a full email address, tack
@@ -280,9 +553,8 @@ def doDelegates(users):
   else:
     showUsage()
     exit(6)
-  count = len(users)
-  i = 1
-  for delegator in users:
+  def processUser(delegator, i, count):
+    emailsettings = getEmailSettingsObject()
     if delegator.find('@') > 0:
       delegator_domain = delegator[delegator.find('@')+1:].lower()
       delegator_email = delegator
@@ -312,28 +584,41 @@ def doDelegates(users):
         use_delegate_address = '%s@%s' % (''.join(random.sample('abcdefghijklmnopqrstuvwxyz0123456789', 10)), delegator_domain)
         print '  Giving %s temporary alias %s for delegation' % (delegate_email, use_delegate_address)
         multi.CreateAlias(user_email=delegate_email, alias_email=use_delegate_address)
-        time.sleep(5)
+        def aliasExists():
+          try:
+            multi.RetrieveAlias(use_delegate_address)
+            return True
+          except gdata.apps.service.AppsForYourDomainException:
+            return False
+        if not waitUntil(aliasExists, settle=DELEGATION_SETTLE):
+          print '  Warning: temporary alias %s is not visible yet' % use_delegate_address
     try:
       emailsettings.CreateDelegate(delegate=use_delegate_address, delegator=delegator)
     except gdata.apps.service.AppsForYourDomainException, e:
       print e
-      time.sleep(10)
       sys.exit(5)
-    time.sleep(10)
     if delete_alias:
+      # the delegation needs the alias until it has gone through
+      def delegationDone():
+        for delegate in emailsettings.GetDelegates(delegator=delegator):
+          if delegate['address'].lower() == use_delegate_address.lower():
+            return True
+        return False
+      if not waitUntil(delegationDone, settle=DELEGATION_SETTLE):
+        print '  Warning: delegation to %s is not visible yet' % use_delegate_address
       print '  Deleting temporary alias...'
       multi.DeleteAlias(use_delegate_address)
-    i = i + 1
+  runForUsers(users, processUser)
 
 def getDelegates(users):
-  emailsettings = getEmailSettingsObject()
   csv_format = False
   try:
     if sys.argv[5].lower() == 'csv':
       csv_format = True
   except IndexError:
     pass
-  for user in users:
+  def processUser(user, i, count):
+    emailsettings = getEmailSettingsObject()
     if user.find('@') > 0:
       emailsettings.domain = user[user.find('@')+1:]
       user = user[:user.find('@')]
@@ -349,9 +634,9 @@ def getDelegates(users):
         print '%s,%s,%s' % (user + '@' + emailsettings.domain, delegate['address'], delegate['status'])
       else:
         print "Delegator: %s\n Delegate: %s\n Status: %s\n Delegate Email: %s\n Delegate ID: %s\n" % (user, delegate['delegate'], delegate['status'], delegate['address'], delegate['delegationId'])
+  runForUsers(users, processUser)
 
 def deleteDelegate(users):
-  emailsettings = getEmailSettingsObject()
   delegate = sys.argv[5]
   if not delegate.find('@') > 0:
     if users[0].find('@') > 0:
@@ -359,9 +644,8 @@ def deleteDelegate(users):
     else:
       delegatedomain = domain
     delegate = delegate+'@'+delegatedomain
-  count = len(users)
-  i = 1
-  for user in users:
+  def processUser(user, i, count):
+    emailsettings = getEmailSettingsObject()
     print "Deleting %s delegate access to %s (%s of %s)" % (delegate, user, i, count)
     if user.find('@') > 0:
       emailsettings.domain = user[user.find('@')+1:]
@@ -369,12 +653,12 @@ def deleteDelegate(users):
     else:
       emailsettings.domain = domain #make sure it's back at default domain
     emailsettings.DeleteDelegate(delegate=delegate, delegator=user)
-    i = i + 1
+  runForUsers(users, processUser)
 
 def deleteCalendar(users):
   del_cal = sys.argv[5]
-  cal = getCalendarObject()
-  for user in users:
+  def processUser(user, i, count):
+    cal = getCalendarObject()
     if user.find('@') > 0:
       user_domain = user[user.find('@')+1:]
       user = user[:user.find('@')]
@@ -385,16 +669,16 @@ def deleteCalendar(users):
       calendar_entry = cal.GetCalendarListEntry(uri)
     except gdata.service.RequestError, e:
       print 'Error: %s - %s' % (e[0]['reason'], e[0]['body'])
-      continue
+      return
     try:
       edit_uri = calendar_entry.GetEditLink().href
       cal.DeleteCalendarEntry(edit_uri)
     except gdata.service.RequestError, e:
       print 'Error: %s - %s' % (e[0]['reason'], e[0]['body'])
+  runForUsers(users, processUser)
 
 def addCalendar(users):
   add_cal = sys.argv[5]
-  cal = getCalendarObject()
   selected = hidden = color = None
   i = 6
   while i < len(sys.argv):
@@ -425,7 +709,8 @@ def addCalendar(users):
     else:
       showUsage()
       print '%s is not a valid argument for "gam add calendar"' % sys.argv[i]
-  for user in users:
+  def processUser(user, i, count):
+    cal = getCalendarObject()
     if user.find('@') > 0:
       user_domain = user[user.find('@')+1:]
       user = user[:user.find('@')]
@@ -442,11 +727,11 @@ def addCalendar(users):
       cal.InsertCalendarSubscription(insert_uri=insert_uri, calendar=calendar_entry)
     except gdata.service.RequestError, e:
       print 'Error: %s - %s' % (e[0]['reason'], e[0]['body'])
-      continue
+      return
+  runForUsers(users, processUser)
 
 def updateCalendar(users):
   update_cal = sys.argv[5]
-  cal = getCalendarObject()
   selected = hidden = color = None
   i = 6
   while i < len(sys.argv):
@@ -477,7 +762,8 @@ def updateCalendar(users):
     else:
       showUsage()
       print '%s is not a valid argument for "gam add calendar"' % sys.argv[i]
-  for user in users:
+  def processUser(user, i, count):
+    cal = getCalendarObject()
     if user.find('@') > 0:
       user_domain = user[user.find('@')+1:]
       user = user[:user.find('@')]
@@ -488,7 +774,7 @@ def updateCalendar(users):
       calendar_entry = cal.GetCalendarListEntry(uri)
     except gdata.service.RequestError, e:
       print 'Error: %s - %s' % (e[0]['reason'], e[0]['body'])
-      continue
+      return
     if selected != None:
 	  calendar_entry.selected =  gdata.calendar.Selected(value=selected)
     if hidden != None:
@@ -500,7 +786,8 @@ def updateCalendar(users):
       cal.UpdateCalendar(calendar_entry)
     except gdata.service.RequestError, e:
       print 'Error: %s - %s' % (e[0]['reason'], e[0]['body'])
-      continue
+      return
+  runForUsers(users, processUser)
 
 def doCalendarShowACL():
   show_cal = sys.argv[2]
@@ -586,10 +873,8 @@ def doProfile(users):
     indexed = 'true'
   elif sys.argv[4].lower() == 'unshare' or sys.argv[4].lower() == 'unshared':
     indexed = 'false'
-  profiles = getProfilesObject()
-  count = len(users)
-  i = 1
-  for user in users:
+  def processUser(user, i, count):
+    profiles = getProfilesObject()
     if user.find('@') > 0:
       user_domain = user[user.find('@')+1:]
       user = user[:user.find('@')]
@@ -603,11 +888,11 @@ def doProfile(users):
       profiles.UpdateProfile(user_profile.GetEditLink().href, user_profile)
     except gdata.service.RequestError, e:
       print 'Error for %s@%s: %s - %s' % (user, user_domain, e[0]['body'], e[0]['reason'])
-    i += 1
+  runForUsers(users, processUser)
 
 def showProfile(users):
-  profiles = getProfilesObject()
-  for user in users:
+  def processUser(user, i, count):
+    profiles = getProfilesObject()
     if user.find('@') > 0:
       user_domain = user[user.find('@')+1:]
       user = user[:user.find('@')]
@@ -618,17 +903,16 @@ def showProfile(users):
       user_profile = profiles.GetProfile(uri)
     except gdata.service.RequestError, e:
       print 'Error for %s@%s: %s - %s' % (user, user_domain, e[0]['body'], e[0]['reason'])
-      continue
+      return
     indexed = user_profile.extension_elements[2].attributes['indexed']
     print '''User: %s@%s
  Profile Shared: %s''' % (user, user_domain, indexed)
+  runForUsers(users, processUser)
 
 def doPhoto(users):
   filename = sys.argv[5]
-  profiles = getProfilesObject()
-  i = 1
-  count = len(users)
-  for user in users:
+  def processUser(user, i, count):
+    profiles = getProfilesObject()
     if user.find('@') > 0:
       user_domain = user[user.find('@')+1:]
       user = user[:user.find('@')]
@@ -642,7 +926,7 @@ def doPhoto(users):
         if sys.argv[6].lower() == 'nooverwrite':
           etag = user_profile.link[0].extension_attributes['{http://schemas.google.com/g/2005}etag']
           print 'Not overwriting existing photo for %s@%s' % (user, user_domain)
-          continue
+          return
       except IndexError:
         pass
       except KeyError:
@@ -651,13 +935,11 @@ def doPhoto(users):
       results = profiles.ChangePhoto(media=filename, content_type='image/jpeg', contact_entry_or_url=photo_uri)
     except gdata.service.RequestError, e:
       print 'Error for %s@%s: %s - %s' % (user, user_domain, e[0]['body'], e[0]['reason'])
-    i = i + 1
+  runForUsers(users, processUser)
 
 def getPhoto(users):
-  profiles = getProfilesObject()
-  i = 1
-  count = len(users)
-  for user in users:
+  def processUser(user, i, count):
+    profiles = getProfilesObject()
     if user.find('@') > 0:
       user_domain = user[user.find('@')+1:]
       user = user[:user.find('@')]
@@ -670,26 +952,22 @@ def getPhoto(users):
         etag = user_profile.link[0].extension_attributes['{http://schemas.google.com/g/2005}etag']
       except KeyError:
         print '  No photo for %s@%s' % (user, user_domain)
-        i = i + 1
-        continue
+        return
       photo_uri = user_profile.link[0].href
       filename = '%s-%s.jpg' % (user, user_domain)
       print "Saving photo for %s to %s (%s of %s)" % (user+'@'+user_domain, filename, i, count)
       photo = profiles.GetPhoto(contact_entry_or_url=photo_uri)
     except gdata.service.RequestError, e:
       print '  Error for %s@%s: %s - %s' % (user, user_domain, e[0]['body'], e[0]['reason'])
-      i = i + 1  
-      continue
+      return
     photo_file = open(filename, 'wb')
     photo_file.write(photo)
     photo_file.close()
-    i = i + 1
+  runForUsers(users, processUser)
 
 def deletePhoto(users):
-  profiles = getProfilesObject()
-  i = 1
-  count = len(users)
-  for user in users:
+  def processUser(user, i, count):
+    profiles = getProfilesObject()
     if user.find('@') > 0:
       user_domain = user[user.find('@')+1:]
       user = user[:user.find('@')]
@@ -703,11 +981,11 @@ def deletePhoto(users):
       results = profiles.DeletePhoto(photo_uri)
     except gdata.service.RequestError, e:
       print 'Error for %s@%s: %s - %s' % (user, user_domain, e[0]['body'], e[0]['reason'])
-    i = i + 1
+  runForUsers(users, processUser)
 
 def showCalendars(users):
-  cal = getCalendarObject()
-  for user in users:
+  def processUser(user, i, count):
+    cal = getCalendarObject()
     if user.find('@') > 0:
       user_domain = user[user.find('@')+1:]
       user = user[:user.find('@')]
@@ -725,10 +1003,11 @@ def showCalendars(users):
       print '    Selected: %s' % str(a_calendar.selected.value)
       print '    Color: %s' % str(a_calendar.color.value)
       print ''
+  runForUsers(users, processUser)
 
 def showCalSettings(users):
-  cal = getCalendarObject()
-  for user in users:
+  def processUser(user, i, count):
+    cal = getCalendarObject()
     if user.find('@') > 0:
       user_domain = user[user.find('@')+1:]
       user = user[:user.find('@')]
@@ -744,6 +1023,7 @@ def showCalSettings(users):
     print feed.title.text
     for i, a_setting in enumerate(feed.entry):
       print ' %s: %s' % (a_setting.extension_elements[0].attributes['name'], a_setting.extension_elements[0].attributes['value'])
+  runForUsers(users, processUser)
 
 def doImap(users):
   checkTOS = True
@@ -753,10 +1033,8 @@ def doImap(users):
     enable = False
   if len(sys.argv) > 5 and sys.argv[5] == 'noconfirm':
     checkTOS = False
-  emailsettings = getEmailSettingsObject()
-  count = len(users)
-  i = 1
-  for user in users:
+  def processUser(user, i, count):
+    emailsettings = getEmailSettingsObject()
     print "Setting IMAP Access to %s for %s (%s of %s)" % (str(enable), user, i, count)
     if checkTOS:
       if not hasAgreed2TOS(user):
@@ -767,11 +1045,11 @@ def doImap(users):
     else:
       emailsettings.domain = domain #make sure it's back at default domain
     emailsettings.UpdateImap(username=user, enable=enable)
-    i = i + 1
+  runForUsers(users, processUser)
 
 def getImap(users):
-  emailsettings = getEmailSettingsObject()
-  for user in users:
+  def processUser(user, i, count):
+    emailsettings = getEmailSettingsObject()
     if user.find('@') > 0:
       emailsettings.domain = user[user.find('@')+1:]
       user = user[:user.find('@')]
@@ -779,6 +1057,7 @@ def getImap(users):
       emailsettings.domain = domain
     imapsettings = emailsettings.GetImap(username=user)
     print 'User %s  IMAP Enabled:%s' % (user, imapsettings['enable'])
+  runForUsers(users, processUser)
 
 def doPop(users):
   checkTOS = True
@@ -811,10 +1090,8 @@ def doPop(users):
     else:
       showUsage()
       sys.exit(2)
-  emailsettings = getEmailSettingsObject()
-  count = len(users)
-  i = 1
-  for user in users:
+  def processUser(user, i, count):
+    emailsettings = getEmailSettingsObject()
     print "Setting POP Access to %s for %s (%s of %s)" % (str(enable), user, i, count)
     if checkTOS:
       if not hasAgreed2TOS(user):
@@ -825,11 +1102,11 @@ def doPop(users):
     else:
       emailsettings.domain = domain #make sure it's back at default domain
     emailsettings.UpdatePop(username=user, enable=enable, enable_for=enable_for, action=action)
-    i = i + 1
+  runForUsers(users, processUser)
 
 def getPop(users):
-  emailsettings = getEmailSettingsObject()
-  for user in users:
+  def processUser(user, i, count):
+    emailsettings = getEmailSettingsObject()
     if user.find('@') > 0:
       emailsettings.domain = user[user.find('@')+1:]
       user = user[:user.find('@')]
@@ -837,6 +1114,7 @@ def getPop(users):
       emailsettings.domain = domain
     popsettings = emailsettings.GetPop(username=user)
     print 'User %s  POP Enabled:%s  Action:%s' % (user, popsettings['enable'], popsettings['action'])
+  runForUsers(users, processUser)
 
 def doSendAs(users):
   sendas = sys.argv[4]
@@ -853,12 +1131,10 @@ def doSendAs(users):
     else:
       showUsage()
       sys.exit(2)
-  emailsettings = getEmailSettingsObject()
   if sendas.find('@') < 0:
     sendas = sendas+'@'+domain
-  count = len(users)
-  i = 1
-  for user in users:
+  def processUser(user, i, count):
+    emailsettings = getEmailSettingsObject()
     print "Allowing %s to send as %s (%s of %s)" % (user, sendas, i, count)
     if user.find('@') > 0:
       emailsettings.domain = user[user.find('@')+1:]
@@ -866,11 +1142,11 @@ def doSendAs(users):
     else:
       emailsettings.domain = domain #make sure it's back at default domain
     emailsettings.CreateSendAsAlias(username=user, name=sendasName, address=sendas, make_default=make_default, reply_to=reply_to)
-    i = i + 1
+  runForUsers(users, processUser)
 
 def showSendAs(users):
-  emailsettings = getEmailSettingsObject()
-  for user in users:
+  def processUser(user, i, count):
+    emailsettings = getEmailSettingsObject()
     print '%s has the following send as aliases:' %  user
     if user.find('@') > 0:
       emailsettings.domain = user[user.find('@')+1:]
@@ -893,13 +1169,12 @@ def showSendAs(users):
         verified = 'no'
       print ' "%s" <%s>%s Default:%s Verified:%s' % (sendas['name'], sendas['address'], replyto, default, verified)
     print ''
+  runForUsers(users, processUser)
 
 def doLanguage(users):
   language = sys.argv[4].lower()
-  emailsettings = getEmailSettingsObject()
-  count = len(users)
-  i = 1
-  for user in users:
+  def processUser(user, i, count):
+    emailsettings = getEmailSettingsObject()
     print "Setting the language for %s to %s (%s of %s)" % (user, language, i, count)
     if user.find('@') > 0:
       emailsettings.domain = user[user.find('@')+1:]
@@ -907,17 +1182,15 @@ def doLanguage(users):
     else:
       emailsettings.domain = domain #make sure it's back at default domain
     emailsettings.UpdateLanguage(username=user, language=language)
-    i = i + 1
+  runForUsers(users, processUser)
 
 def doUTF(users):
   if sys.argv[4].lower() == 'on':
     SetUTF = True
   elif sys.argv[4].lower() == 'off':
     SetUTF = False
-  emailsettings = getEmailSettingsObject()
-  count = len(users)
-  i = 1
-  for user in users:
+  def processUser(user, i, count):
+    emailsettings = getEmailSettingsObject()
     print "Setting UTF-8 to %s for %s (%s of %s)" % (str(SetUTF), user, i, count)
     if user.find('@') > 0:
       emailsettings.domain = user[user.find('@')+1:]
@@ -925,7 +1198,7 @@ def doUTF(users):
     else:
       emailsettings.domain = domain #make sure it's back at default domain
     emailsettings.UpdateGeneral(username=user, unicode=SetUTF)
-    i = i + 1
+  runForUsers(users, processUser)
 
 def doPageSize(users):
   if sys.argv[4] == '25':
@@ -937,10 +1210,8 @@ def doPageSize(users):
   else:
     showUsage()
     sys.exit(2)
-  emailsettings = getEmailSettingsObject()
-  count = len(users)
-  i = 1
-  for user in users:
+  def processUser(user, i, count):
+    emailsettings = getEmailSettingsObject()
     print "Setting Page Size to %s for %s (%s of %s)" % (PageSize, user, i, count)
     if user.find('@') > 0:
       emailsettings.domain = user[user.find('@')+1:]
@@ -948,17 +1219,15 @@ def doPageSize(users):
     else:
       emailsettings.domain = domain #make sure it's back at default domain
     emailsettings.UpdateGeneral(username=user, page_size=PageSize)
-    i = i + 1
+  runForUsers(users, processUser)
 
 def doShortCuts(users):
   if sys.argv[4].lower() == 'on':
     SetShortCuts = True
   elif sys.argv[4].lower() == 'off':
     SetShortCuts = False
-  emailsettings = getEmailSettingsObject()
-  count = len(users)
-  i = 1
-  for user in users:
+  def processUser(user, i, count):
+    emailsettings = getEmailSettingsObject()
     print "Setting Keyboard Short Cuts to %s for %s (%s of %s)" % (str(SetShortCuts), user, i, count)
     if user.find('@') > 0:
       emailsettings.domain = user[user.find('@')+1:]
@@ -966,9 +1235,74 @@ def doShortCuts(users):
     else:
       emailsettings.domain = domain #make sure it's back at default domain
     emailsettings.UpdateGeneral(username=user, shortcuts=SetShortCuts)
-    i = i + 1
+  runForUsers(users, processUser)
+
+# The admin audit of a time window is fetched as this many shards of the
+# window at once, unless gam runs with more workers
+AUDIT_SHARDS = 8
+# The columns of "gam audit admin", one row per event
+AUDIT_TITLES = ['time', 'actor', 'ipAddress', 'eventType', 'event', 'parameters']
+
+def parseAuditTime(value, end=False):
+  # Returns the datetime of a YYYY-MM-DD or RFC 3339 UTC time. A date alone
+  # is the start of that day, or its last millisecond if end is True so that
+  # the whole day is included.
+  match = re.match(r'^(\d{4}-\d{2}-\d{2})(?:[Tt ](\d{2}):(\d{2})(?::(\d{2})(?:\.(\d{1,6})\d*)?)?)?[Zz]?$', value)
+  try:
+    if match is None:
+      raise ValueError(value)
+    day, hour, minute, second, fraction = match.groups()
+    audit_time = datetime.datetime(*time.strptime(day, '%Y-%m-%d')[:3])
+    if hour is None:
+      if end:
+        return audit_time + datetime.timedelta(days=1, milliseconds=-1)
+      return audit_time
+    return audit_time.replace(hour=int(hour), minute=int(minute), second=int(second or 0), microsecond=int((fraction or '0').ljust(6, '0')))
+  except ValueError:
+    print 'Error: times must look like 2012-05-31 or 2012-05-31T14:30:00Z, not %s' % value
+    sys.exit(2)
+
+def formatAuditTime(audit_time):
+  return audit_time.strftime('%Y-%m-%dT%H:%M:%S.') + '%03dZ' % (audit_time.microsecond / 1000)
+
+def auditShards(start_time, end_time, count):
+  # Splits start_time..end_time into count (start, end) windows, newest
+  # first like the audit lists activities. A window ends a millisecond
+  # before the next one starts so no activity is in two of them.
+  step = (end_time - start_time) / count
+  if step < datetime.timedelta(seconds=1):
+    return [(start_time, end_time)]
+  shards = []
+  for i in range(count):
+    shard_start = start_time + step * i
+    if i < count - 1:
+      shard_end = start_time + step * (i + 1) - datetime.timedelta(milliseconds=1)
+    else:
+      shard_end = end_time
+    shards.append((shard_start, shard_end))
+  shards.reverse()
+  return shards
+
+def auditRows(activity):
+  # Returns the rows of an admin audit activity, one for each of its events
+  rows = []
+  for event in activity.get('events', []):
+    parameters = {}
+    for parameter in event.get('parameters', []):
+      parameters[parameter.get('name')] = parameter.get('value')
+    rows.append({'time': activity.get('id', {}).get('time'),
+                 'actor': activity.get('actor', {}).get('email'),
+                 'ipAddress': activity.get('ipAddress'),
+                 'eventType': event.get('eventType'),
+                 'event': event.get('name'),
+                 'parameters': parameters})
+  return rows
 
 def doAdminAudit():
+  # The start_date..end_date window is split into shards fetched at once,
+  # each following its continuation tokens into a temporary spool file. The
+  # shards are written out in order, one row per event, as soon as they and
+  # the shards before them are done, so memory does not grow with the window.
   i = 3
   admin = event = start_date = end_date = None
   while i < len(sys.argv):
@@ -984,45 +1318,57 @@ def doAdminAudit():
     elif sys.argv[i].lower() == 'end_date':
       end_date = sys.argv[i+1]
       i = i + 2
+    elif sys.argv[i].lower() in OUTPUT_ARGUMENTS:
+      i = parseOutputArgument(i)
     else:
       showUsage()
       sys.exit(2)
+  shard_count = max(getNumWorkers(), AUDIT_SHARDS)
+  if start_date is not None:
+    start_time = parseAuditTime(start_date)
+    if end_date is not None:
+      end_time = parseAuditTime(end_date, end=True)
+    else:
+      end_time = datetime.datetime.utcnow()
+    shards = [(formatAuditTime(shard_start), formatAuditTime(shard_end)) for shard_start, shard_end in auditShards(start_time, end_time, shard_count)]
+  elif end_date is not None:
+    shards = [(None, formatAuditTime(parseAuditTime(end_date, end=True)))]
+  else:
+    shards = [(None, None)]
   orgs = getOrgObject()
   customer_id = orgs.RetrieveCustomerId()['customerId']
-  aa = getAdminAuditObject()
-  results = aa.retrieve_audit(customer_id=customer_id, admin=admin, event=event, start_date=start_date, end_date=end_date)
-  #for result in results['items']:
-  #  pp.pprint(result)
-  #  print ''
-  print results
-  sys.exit(0)
-  for result in results['items']:
-    #print result['events'][0]['name']
-    #print result['actor']['email']
-    event_name = result['events'][0]['name']
-    description = ''
-    if event_name == 'RENAME_USER':
-      description = '%s has been renamed to %s' % (result['events'][0]['parameters'][0]['value'], result['events'][0]['parameters'][1]['value'])
-    elif event_name == 'CHANGE_PASSWORD':
-      description = 'Password has been changed for %s' % result['events'][0]['parameters'][0]['value']
-    elif event_name == 'REMOVE_NICKNAME':
-      description = '%s is removed as a nickname of %s' % (result['events'][0]['parameters'][0]['value'], result['events'][0]['parameters'][1]['value'])
-    elif event_name == 'CHANGE_CALENDAR_SETTING':
-      #print result['events'][0]['parameters']
-      print result
-      description = '%s for calendar service on %s has been changed from %s to %s' % (result['events'][0]['parameters'][0]['value'], result['events']['DOMAIN_NAME'], result['events'][0]['parameters'][0]['OLD_VALUE'], result['events'][0]['parameters'][0]['NEW_VALUE'])
-    print '%s,%s,%s,%s,%s' % (event_name, description, result['actor']['email'], result['ipAddress'], result['id']['time'])
-    #exit(0)
-  
+  def getShard(shard_start, shard_end):
+    def call():
+      aa = getAdminAuditObject()
+      spool = tempfile.TemporaryFile()
+      for page in aa.retrieve_audit_pages(customer_id=customer_id, admin=admin, event=event, start_date=shard_start, end_date=shard_end):
+        for activity in page:
+          spool.write(json.dumps(activity)+'\n')
+      spool.seek(0)
+      return spool
+    return call
+  writer = getRowWriter(AUDIT_TITLES)
+  try:
+    try:
+      for spool in gamlib.workers.IterConcurrently([getShard(shard_start, shard_end) for shard_start, shard_end in shards], shard_count):
+        for line in spool:
+          for row in auditRows(json.loads(line)):
+            writer.WriteRow(row)
+        spool.close()
+    except gdata.service.RequestError, e:
+      print 'Error: %s' % e
+      sys.exit(1)
+  finally:
+    # a gzipped file is only readable once it is closed
+    writer.Close()
+
 def doArrows(users):
   if sys.argv[4].lower() == 'on':
     SetArrows = True
   elif sys.argv[4].lower() == 'off':
     SetArrows = False
-  emailsettings = getEmailSettingsObject()
-  count = len(users)
-  i = 1
-  for user in users:
+  def processUser(user, i, count):
+    emailsettings = getEmailSettingsObject()
     print "Setting Personal Indicator Arrows to %s for %s (%s of %s)" % (str(SetArrows), user, i, count)
     if user.find('@') > 0:
       emailsettings.domain = user[user.find('@')+1:]
@@ -1030,17 +1376,15 @@ def doArrows(users):
     else:
       emailsettings.domain = domain #make sure it's back at default domain
     emailsettings.UpdateGeneral(username=user, arrows=SetArrows)
-    i = i + 1
+  runForUsers(users, processUser)
 
 def doSnippets(users):
   if sys.argv[4].lower() == 'on':
     SetSnippets = True
   elif sys.argv[4].lower() == 'off':
     SetSnippets = False
-  emailsettings = getEmailSettingsObject()
-  count = len(users)
-  i = 1
-  for user in users:
+  def processUser(user, i, count):
+    emailsettings = getEmailSettingsObject()
     print "Setting Preview Snippets to %s for %s (%s of %s)" % (str(SetSnippets), user, i, count)
     if user.find('@') > 0:
       emailsettings.domain = user[user.find('@')+1:]
@@ -1048,14 +1392,12 @@ def doSnippets(users):
     else:
       emailsettings.domain = domain #make sure it's back at default domain
     emailsettings.UpdateGeneral(username=user, snippets=SetSnippets)
-    i = i + 1
+  runForUsers(users, processUser)
 
 def doLabel(users):
   label = sys.argv[4]
-  emailsettings = getEmailSettingsObject()
-  count = len(users)
-  i = 1
-  for user in users:
+  def processUser(user, i, count):
+    emailsettings = getEmailSettingsObject()
     print "Creating label %s for %s (%s of %s)" % (label, user, i, count)
     if user.find('@') > 0:
       emailsettings.domain = user[user.find('@')+1:]
@@ -1063,14 +1405,12 @@ def doLabel(users):
     else:
       emailsettings.domain = domain #make sure it's back at default domain
     emailsettings.CreateLabel(username=user, label=label)
-    i = i + 1
+  runForUsers(users, processUser)
 
 def doDeleteLabel(users):
   label = sys.argv[5]
-  emailsettings = getEmailSettingsObject()
-  count = len(users)
-  i = 1
-  for user in users:
+  def processUser(user, i, count):
+    emailsettings = getEmailSettingsObject()
     print "Deleting label %s for %s (%s of %s)" % (label, user, i, count)
     if user.find('@') > 0:
       emailsettings.domain = user[user.find('@')+1:]
@@ -1081,11 +1421,11 @@ def doDeleteLabel(users):
       results = emailsettings.DeleteLabel(username=user, label=label)
     except gdata.service.RequestError, e:
       print e
-    i = i + 1
+  runForUsers(users, processUser)
 
 def showLabels(users):
-  emailsettings = getEmailSettingsObject()
-  for user in users:
+  def processUser(user, i, count):
+    emailsettings = getEmailSettingsObject()
     print '%s has the following labels:' %  user
     if user.find('@') > 0:
       emailsettings.domain = user[user.find('@')+1:]
@@ -1096,6 +1436,7 @@ def showLabels(users):
     for label in labels:
       print ' %s  Unread:%s  Visibility:%s' % (label['label'], label['unreadCount'], label['visibility'])
     print ''
+  runForUsers(users, processUser)
 
 def doFilter(users):
   i = 4 # filter arguments start here
@@ -1165,10 +1506,8 @@ def doFilter(users):
   if not haveAction:
     showUsage()
     sys.exit(2)
-  emailsettings = getEmailSettingsObject()
-  count = len(users)
-  i = 1
-  for user in users:
+  def processUser(user, i, count):
+    emailsettings = getEmailSettingsObject()
     print "Creating filter for %s (%s of %s)" % (user, i, count)
     if user.find('@') > 0:
       emailsettings.domain = user[user.find('@')+1:]
@@ -1176,7 +1515,7 @@ def doFilter(users):
     else:
       emailsettings.domain = domain #make sure it's back at default domain
     emailsettings.CreateFilter(username=user, from_=from_, to=to, subject=subject, has_the_word=has_the_word, does_not_have_the_word=does_not_have_the_word, has_attachment=has_attachment, label=label, should_mark_as_read=should_mark_as_read, should_archive=should_archive, should_star=should_star, forward_to=forward_to, should_trash=should_trash, should_not_spam=should_not_spam)
-    i = i + 1
+  runForUsers(users, processUser)
 
 def doForward(users):
   checkTOS = True
@@ -1208,10 +1547,8 @@ def doForward(users):
   if enable and (not gotAction or not gotForward):
     showUsage()
     sys.exit()
-  emailsettings = getEmailSettingsObject()
-  count = len(users)
-  i = 1
-  for user in users:
+  def processUser(user, i, count):
+    emailsettings = getEmailSettingsObject()
     print "Turning forward %s for %s, emails will be %s (%s of %s)" % (sys.argv[4], user, action, i, count)
     if checkTOS:
       if not hasAgreed2TOS(user):
@@ -1222,23 +1559,19 @@ def doForward(users):
     else:
       emailsettings.domain = domain #make sure it's back at default domain
     emailsettings.UpdateForwarding(username=user, enable=enable, action=action, forward_to=forward_to)
-    i = i + 1
+  runForUsers(users, processUser)
 
 def getForward(users):
-  emailsettings = getEmailSettingsObject()
-  for user in users:
+  def processUser(user, i, count):
+    emailsettings = getEmailSettingsObject()
     if user.find('@') > 0:
       emailsettings.domain = user[user.find('@')+1:]
       user = user[:user.find('@')]
     else:
       emailsettings.domain = domain
-    while True:
-      try:
-        forward = emailsettings.GetForward(username=user)
-        break
-      except gdata.apps.service.AppsForYourDomainException, e:
-        pass
+    forward = emailsettings.GetForward(username=user)
     print "User %s:  Forward To:%s  Enabled:%s  Action:%s" % (user, forward['forwardTo'], forward['enable'], forward['action'])
+  runForUsers(users, processUser)
 
 def doSignature(users):
   signature = cgi.escape(sys.argv[4]).replace('\\n', '&#xA;')
@@ -1246,10 +1579,8 @@ def doSignature(users):
 <atom:entry xmlns:atom="http://www.w3.org/2005/Atom" xmlns:apps="http://schemas.google.com/apps/2006">
     <apps:property name="signature" value="'''+signature+'''" />
 </atom:entry>'''
-  emailsettings = getEmailSettingsObject()
-  count = len(users)
-  i = 1
-  for user in users:
+  def processUser(user, i, count):
+    emailsettings = getEmailSettingsObject()
     print "Setting Signature for %s (%s of %s)" % (user, i, count)
     #emailsettings.UpdateSignature(username=user, signature=signature)
     if user.find('@') > 0:
@@ -1259,11 +1590,11 @@ def doSignature(users):
       emailsettings.domain = domain #make sure it's back at default domain
     uri = 'https://apps-apis.google.com/a/feeds/emailsettings/2.0/'+emailsettings.domain+'/'+user+'/signature'
     emailsettings.Put(xmlsig, uri)
-    i = i + 1
+  runForUsers(users, processUser)
 
 def getSignature(users):
-  emailsettings = getEmailSettingsObject()
-  for user in users:
+  def processUser(user, i, count):
+    emailsettings = getEmailSettingsObject()
     if user.find('@') > 0:
       emailsettings.domain = user[user.find('@')+1:]
       user = user[:user.find('@')]
@@ -1271,6 +1602,7 @@ def getSignature(users):
       emailsettings.domain = domain
     signature = emailsettings.GetSignature(username=user)
     print "User %s:  Signature: %s" % (user, signature['signature'])
+  runForUsers(users, processUser)
 
 def doWebClips(users):
   if sys.argv[4].lower() == 'on':
@@ -1280,10 +1612,8 @@ def doWebClips(users):
   else:
     showUsage()
     sys.exit(2)
-  emailsettings = getEmailSettingsObject()
-  count = len(users)
-  i = 1
-  for user in users:
+  def processUser(user, i, count):
+    emailsettings = getEmailSettingsObject()
     print "Turning Web Clips %s for %s (%s of %s)" % (sys.argv[4], user, i, count)
     if user.find('@') > 0:
       emailsettings.domain = user[user.find('@')+1:]
@@ -1291,7 +1621,7 @@ def doWebClips(users):
     else:
       emailsettings.domain = domain #make sure it's back at default domain
     emailsettings.UpdateWebClipSettings(username=user, enable=enable)
-    i = i + 1
+  runForUsers(users, processUser)
 
 def doVacation(users):
   subject = message = ''
@@ -1327,9 +1657,6 @@ def doVacation(users):
     else:
       showUsage()
       sys.exit(2)
-  i = 1
-  count = len(users)
-  emailsettings = getEmailSettingsObject()
   message = cgi.escape(message).replace('\\n', '&#xA;')
   vacxml = '''<?xml version="1.0" encoding="utf-8"?>
 <atom:entry xmlns:atom="http://www.w3.org/2005/Atom" xmlns:apps="http://schemas.google.com/apps/2006">
@@ -1344,7 +1671,8 @@ def doVacation(users):
     if end_date != None:
       vacxml += '<apps:property name="endDate" value="%s" />' % end_date
   vacxml += '</atom:entry>'
-  for user in users:
+  def processUser(user, i, count):
+    emailsettings = getEmailSettingsObject()
     print "Setting Vacation for %s (%s of %s)" % (user, i, count)
     if user.find('@') > 0:
       emailsettings.domain = user[user.find('@')+1:]
@@ -1354,11 +1682,11 @@ def doVacation(users):
     uri = 'https://apps-apis.google.com/a/feeds/emailsettings/2.0/'+emailsettings.domain+'/'+user+'/vacation'
     emailsettings.Put(vacxml, uri)
     #emailsettings.UpdateVacation(username=user, enable=enable, subject=subject, message=message, contacts_only=contacts_only, domain_only=domain_only, start_date=start_date, end_date=end_date)
-    i = i + 1
+  runForUsers(users, processUser)
 
 def getVacation(users):
-  emailsettings = getEmailSettingsObject()
-  for user in users:
+  def processUser(user, i, count):
+    emailsettings = getEmailSettingsObject()
     if user.find('@') > 0:
       emailsettings.domain = user[user.find('@')+1:]
       user = user[:user.find('@')]
@@ -1374,6 +1702,7 @@ def getVacation(users):
  Start Date: %s
  End Date: %s
 ''' % (user, vacationsettings['enable'], vacationsettings['contactsOnly'], vacationsettings['domainOnly'], vacationsettings['subject'], vacationsettings['message'], vacationsettings['startDate'], vacationsettings['endDate'])
+  runForUsers(users, processUser)
 
 
 def doCreateUser():
@@ -2025,7 +2354,6 @@ def doUpdateOrg():
 
 def doGetUserInfo():
   user_name = sys.argv[3]
-  apps = getAppsObject()
   getAliases = getGroups = getOrg = True
   i = 4
   while i < len(sys.argv):
@@ -2038,11 +2366,48 @@ def doGetUserInfo():
     elif sys.argv[i].lower() == 'noorg':
       getOrg = False
       i = i + 1
+  apps = getAppsObject()
   if user_name.find('@') > 0:
-    apps.domain = user_name[user_name.find('@')+1:]
+    user_domain = user_name[user_name.find('@')+1:]
     user_name = user_name[:user_name.find('@')]
-  user = apps.RetrieveUser(user_name)
-  print 'User: %s' % user.login.user_name + '@' + apps.domain
+  else:
+    user_domain = apps.domain
+  user_email = '%s@%s' % (user_name, user_domain)
+  # The lookups run at once, each thread with its own service objects.
+  # Errors are returned instead of raised so they surface where they did
+  # when the lookups ran one after the other.
+  def lookup(func):
+    def call():
+      try:
+        return func()
+      except gdata.apps.service.AppsForYourDomainException, e:
+        return e
+    return call
+  def retrieveUser():
+    apps = getAppsObject()
+    apps.domain = user_domain
+    return apps.RetrieveUser(user_name)
+  def retrieveOrg():
+    return getOrgObject().RetrieveUserOrganization(user_email)
+  def retrieveAliases():
+    return getMultiDomainObject().GetUserAliases(user_email)
+  def retrieveGroups():
+    groupObj = getGroupsObject()
+    groupObj.domain = user_domain
+    return groupObj.RetrieveGroups(user_email)
+  lookups = [('user', retrieveUser)]
+  if getOrg:
+    lookups.append(('org', retrieveOrg))
+  if getAliases:
+    lookups.append(('aliases', retrieveAliases))
+  if getGroups:
+    lookups.append(('groups', retrieveGroups))
+  results = dict(zip([name for name, func in lookups],
+                     gamlib.workers.CallConcurrently([lookup(func) for name, func in lookups])))
+  user = results['user']
+  if isinstance(user, Exception):
+    raise user
+  print 'User: %s' % user.login.user_name + '@' + user_domain
   print 'First Name: %s' % user.name.given_name
   print 'Last Name: %s' % user.name.family_name
   print 'Is an admin: %s' % user.login.admin
@@ -2052,22 +2417,22 @@ def doGetUserInfo():
   print 'Must Change Password: %s' % user.login.change_password
   print 'Quota: %s' % user.quota.limit
   if getOrg:
-    orgObj = getOrgObject()
-    try:
-      user_org = orgObj.RetrieveUserOrganization('%s@%s' % (user_name, apps.domain))
+    user_org = results['org']
+    if isinstance(user_org, Exception):
+      print user_org
+    else:
       print 'Organization: %s' % user_org['orgUnitPath']
-    except gdata.apps.service.AppsForYourDomainException, e:
-      print e
   if getAliases:
-    multi = getMultiDomainObject()
     print 'Email Aliases (Nicknames):'
-    nicknames = multi.GetUserAliases(user_name+'@'+apps.domain)
+    nicknames = results['aliases']
+    if isinstance(nicknames, Exception):
+      raise nicknames
     for nick in nicknames:
       print '  ' + nick['aliasEmail']
   if getGroups:
-    groupObj = getGroupsObject()
-    groupObj.domain = apps.domain
-    groups = groupObj.RetrieveGroups('%s@%s' % (user_name, apps.domain))
+    groups = results['groups']
+    if isinstance(groups, Exception):
+      raise groups
     print 'Groups:'
     for group in groups:
       if group['directMember'] == 'true':
@@ -2323,6 +2688,10 @@ def doUpdateDomain():
   else:
     print 'Error: that is not a valid "gam update domain" command'
 
+# Settings doGetDomainInfo() asks for at once, few enough to stay clear of
+# the admin settings API's limits
+DOMAIN_INFO_WORKERS = 4
+
 def doGetDomainInfo():
   adminObj = getAdminSettingsObject()
   if len(sys.argv) > 4 and sys.argv[3].lower() == 'logo':
@@ -2336,52 +2705,51 @@ def doGetDomainInfo():
       print 'Error: can\'t open file %s for writing' % target_file
       sys.exit(11)
     sys.exit(0)
-  #pause 1 sec inbetween calls to prevent quota warning
+  def getSetting(name):
+    # each thread uses its own service object
+    return lambda: getattr(getAdminSettingsObject(), name)()
+  def getSSOKey():
+    try:
+      return getAdminSettingsObject().GetSSOKey()
+    except gdata.apps.service.AppsForYourDomainException:
+      return {}
+  (default_language, organization_name, maximum_users, current_users,
+   domain_verified, support_pin, edition, customer_pin, creation_time,
+   country_code, admin_secondary_email, cnameverificationstatus,
+   mxverificationstatus, ssosettings, ssokey, migration_status,
+   outbound_gateway_settings) = gamlib.workers.CallConcurrently([
+    getSetting('GetDefaultLanguage'), getSetting('GetOrganizationName'),
+    getSetting('GetMaximumNumberOfUsers'), getSetting('GetCurrentNumberOfUsers'),
+    getSetting('IsDomainVerified'), getSetting('GetSupportPIN'),
+    getSetting('GetEdition'), getSetting('GetCustomerPIN'),
+    getSetting('GetCreationTime'), getSetting('GetCountryCode'),
+    getSetting('GetAdminSecondaryEmail'), getSetting('GetCNAMEVerificationStatus'),
+    getSetting('GetMXVerificationStatus'), getSetting('GetSSOSettings'),
+    getSSOKey, getSetting('IsUserMigrationEnabled'),
+    getSetting('GetOutboundGatewaySettings')], DOMAIN_INFO_WORKERS)
   print 'Google Apps Domain: ', adminObj.domain
-  time.sleep(1)
-  print 'Default Language: ', adminObj.GetDefaultLanguage()
-  time.sleep(1)
-  print 'Organization Name: ', adminObj.GetOrganizationName()
-  time.sleep(1)
-  print 'Maximum Users: ', adminObj.GetMaximumNumberOfUsers()
-  time.sleep(1)
-  print 'Current Users: ', adminObj.GetCurrentNumberOfUsers()
-  time.sleep(1)
-  print 'Domain is Verified: ',adminObj.IsDomainVerified()
-  time.sleep(1)
-  print 'Support PIN: ',adminObj.GetSupportPIN()
-  time.sleep(1)
-  print 'Domain Edition: ', adminObj.GetEdition()
-  time.sleep(1)
-  print 'Customer PIN: ', adminObj.GetCustomerPIN()
-  time.sleep(1)
-  print 'Domain Creation Time: ', adminObj.GetCreationTime()
-  time.sleep(1)
-  print 'Domain Country Code: ', adminObj.GetCountryCode()
-  time.sleep(1)
-  print 'Admin Secondary Email: ', adminObj.GetAdminSecondaryEmail()
-  time.sleep(1)
-  cnameverificationstatus = adminObj.GetCNAMEVerificationStatus()
+  print 'Default Language: ', default_language
+  print 'Organization Name: ', organization_name
+  print 'Maximum Users: ', maximum_users
+  print 'Current Users: ', current_users
+  print 'Domain is Verified: ', domain_verified
+  print 'Support PIN: ', support_pin
+  print 'Domain Edition: ', edition
+  print 'Customer PIN: ', customer_pin
+  print 'Domain Creation Time: ', creation_time
+  print 'Domain Country Code: ', country_code
+  print 'Admin Secondary Email: ', admin_secondary_email
   print 'CNAME Verification Record Name: ', cnameverificationstatus['recordName']
   print 'CNAME Verification Verified: ', cnameverificationstatus['verified']
   print 'CNAME Verification Method: ', cnameverificationstatus['verificationMethod']
-  time.sleep(1)
-  mxverificationstatus = adminObj.GetMXVerificationStatus()
   print 'MX Verification Verified: ', mxverificationstatus['verified']
   print 'MX Verification Method: ', mxverificationstatus['verificationMethod']
-  time.sleep(1)
-  ssosettings = adminObj.GetSSOSettings()
   print 'SSO Enabled: ', ssosettings['enableSSO']
   print 'SSO Signon Page: ', ssosettings['samlSignonUri']
   print 'SSO Logout Page: ', ssosettings['samlLogoutUri']
   print 'SSO Password Page: ', ssosettings['changePasswordUri']
   print 'SSO Whitelist IPs: ', ssosettings['ssoWhitelist']
   print 'SSO Use Domain Specific Issuer: ', ssosettings['useDomainSpecificIssuer']
-  time.sleep(1)
-  try:
-    ssokey = adminObj.GetSSOKey()
-  except gdata.apps.service.AppsForYourDomainException:
-    ssokey = {}
   try:
     algorithm = str(ssokey['algorithm'])
     print 'SSO Key Algorithm: ' + algorithm
@@ -2412,11 +2780,7 @@ def doGetDomainInfo():
     print 'Full SSO Key: ' + signingKey
   except KeyError:
     pass
-  time.sleep(1)
-  migration_status = adminObj.IsUserMigrationEnabled()
   print 'User Migration Enabled: ', str(migration_status)
-  time.sleep(1)
-  outbound_gateway_settings = adminObj.GetOutboundGatewaySettings()
   print 'Outbound Gateway Smart Host: ', outbound_gateway_settings['smartHost']
   try:
     print 'Outbound Gateway SMTP Mode: ', outbound_gateway_settings['smtpMode']
@@ -2530,241 +2894,429 @@ def doPrintPostini():
   for group in groups:
     print group_template.replace('%group%', str(group['groupId'])).replace('%name%', str(group['groupName'])).replace('%description%', str(group['description'])).replace('%list_owner%', list_owner)
 
+# Aliases returned per page of MultiDomainService.RetrieveAllAliases()
+ALIASES_PER_PAGE = 100
+
+def getAliasesForUsers(emails, domain_sizes):
+  # Returns a dict of user email -> list of the user's alias emails.
+  # For each domain this lists all aliases of the domain and joins them on
+  # userEmail, about one request per ALIASES_PER_PAGE users of the domain
+  # (domain_sizes has the user counts), unless asking for the aliases of
+  # each user is fewer requests.
+  multi = getMultiDomainObject()
+  user_aliases = {}
+  emails_by_domain = {}
+  for email in emails:
+    user_aliases[email] = []
+    user_domain = email[email.find('@')+1:]
+    emails_by_domain.setdefault(user_domain, []).append(email)
+  for user_domain, domain_emails in emails_by_domain.items():
+    list_cost = domain_sizes.get(user_domain, 0) / ALIASES_PER_PAGE + 1
+    if len(domain_emails) <= list_cost:
+      user_count = 1
+      for email in domain_emails:
+        sys.stderr.write("Getting Aliases for %s (%s/%s)\r\n" % (email, user_count, len(domain_emails)))
+        try:
+          for alias in multi.GetUserAliases(email):
+            user_aliases[email].append(alias['aliasEmail'])
+        except gdata.apps.service.AppsForYourDomainException, e:
+          if e.reason != 'EntityDoesNotExist':
+            raise
+        user_count = user_count + 1
+    else:
+      sys.stderr.write("Getting all aliases in the %s domain...\r\n" % user_domain)
+      multi.domain = user_domain
+      for alias in multi.RetrieveAllAliases():
+        try:
+          user_aliases[alias['userEmail'].lower()].append(alias['aliasEmail'])
+        except KeyError:
+          pass
+  return user_aliases
+
+# Members returned per page of GroupsService.RetrieveAllMembers()
+MEMBERS_PER_PAGE = 200
+# Threads listing group members when gam runs with a single worker
+GROUP_MEMBER_WORKERS = 10
+
+def getGroupsForUsers(emails):
+  # Returns a dict of user email -> list of the ids of the groups of the
+  # user's domain the user belongs to, directly or through other groups.
+  # For each domain this either asks for the groups of each user, one
+  # request per user, or lists the groups of the domain and their members
+  # and inverts that, about one request per group plus the member pages.
+  # Groups are listed only while there are fewer of them than users, so
+  # when asking per user is cheaper few requests are wasted finding out.
+  groupsObj = getGroupsObject()
+  user_groups = {}
+  emails_by_domain = {}
+  for email in emails:
+    user_groups[email] = []
+    user_domain = email[email.find('@')+1:]
+    emails_by_domain.setdefault(user_domain, []).append(email)
+  for user_domain, domain_emails in emails_by_domain.items():
+    groupsObj.domain = user_domain
+    sys.stderr.write("Getting groups in the %s domain...\r\n" % user_domain)
+    group_ids = []
+    pages = 0
+    for page in groupsObj.GetGeneratorForAllGroups():
+      pages = pages + 1
+      group_ids.extend([group['groupId'] for group in page])
+      if len(group_ids) >= len(domain_emails):
+        break
+    invert_cost = pages + len(group_ids) + len(domain_emails) / MEMBERS_PER_PAGE
+    inverted = None
+    if invert_cost < len(domain_emails):
+      sys.stderr.write("Getting members of %s groups in the %s domain\r\n" % (len(group_ids), user_domain))
+      inverted = invertGroupMembers(user_domain, group_ids, domain_emails)
+      if inverted is None:
+        sys.stderr.write("Getting the groups of each user in the %s domain instead\r\n" % user_domain)
+    if inverted is not None:
+      for email, group_list in inverted.items():
+        user_groups[email] = group_list
+    else:
+      user_count = 1
+      for email in domain_emails:
+        sys.stderr.write("Getting Group Membership for %s (%s/%s)\r\n" % (email, user_count, len(domain_emails)))
+        try:
+          for group in groupsObj.RetrieveGroups(email[:email.find('@')]):
+            user_groups[email].append(group['groupId'])
+        except gdata.apps.service.AppsForYourDomainException, e:
+          if e.reason != 'EntityDoesNotExist':
+            raise
+        user_count = user_count + 1
+  return user_groups
+
+def invertGroupMembers(group_domain, group_ids, emails):
+  # Lists the members of the groups concurrently and returns a dict of
+  # user email -> list of group ids for the emails, in the order of
+  # group_ids. Members which are groups pass their membership on, a member
+  # '*' stands for every user of the domain, so all emails get such groups.
+  # Returns None, after a warning, if the members of a group can't be
+  # listed, as the users of that group would be missing it.
+  def getMembers(group_id):
+    def call():
+      groupsObj = getGroupsObject()
+      groupsObj.domain = group_domain
+      try:
+        return groupsObj.RetrieveAllMembers(group_id, suspended_users=True)
+      except (gdata.apps.service.AppsForYourDomainException, gdata.service.RequestError), e:
+        sys.stderr.write('Warning: cannot get the members of %s, %s\n' % (group_id, e))
+        return None
+    return call
+  workers = getNumWorkers()
+  if workers < 2:
+    workers = GROUP_MEMBER_WORKERS
+  all_members = gamlib.workers.CallConcurrently([getMembers(group_id) for group_id in group_ids], workers)
+  if None in all_members:
+    return None
+  # parents maps a member to the groups it is a direct member of
+  parents = {}
+  for group_id, members in zip(group_ids, all_members):
+    for member in members:
+      parents.setdefault(member['memberId'].lower(), []).append(group_id)
+  group_order = {}
+  for group_id in group_ids:
+    group_order[group_id] = len(group_order)
+  user_groups = {}
+  for email in emails:
+    found = set()
+    todo = parents.get(email, []) + parents.get('*', [])
+    while todo:
+      group_id = todo.pop()
+      if group_id in found:
+        continue
+      found.add(group_id)
+      todo.extend(parents.get(group_id.lower(), []))
+    user_groups[email] = sorted(found, key=group_order.get)
+  return user_groups
+
+# GAM_LISTING_PARTITIONS splits the listings of all users and all groups of a
+# domain into this many ranges of usernames or group IDs which are fetched at
+# once, see listPartitioned(). The default of 1 pages through each listing one
+# page after the other, handing out every page as it arrives.
+listing_partitions = 1
+try:
+  listing_partitions = int(os.environ['GAM_LISTING_PARTITIONS'])
+except (KeyError, ValueError):
+  pass
+
+def keyspaceRanges(parts):
+  # Splits the keyspace of usernames and group IDs at letters into a list of
+  # (start, stop) ranges. The first range starts at None so it also holds
+  # keys starting with digits, the last one stops at None.
+  letters = 'abcdefghijklmnopqrstuvwxyz'
+  parts = max(1, min(parts, len(letters)))
+  bounds = [None] + [letters[i * len(letters) / parts] for i in range(1, parts)] + [None]
+  return zip(bounds[:-1], bounds[1:])
+
+def listPartitioned(retrieve_range, key):
+  # Calls retrieve_range(start, stop) for every range of the keyspace at once
+  # and yields the lists it returned in keyspace order, each as soon as it and
+  # the ranges before it are done, leaving out items whose key(item) an
+  # earlier range returned already.
+  calls = []
+  for start, stop in keyspaceRanges(listing_partitions):
+    calls.append(lambda start=start, stop=stop: retrieve_range(start, stop))
+  seen = set()
+  for result in gamlib.workers.IterConcurrently(calls):
+    items = []
+    for item in result:
+      item_key = key(item)
+      if item_key in seen:
+        continue
+      seen.add(item_key)
+      items.append(item)
+    yield items
+
+def listAllUsers(domain):
+  # Returns the UserEntry objects of all users in domain as an iterable of
+  # lists, in username order. Only the listing of all users in one piece can
+  # be resumed from a journal.
+  if listing_partitions < 2 or page_journal is not None:
+    apps = getAppsObject()
+    apps.domain = domain
+    return (page.entry for page in apps.GetGeneratorForAllUsers())
+  def retrieveRange(start, stop):
+    apps = getAppsObject()
+    apps.domain = domain
+    return apps.RetrieveRangeOfUsers(start, stop)
+  return listPartitioned(retrieveRange, lambda user: user.login.user_name.lower())
+
+def listAllGroups(domain, noUserManagedGroups=False):
+  # Returns the dicts of all groups in domain as an iterable of lists, in
+  # group ID order.
+  if listing_partitions < 2:
+    groupsObj = getGroupsObject()
+    groupsObj.domain = domain
+    return groupsObj.GetGeneratorForAllGroups(noUserManagedGroups)
+  def retrieveRange(start, stop):
+    groupsObj = getGroupsObject()
+    groupsObj.domain = domain
+    return groupsObj.RetrieveRangeOfGroups(start, stop, noUserManagedGroups)
+  return listPartitioned(retrieveRange, lambda group: group['groupId'].lower())
+
+# Print commands take "format csv|tsv|jsonl", "file <path>" and "gzip" to
+# choose how and where their rows are written, see getRowWriter(). They are
+# kept per thread as "gam batch" can run several commands at once.
+OUTPUT_ARGUMENTS = ['format', 'file', 'gzip']
+output_options = threading.local()
+
+def parseOutputArgument(i):
+  # Handles the output argument at sys.argv[i], returns the index of the next
+  # argument
+  if sys.argv[i].lower() == 'format':
+    output_format = sys.argv[i+1].lower()
+    if output_format not in gamlib.output.FORMATS:
+      print 'Error: format must be one of %s, not %s' % (', '.join(gamlib.output.FORMATS), sys.argv[i+1])
+      sys.exit(2)
+    if output_format == 'jsonl':
+      requireJson('format jsonl')
+    output_options.format = output_format
+    return i + 2
+  elif sys.argv[i].lower() == 'file':
+    output_options.file = sys.argv[i+1]
+    return i + 2
+  output_options.gzip = True
+  return i + 1
+
+def getRowWriter(titles):
+  output_file = getattr(output_options, 'file', None)
+  try:
+    return gamlib.output.RowWriter(titles, format=getattr(output_options, 'format', 'csv'), path=output_file, compress=getattr(output_options, 'gzip', False))
+  except IOError, e:
+    print 'Error: cannot write %s, %s' % (output_file, e)
+    sys.exit(2)
+
+class UserRecord(object):
+  # One user in "gam print users". __slots__ keeps the memory use of 100k
+  # users low, the fields are the CSV column titles.
+  __slots__ = ('Email', 'Firstname', 'Lastname', 'Username', 'OU', 'Suspended',
+               'ChangePassword', 'AgreedToTerms', 'Admin', 'Aliases', 'Groups')
+
+  def __init__(self, email):
+    for field in self.__slots__:
+      setattr(self, field, '')
+    self.Email = email
+
+  def GetRow(self, titles):
+    return [getattr(self, title) for title in titles]
+
 def doPrintUsers():
   org = getOrgObject()
   sys.stderr.write("Getting all users in the %s organization (may take some time on a large Google Apps account)...\r\n" % org.domain)
   i = 3
   getUserFeed = getNickFeed = getGroupFeed = False
   firstname = lastname = username = ou = suspended = changepassword = agreed2terms = admin = nicknames = groups = False
-  user_attributes = []
-  # the titles list ensures the CSV output has its parameters in the specified order. 
-  # Python's dicts can be listed in any order, and the order often changes between the
-  # header (user_attributes[0]) and the actual data rows.
+  # user_records keeps the users in the order of the organization feed,
+  # users_by_email finds them when merging in the other feeds
+  user_records = []
+  users_by_email = {}
+  # the titles list gives the CSV columns in the specified order, they are
+  # the UserRecord fields to print
   titles = ['Email']
-  user_attributes.append({'Email': 'Email'})
   while i < len(sys.argv):
     if sys.argv[i].lower() == 'firstname':
       getUserFeed = True
       firstname = True
-      user_attributes[0].update(Firstname='Firstname')
       titles.append('Firstname')
       i = i + 1
     elif sys.argv[i].lower() == 'lastname':
       getUserFeed = True
       lastname = True
-      user_attributes[0].update(Lastname='Lastname')
       titles.append('Lastname')
       i = i + 1
     elif sys.argv[i].lower() == 'username':
       username = True
-      user_attributes[0].update(Username='Username')
       titles.append('Username')
       i = i + 1
     elif sys.argv[i].lower() == 'ou':
       ou = True
-      user_attributes[0].update(OU='OU')
       titles.append('OU')
       i = i + 1
     elif sys.argv[i].lower() == 'suspended':
       getUserFeed = True
       suspended = True
-      user_attributes[0].update(Suspended='Suspended')
       titles.append('Suspended')
       i = i + 1
     elif sys.argv[i].lower() == 'changepassword':
       getUserFeed = True
       changepassword = True
-      user_attributes[0].update(ChangePassword='ChangePassword')
       titles.append('ChangePassword')
       i = i + 1
     elif sys.argv[i].lower() == 'agreed2terms':
       getUserFeed = True
       agreed2terms = True
-      user_attributes[0].update(AgreedToTerms='AgreedToTerms')
       titles.append('AgreedToTerms')
       i = i + 1
     elif sys.argv[i].lower() == 'admin':
       getUserFeed = True
       admin = True
-      user_attributes[0].update(Admin='Admin')
       titles.append('Admin')
       i = i + 1
     elif sys.argv[i].lower() == 'nicknames' or sys.argv[i].lower() == 'aliases':
       getNickFeed = True
       nicknames = True
-      user_attributes[0].update(Aliases='Aliases')
       titles.append('Aliases')
       i = i + 1
     elif sys.argv[i].lower() == 'groups':
       getGroupFeed = True
       groups = True
-      user_attributes[0].update(Groups='Groups')
       titles.append('Groups')
       i = i + 1
+    elif sys.argv[i].lower() in OUTPUT_ARGUMENTS:
+      i = parseOutputArgument(i)
     else:
       showUsage()
       exit(5)
-  while True:
+  # when every column comes from the organization feed there is nothing to
+  # merge, so rows are written as each page arrives instead of being kept
+  stream_rows = not (getUserFeed or getNickFeed or getGroupFeed)
+  if stream_rows:
+    writer = getRowWriter(titles)
+  domains = []
+  domain_sizes = {}
+  try:
     try:
-      all_users = org.RetrieveAllOrganizationUsers()
-      sys.stderr.write("done.\r\n")
-      break
+      for page in org.GetGeneratorForAllOrganizationUsers():
+        for user in page:
+          email = user['orgUserEmail'].lower()
+          domain = email[email.find('@')+1:]
+          domain_sizes[domain] = domain_sizes.get(domain, 0) + 1
+          if email[:2] == '.@' or email[:11] == 'gcc_websvc@' or email[:27] == 'secure-data-connector-user@' or email[-16:] == '@gtempaccount.com':  # not real users, skip em
+            continue
+          record = UserRecord(email)
+          if username:
+            record.Username = email[:email.find('@')]
+          if ou:
+            user_ou = user['orgUnitPath']
+            if user_ou == None:
+              user_ou = ''
+            record.OU = user_ou
+          if domain not in domains:
+            domains.append(domain)
+          if stream_rows:
+            writer.WriteRow(record.GetRow(titles))
+            continue
+          user_records.append(record)
+          users_by_email[email] = record
+          del(email, domain)
     except gdata.apps.service.AppsForYourDomainException, e:
       print e
-      continue
-  domains = []
-  for user in all_users:
-    email = user['orgUserEmail'].lower()
-    domain = email[email.find('@')+1:]
-    if email[:2] == '.@' or email[:11] == 'gcc_websvc@' or email[:27] == 'secure-data-connector-user@' or email[-16:] == '@gtempaccount.com':  # not real users, skip em
-      continue
-    user_attributes.append({'Email': email})
-    location = 0
-    try:
-      location = user_attributes.index({'Email': email})
-      if username:
-          user_attributes[location].update(Username=email[:email.find('@')])
-      if ou:
-          user_ou = user['orgUnitPath']
-          if user_ou == None:
-            user_ou = ''
-          user_attributes[location].update(OU=user_ou)
-    except ValueError:
-      raise
-    try:
-      domains.index(domain)
-    except ValueError:
-      domains.append(domain)
-    del(email, domain)
-  apps = getAppsObject()
+      sys.exit(5)
+  finally:
+    # a gzipped file is only readable once it is closed
+    if stream_rows:
+      writer.Close()
+  sys.stderr.write("done.\r\n")
+  if stream_rows:
+    return
   if getUserFeed:
     for domain in domains:
       sys.stderr.write("Getting detailed info for users in %s domain (may take some time on a large domain)...\r\n" % domain)
-      apps.domain = domain
-      for page in apps.GetGeneratorForAllUsers():
-        for user in page.entry:
+      for page in listAllUsers(domain):
+        for user in page:
           email = user.login.user_name.lower() + '@' + domain.lower()
           try:
-            location = 0
-            gotLocation = False
-            while not gotLocation and location < len(user_attributes):
-              location = location + 1
-              try:
-                if user_attributes[location]['Email'] == email:
-                  gotLocation = True
-              except IndexError:
-                continue
-            if firstname:
-              userfirstname = user.name.given_name
-              if userfirstname == None:
-                userfirstname = ''
-              try:
-                user_attributes[location].update(Firstname=userfirstname)
-              except IndexError:
-                continue
-            if lastname:
-              userlastname = user.name.family_name
-              if userlastname == None:
-                userlastname = ''
-              try:
-                user_attributes[location].update(Lastname=userlastname)
-              except IndexError:
-                continue
-            if suspended:
-              try:
-                user_attributes[location].update(Suspended=user.login.suspended)
-              except IndexError:
-                continue
-            if agreed2terms:
-              try:
-                user_attributes[location].update(AgreedToTerms=user.login.agreed_to_terms)
-              except IndexError:
-                continue
-            if changepassword:
-              try:
-                user_attributes[location].update(ChangePassword=user.login.change_password)
-              except IndexError:
-                continue
-            if admin:
-              try:
-                user_attributes[location].update(Admin=user.login.admin)
-              except IndexError:
-                continue
-          except ValueError:
-            pass
+            record = users_by_email[email]
+          except KeyError:
+            continue
+          if firstname:
+            userfirstname = user.name.given_name
+            if userfirstname == None:
+              userfirstname = ''
+            record.Firstname = userfirstname
+          if lastname:
+            userlastname = user.name.family_name
+            if userlastname == None:
+              userlastname = ''
+            record.Lastname = userlastname
+          if suspended:
+            record.Suspended = user.login.suspended
+          if agreed2terms:
+            record.AgreedToTerms = user.login.agreed_to_terms
+          if changepassword:
+            record.ChangePassword = user.login.change_password
+          if admin:
+            record.Admin = user.login.admin
           del (email)
-  total_users = len(user_attributes)
+  total_users = len(user_records)
   if getNickFeed:
-    multi = getMultiDomainObject()
-    user_count = 1
-    for user in user_attributes:
-      if user['Email'] == 'Email':
-        continue
-      nicknames = []
-      while True:
-        try:
-          sys.stderr.write("Getting Aliases for %s (%s/%s)\r\n" % (user['Email'], user_count, total_users))
-          nicknames = multi.GetUserAliases(user['Email'])
-          break
-        except gdata.apps.service.AppsForYourDomainException, e:
-          if e.reason == 'EntityDoesNotExist':
-            break
-          continue
+    user_aliases = getAliasesForUsers([user.Email for user in user_records], domain_sizes)
+    for user in user_records:
       nicklist = ''
-      for nickname in nicknames:
-        nicklist += nickname['aliasEmail']+' '
-      user.update(Aliases=nicklist)
-      user_count = user_count + 1
-      del (nicknames, nicklist)
+      for alias in user_aliases[user.Email]:
+        nicklist += alias+' '
+      user.Aliases = nicklist
+      del (nicklist)
   if getGroupFeed:
-    groupsObj = getGroupsObject()
-    user_count = 1
-    for user in user_attributes:
-      if user['Email'] == 'Email':
-        continue
-      sys.stderr.write("Getting Group Membership for %s (%s/%s)\r\n" % (user['Email'], user_count, total_users))
-      groupsObj.domain = user['Email'][user['Email'].find('@')+1:]
-      username = user['Email'][:user['Email'].find('@')]
-      groups = []
-      while True:
-        try:
-          groups = groupsObj.RetrieveGroups(username)
-          break
-        except gdata.apps.service.AppsForYourDomainException, e:
-          if e.reason == 'EntityDoesNotExist':
-            break
-          continue
+    user_groups = getGroupsForUsers([user.Email for user in user_records])
+    for user in user_records:
       grouplist = ''
-      for groupname in groups:
-        grouplist += groupname['groupId']+' '
-      user.update(Groups=grouplist)
-      user_count = user_count + 1
-      del (username, groups, grouplist)
+      for group_id in user_groups[user.Email]:
+        grouplist += group_id+' '
+      user.Groups = grouplist
+      del (grouplist)
 
-  if os.name == 'windows':
-    csv.register_dialect('winstdout', lineterminator='\r') # Stupid Windows always adds \n here...
-    writer = csv.DictWriter(sys.stdout, fieldnames=titles, dialect='winstdout', quoting=csv.QUOTE_MINIMAL)
-  else:
-    csv.register_dialect('nixstdout', lineterminator='\n')
-    writer = csv.DictWriter(sys.stdout, fieldnames=titles, dialect='nixstdout', quoting=csv.QUOTE_MINIMAL)
-  writer.writerows(user_attributes)      
+  writer = getRowWriter(titles)
+  for record in user_records:
+    writer.WriteRow(record.GetRow(titles))
+  writer.Close()
 
 def doPrintGroups():
   i = 3
   printname = printdesc = printperm = usedomain = nousermanagedgroups = onlyusermanagedgroups = False
-  group_attributes = []
-  group_attributes.append({'GroupID': 'GroupID'})
+  titles = ['GroupID']
   while i < len(sys.argv):
     if sys.argv[i].lower() == 'name':
       printname = True
-      group_attributes[0].update(Name='Name')
+      titles.append('Name')
       i = i + 1
     elif sys.argv[i].lower() == 'description':
-      group_attributes[0].update(Description='Description')
+      titles.append('Description')
       printdesc = True
       i = i + 1
     elif sys.argv[i].lower() == 'permission':
-      group_attributes[0].update(Permission='Permission')
+      titles.append('Permission')
       printperm = True
       i = i + 1
     elif sys.argv[i].lower() == 'domain':
@@ -2776,6 +3328,8 @@ def doPrintGroups():
     elif sys.argv[i].lower() == 'onlyusermanagedgroups':
       onlyusermanagedgroups = True
       i = i + 1
+    elif sys.argv[i].lower() in OUTPUT_ARGUMENTS:
+      i = parseOutputArgument(i)
     else:
       showUsage()
       exit(7)
@@ -2784,42 +3338,39 @@ def doPrintGroups():
     groupsObj.domain = usedomain
   sys.stderr.write("Retrieving All Groups for domain %s (may take some time on large domain)..." % groupsObj.domain)
   if not onlyusermanagedgroups:
-    all_groups = groupsObj.RetrieveAllGroups(nousermanagedgroups)
+    group_pages = listAllGroups(groupsObj.domain, nousermanagedgroups)
   else:
-    admin_and_user_groups = groupsObj.RetrieveAllGroups(False)
-    admin_groups = groupsObj.RetrieveAllGroups(True)
-    all_groups = []
-    for this_group in admin_and_user_groups:
-      this_group_is_admin_created = False
-      for that_group in admin_groups:
-        if this_group['groupId'] == that_group['groupId']:
-          this_group_is_admin_created = True
-          break
-      if not this_group_is_admin_created:
-        all_groups.append(this_group)
-  for group_vals in all_groups:
-    group = {}
-    group.update({'GroupID': group_vals['groupId']})
-    if printname:
-      name = group_vals['groupName']
-      if name == None:
-        name = ''
-      group.update({'Name': name})
-    if printdesc:
-      description = group_vals['description']
-      if description == None:
-        description = ''
-      group.update({'Description': description})
-    if printperm:
-      try:
-        group.update({'Permission': group_vals['emailPermission']})
-      except KeyError:
-        group.update({'Permission': 'Unknown'})
-    group_attributes.append(group)
-  for row in group_attributes:
-    for cell in row.values():
-      print str(cell)+',',
-    print ''
+    admin_group_ids = set()
+    for page in listAllGroups(groupsObj.domain, True):
+      for that_group in page:
+        admin_group_ids.add(that_group['groupId'])
+    group_pages = ([this_group for this_group in page if this_group['groupId'] not in admin_group_ids] for page in listAllGroups(groupsObj.domain, False))
+  # the header row goes out first and every group row is written as soon as
+  # its page arrives
+  writer = getRowWriter(titles)
+  try:
+    for page in group_pages:
+      for group_vals in page:
+        group = {}
+        group.update({'GroupID': group_vals['groupId']})
+        if printname:
+          name = group_vals['groupName']
+          if name == None:
+            name = ''
+          group.update({'Name': name})
+        if printdesc:
+          description = group_vals['description']
+          if description == None:
+            description = ''
+          group.update({'Description': description})
+        if printperm:
+          try:
+            group.update({'Permission': group_vals['emailPermission']})
+          except KeyError:
+            group.update({'Permission': 'Unknown'})
+        writer.WriteRow(group)
+  finally:
+    writer.Close()
 
 def doPrintNicknames():
   i = 3
@@ -2828,43 +3379,53 @@ def doPrintNicknames():
     if sys.argv[i].lower() == 'domain':
       usedomain = sys.argv[i+1]
       i = i + 2
+    elif sys.argv[i].lower() in OUTPUT_ARGUMENTS:
+      i = parseOutputArgument(i)
+    else:
+      showUsage()
+      sys.exit(2)
   multi = getMultiDomainObject()
   if usedomain:
     multi.domain = usedomain
   sys.stderr.write("Retrieving All Aliases for domain %s (may take some time on large domain)...\r\n\r\n" % multi.domain)
-  print "Alias, User"
-  nicknames = multi.RetrieveAllAliases()
-  for nickname in nicknames:
-    print "%s, %s" % (nickname['aliasEmail'], nickname['userEmail'])
+  writer = getRowWriter(['Alias', 'User'])
+  try:
+    for page in multi.GetGeneratorForAllAliases():
+      for nickname in page:
+        writer.WriteRow([nickname['aliasEmail'], nickname['userEmail']])
+  finally:
+    writer.Close()
 
 def doPrintOrgs():
   i = 3
   printname = printdesc = printparent = printinherit = False
-  org_attributes = []
-  org_attributes.append({'Path': 'Path'})
+  titles = ['Path']
   while i < len(sys.argv):
     if sys.argv[i].lower() == 'name':
       printname = True
-      org_attributes[0].update(Name='Name')
+      titles.append('Name')
       i = i + 1
     elif sys.argv[i].lower() == 'description':
       printdesc = True
-      org_attributes[0].update(Description='Description')
+      titles.append('Description')
       i = i + 1
     elif sys.argv[i].lower() == 'parent':
       printparent = True
-      org_attributes[0].update(Parent='Parent')
+      titles.append('Parent')
       i = i + 1
     elif sys.argv[i].lower() == 'inherit':
       printinherit = True
-      org_attributes[0].update(InheritanceBlocked='InheritanceBlocked')
+      titles.append('InheritanceBlocked')
       i = i + 1
+    elif sys.argv[i].lower() in OUTPUT_ARGUMENTS:
+      i = parseOutputArgument(i)
     else:
       showUsage()
       exit(8)
   org = getOrgObject()
   sys.stderr.write("Retrieving All Organizational Units for your account (may take some time on large domain)...")
   orgs = org.RetrieveAllOrganizationUnits()
+  writer = getRowWriter(titles)
   for org_vals in orgs:
     orgUnit = {}
     orgUnit.update({'Path': org_vals['orgUnitPath']})
@@ -2885,40 +3446,35 @@ def doPrintOrgs():
       orgUnit.update({'Parent': parent})
     if printinherit:
       orgUnit.update({'InheritanceBlocked': org_vals['blockInheritance']})
-    org_attributes.append(orgUnit)
-  for row in org_attributes:
-    for cell in row.values():
-      print str(cell)+',',
-    print ''    
+    writer.WriteRow(orgUnit)
+  writer.Close()
 
 def doPrintResources():
   i = 3
-  res_attributes = []
-  res_attributes.append({'Name': 'Name'})
   titles = ['Name']
   printid = printdesc = printemail = False
   while i < len(sys.argv):
     if sys.argv[i].lower() == 'id':
       printid = True
-      res_attributes[0].update(ID='ID')
       titles.append('ID')
       i = i + 1
     elif sys.argv[i].lower() == 'description':
       printdesc = True
-      res_attributes[0].update(Description='Description')
       titles.append('Description')
       i = i + 1
     elif sys.argv[i].lower() == 'email':
       printemail = True
-      res_attributes[0].update(Email='Email')
       titles.append('Email')
       i = i + 1
+    elif sys.argv[i].lower() in OUTPUT_ARGUMENTS:
+      i = parseOutputArgument(i)
     else:
       showUsage()
       sys.exit(2)
   resObj = getResCalObject()
   sys.stderr.write("Retrieving All Resource Calendars for your account (may take some time on a large domain)")
   resources = resObj.RetrieveAllResourceCalendars()
+  writer = getRowWriter(titles)
   for resource in resources:
     resUnit = {}
     resUnit.update({'Name': resource['resourceCommonName']})
@@ -2932,14 +3488,8 @@ def doPrintResources():
       resUnit.update({'Description': desc})
     if printemail:
       resUnit.update({'Email': resource['resourceEmail']})
-    res_attributes.append(resUnit)
-  if os.name == 'windows':
-    csv.register_dialect('winstdout', lineterminator='\r') # Stupid Windows always adds \n here...
-    writer = csv.DictWriter(sys.stdout, fieldnames=titles, dialect='winstdout', quoting=csv.QUOTE_MINIMAL)
-  else:
-    csv.register_dialect('nixstdout', lineterminator='\n')
-    writer = csv.DictWriter(sys.stdout, fieldnames=titles, dialect='nixstdout', quoting=csv.QUOTE_MINIMAL)
-  writer.writerows(res_attributes)      
+    writer.WriteRow(resUnit)
+  writer.Close()
 
 
 def hasAgreed2TOS(user_name):
@@ -3096,17 +3646,22 @@ def doDownloadActivityRequest():
   except KeyError:
     print 'ERROR: Request completed but no files were returned, try requesting again'
     sys.exit(4)
-  for i in range(0, int(results['numberOfFiles'])):
-    url = results['fileUrl'+str(i)]
-    filename = 'activity-'+user+'-'+request_id+'-'+str(i)+'.txt.gpg'
-    print 'Downloading '+filename+' ('+str(i+1)+' of '+results['numberOfFiles']+')'
-    geturl(url, filename)
+  downloadRequestFiles(results, 'activity-'+user+'-'+request_id+'-', '.txt.gpg')
 
 def doRequestExport():
-  begin_date = end_date = search_query = None
+  # gam audit export request <user>|group <group>|ou <ou>|file <file>|all users
+  # [begin <date>] [end <date>] [search <query>] [headersonly] [includedeleted]
+  # [state <file>]
+  begin_date = end_date = search_query = state_file = None
   headers_only = include_deleted = False
-  user = sys.argv[4].lower()
-  i = 5
+  if sys.argv[4].lower() in ['group', 'ou', 'file', 'all']:
+    entity = sys.argv[4].lower()
+    value = sys.argv[5]
+    user = None
+    i = 6
+  else:
+    user = sys.argv[4].lower()
+    i = 5
   while i < len(sys.argv):
     if sys.argv[i].lower() == 'begin':
       begin_date = sys.argv[i+1]
@@ -3123,9 +3678,18 @@ def doRequestExport():
     elif sys.argv[i].lower() == 'includedeleted':
       include_deleted = True
       i = i + 1
+    elif sys.argv[i].lower() == 'state' and user is None:
+      state_file = sys.argv[i+1]
+      i = i + 2
     else:
       showUsage()
       sys.exit(2)
+  if user is None:
+    if state_file is None:
+      state_file = getGamPath()+'exports-%s.gam' % sha1(' '.join(sys.argv[1:])).hexdigest()[:12]
+    doRequestExports(getUsersToModify(entity, value), state_file, begin_date=begin_date, end_date=end_date, include_deleted=include_deleted,
+                     search_query=search_query, headers_only=headers_only)
+    return
   audit = getAuditObject()
   if user.find('@') > 0:
     audit.domain = user[user.find('@')+1:]
@@ -3149,6 +3713,177 @@ def doRequestExport():
   except KeyError:
     print ' End: export request date'
 
+# Users whose export requests are submitted at once when gam runs with a
+# single worker
+EXPORT_WORKERS = 4
+# Seconds between checks of pending export requests. The wait doubles up to
+# EXPORT_POLL_MAX while no request finishes and drops back to EXPORT_POLL_MIN
+# when one does.
+EXPORT_POLL_MIN = 60
+EXPORT_POLL_MAX = 1800
+
+def loadExportState(state_file):
+  # The exports tracked in a state file, by user email address
+  if not os.path.isfile(state_file):
+    return {}
+  try:
+    state = open(state_file, 'rb')
+    try:
+      return json.load(state)['exports']
+    finally:
+      state.close()
+  except (IOError, ValueError, KeyError), e:
+    print 'Error: cannot read export state %s, %s' % (state_file, e)
+    sys.exit(2)
+
+def saveExportState(state_file, exports):
+  # Writes a temporary file first so an interrupted write never loses the
+  # request IDs
+  temp_file = state_file+'.tmp'
+  state = open(temp_file, 'wb')
+  try:
+    json.dump({'exports': exports}, state, indent=1, sort_keys=True)
+  finally:
+    state.close()
+  if os.name == 'nt' and os.path.exists(state_file):
+    os.remove(state_file)
+  os.rename(temp_file, state_file)
+
+def doRequestExports(users, state_file, **request):
+  # Requests the mailbox exports of many users, then checks their status
+  # until all are done and downloads every export as soon as it is
+  # COMPLETED. The request IDs are kept in state_file, running the command
+  # again picks up where it stopped without requesting exports twice.
+  requireJson('Exporting several mailboxes')
+  exports = loadExportState(state_file)
+  default_domain = getAuditObject().domain
+  emails = []
+  for user in users:
+    if user.find('@') < 0:
+      user = user+'@'+default_domain
+    if user.lower() not in emails:
+      emails.append(user.lower())
+  count = len(emails)
+  state_lock = threading.Lock()
+  def saveState():
+    state_lock.acquire()
+    try:
+      saveExportState(state_file, exports)
+    finally:
+      state_lock.release()
+  def say(message):
+    state_lock.acquire()
+    try:
+      sys.stdout.write(message+'\n')
+      sys.stdout.flush()
+    finally:
+      state_lock.release()
+  def requestExport(email):
+    def call():
+      audit = getAuditObject()
+      audit.domain = email[email.find('@')+1:]
+      try:
+        return audit.createMailboxExportRequest(user=email[:email.find('@')], **request), None
+      except (gdata.apps.service.AppsForYourDomainException, gdata.service.RequestError), e:
+        return None, e
+    return call
+  # exports which ended without files to download, like EXPIRED, DELETED or
+  # ERROR ones, are requested again
+  for email in emails:
+    if email in exports and exports[email]['status'] not in ['PENDING', 'COMPLETED', 'DOWNLOAD_FAILED', 'DOWNLOADED']:
+      del exports[email]
+  new_emails = [email for email in emails if email not in exports]
+  print 'Tracking exports in %s, requesting %s of %s...' % (state_file, len(new_emails), count)
+  workers = getNumWorkers()
+  if workers < 2:
+    workers = EXPORT_WORKERS
+  calls = [requestExport(email) for email in new_emails]
+  for email, (results, error) in zip(new_emails, gamlib.workers.IterConcurrently(calls, workers)):
+    if error is not None:
+      say('Error: export request for %s failed, %s' % (email, error))
+      continue
+    exports[email] = {'requestId': results['requestId'], 'status': results['status']}
+    saveState()
+  emails = [email for email in emails if email in exports]
+  workers = getNumWorkers()
+  if workers < 2:
+    workers = DOWNLOAD_WORKERS
+  downloads = gamlib.download.DownloadQueue(workers)
+  def download(email, results):
+    export = exports[email]
+    prefix = 'export-'+email[:email.find('@')]+'-'+export['requestId'].lower()+'-'
+    files = [(results['fileUrl'+str(i)], prefix+str(i)+'.mbox.gpg') for i in range(int(results['numberOfFiles']))]
+    def done(errors):
+      for path, error in errors:
+        say('Error: %s failed: %s' % (path, error))
+      if errors:
+        export['status'] = 'DOWNLOAD_FAILED'
+      else:
+        export['status'] = 'DOWNLOADED'
+        say('Downloaded the export of %s (%s files)' % (email, len(files)))
+      saveState()
+    export['status'] = 'COMPLETED'
+    saveState()
+    downloads.Add(files, done)
+  def checkExports():
+    # Returns True if an export finished since the last check
+    changed = False
+    pending = [email for email in emails if exports[email]['status'] == 'PENDING']
+    statuses = {}
+    for domain in set([email[email.find('@')+1:] for email in pending]):
+      audit = getAuditObject()
+      audit.domain = domain
+      try:
+        for results in audit.getAllMailboxExportRequestsStatus():
+          statuses[(results['userEmailAddress'].lower(), results['requestId'])] = results
+      except (gdata.apps.service.AppsForYourDomainException, gdata.service.RequestError), e:
+        say('Error: cannot get the export requests of %s, %s' % (domain, e))
+    for email in pending:
+      export = exports[email]
+      results = statuses.get((email, export['requestId']))
+      if results is not None and results['status'] == 'PENDING':
+        continue
+      audit = getAuditObject()
+      audit.domain = email[email.find('@')+1:]
+      try:
+        results = audit.getMailboxExportRequestStatus(email[:email.find('@')], export['requestId'])
+      except (gdata.apps.service.AppsForYourDomainException, gdata.service.RequestError), e:
+        say('Error: cannot get the export request of %s, %s' % (email, e))
+        continue
+      if results['status'] == 'PENDING':
+        continue
+      changed = True
+      if results['status'] == 'COMPLETED' and results.get('numberOfFiles'):
+        download(email, results)
+      elif results['status'] == 'COMPLETED':
+        say('Error: export request for %s completed without files' % email)
+        export['status'] = 'NO_FILES'
+        saveState()
+      else:
+        say('Error: export request for %s ended as %s' % (email, results['status']))
+        export['status'] = results['status']
+        saveState()
+    return changed
+  # exports which completed or failed to download before are fetched again
+  for email in emails:
+    if exports[email]['status'] in ['COMPLETED', 'DOWNLOAD_FAILED']:
+      exports[email]['status'] = 'PENDING'
+  delay = EXPORT_POLL_MIN
+  while True:
+    if checkExports():
+      delay = EXPORT_POLL_MIN
+    pending = len([email for email in emails if exports[email]['status'] == 'PENDING'])
+    if not pending:
+      break
+    say('%s of %s exports pending, checking again in %s seconds' % (pending, len(emails), delay))
+    time.sleep(delay)
+    delay = min(delay * 2, EXPORT_POLL_MAX)
+  downloads.Join()
+  downloaded = len([email for email in emails if exports[email]['status'] == 'DOWNLOADED'])
+  print 'Downloaded %s of %s exports' % (downloaded, count)
+  if downloaded < count:
+    sys.exit(1)
+
 def doDeleteExport():
   audit = getAuditObject()
   user = sys.argv[4].lower()
@@ -3234,15 +3969,7 @@ def doDownloadExportRequest():
   except KeyError:
     print 'ERROR: Request completed but no files were returned, try requesting again'
     sys.exit(4)
-  for i in range(0, int(results['numberOfFiles'])):
-    url = results['fileUrl'+str(i)]
-    filename = 'export-'+user+'-'+request_id+'-'+str(i)+'.mbox.gpg'
-    #don't download existing files. This does not check validity of existing local
-    #file so partial/corrupt downloads will need to be deleted manually.
-    if os.path.isfile(filename):
-      continue
-    print 'Downloading '+filename+' ('+str(i+1)+' of '+results['numberOfFiles']+')'
-    geturl(url, filename)
+  downloadRequestFiles(results, 'export-'+user+'-'+request_id+'-', '.mbox.gpg')
 
 def doUploadAuditKey():
   auditkey = sys.stdin.read()
@@ -3275,38 +4002,52 @@ def doDeleteAlias():
   multi = getMultiDomainObject()
   results = multi.DeleteAlias(alias_email=alias_email)
 
-def getUsersToModify():
-  entity = sys.argv[1].lower()
+def getUsersToModify(entity=None, value=None):
+  # The users named by "<entity> <value>", sys.argv[1] and sys.argv[2] if not
+  # given
+  if entity is None:
+    entity = sys.argv[1]
+    value = sys.argv[2]
+  entity = entity.lower()
   if entity == 'user':
-    users = [sys.argv[2].lower(),]
+    users = [value.lower(),]
   elif entity == 'group':
     groupsObj = getGroupsObject()
-    group = sys.argv[2].lower()
+    group = value.lower()
     print "Getting all members of %s (may take some time for large groups)..." % group
-    members = groupsObj.RetrieveAllMembers(group)
-    print "done.\r\n"
     users = []
-    for member in members:
-      users.append(member['memberId'][0:member['memberId'].find('@')])
+    for page in groupsObj.GetGeneratorForAllMembers(group):
+      for member in page:
+        users.append(member['memberId'][0:member['memberId'].find('@')])
+    print "done.\r\n"
   elif entity == 'ou':
     orgObj = getOrgObject()
-    ou = sys.argv[2]
+    ou = value
     print "Getting all users of %s Organizational Unit (May take some time for large OUs)..." % ou
-    members = orgObj.RetrieveAllOrganizationUnitUsers(ou)
-    print "done.\r\n"
     users = []
-    for member in members:
-      users.append(member['orgUserEmail'])
+    for page in orgObj.GetGeneratorForAllOrganizationUnitUsers(ou):
+      for member in page:
+        users.append(member['orgUserEmail'])
+    print "done.\r\n"
   elif entity == 'all':
     orgObj = getOrgObject()
     users = []
     print "Getting all users in the Google Apps %s organization (may take some time on a large domain)..." % orgObj.domain
-    members = orgObj.RetrieveAllOrganizationUsers()
-    for member in members:
-      if member['orgUserEmail'][:2] == '.@' or member['orgUserEmail'][:11] == 'gcc_websvc@' or member['orgUserEmail'][:27] == 'secure-data-connector-user@' or member['orgUserEmail'][-16:] == '@gtempaccount.com':  # not real users, skip em
-        continue
-      users.append(member['orgUserEmail'])
+    for page in orgObj.GetGeneratorForAllOrganizationUsers():
+      for member in page:
+        if member['orgUserEmail'][:2] == '.@' or member['orgUserEmail'][:11] == 'gcc_websvc@' or member['orgUserEmail'][:27] == 'secure-data-connector-user@' or member['orgUserEmail'][-16:] == '@gtempaccount.com':  # not real users, skip em
+          continue
+        users.append(member['orgUserEmail'])
     print "done.\r\n"
+  elif entity == 'file':
+    # one user per line
+    try:
+      user_file = open(value, 'rb')
+    except IOError, e:
+      print 'Error: cannot read %s, %s' % (value, e)
+      sys.exit(2)
+    users = [line.strip().lower() for line in user_file if line.strip()]
+    user_file.close()
   else:
     showUsage()
     sys.exit(2)
@@ -3438,7 +4179,9 @@ def doRequestOAuth():
   pickle.dump(final_token, f)
   f.close()
 
-try:
+def processGAMCommand():
+  # Runs the gam command in sys.argv, "gam" itself being sys.argv[0]
+  output_options.__dict__.clear()
   if sys.argv[1].lower() == 'version':
     doGAMVersion()
     exit(0)
@@ -3659,6 +4402,170 @@ try:
   else:
     showUsage()
     sys.exit(2)
+
+# "gam batch <file>" runs the gam commands in file, one per line, in this
+# process so they share the OAuth token, the service objects and the pooled
+# connections. "-" reads the commands from stdin. Blank lines and lines
+# starting with # are skipped, a leading "gam" is optional. "gam workers N
+# batch <file>" runs N commands at once, each of them on one thread; their
+# output still comes out in the order of the lines.
+def splitBatchLine(line):
+  # Splits a batch line into arguments the way a shell would. On Windows a
+  # backslash separates the parts of a path instead of escaping the next
+  # character, so it is kept, as cmd.exe keeps it.
+  lexer = shlex.shlex(line, posix=True)
+  lexer.whitespace_split = True
+  if os.name == 'nt':
+    lexer.escape = ''
+  return list(lexer)
+
+def doBatch():
+  filename = sys.argv[2]
+  if filename == '-':
+    batch_file = sys.stdin
+  else:
+    try:
+      batch_file = open(filename, 'rb')
+    except IOError, e:
+      print 'Error: cannot read batch file %s, %s' % (filename, e)
+      sys.exit(2)
+  commands = []
+  for line in batch_file:
+    try:
+      argv = splitBatchLine(line)
+    except ValueError, e:
+      print 'Error: cannot parse batch line "%s", %s' % (line.strip(), e)
+      sys.exit(2)
+    if not argv:
+      continue
+    if argv[0].lower() == 'gam':
+      argv = argv[1:]
+    commands.append(argv)
+  if batch_file is not sys.stdin:
+    batch_file.close()
+  if getOAuthToken() is None:
+    doRequestOAuth()
+  workers = max(getNumWorkers(), 1)
+  sys.argv = gamlib.workers.ThreadedArgv(sys.argv[:1])
+  def runCommand(argv, i, count):
+    sys.argv.set(sys.argv[:1] + argv)
+    command = ' '.join(argv)
+    try:
+      try:
+        processGAMCommand()
+      except IndexError:
+        showUsage()
+        sys.exit(2)
+    except SystemExit, e:
+      if e.code:
+        sys.stderr.write('Batch command %s of %s failed with status %s: %s\n' % (i, count, e.code, command))
+        raise
+    except Exception, e:
+      sys.stderr.write('Batch command %s of %s failed with %s: %s\n' % (i, count, e.__class__.__name__, command))
+      raise
+    sys.stderr.write('Batch command %s of %s done: %s\n' % (i, count, command))
+  # the commands run their users one at a time, the batch is what runs in
+  # parallel. The threads running the commands take these settings over.
+  previous = gamlib.workers.context.__dict__.copy()
+  gamlib.workers.context.num_workers = 1
+  if adaptive_workers:
+    gamlib.workers.context.concurrency_limiter = gamlib.throttle.AIMDLimiter(maximum=workers)
+  try:
+    failures = gamlib.workers.RunTasks(runCommand, commands, workers)
+  finally:
+    gamlib.workers.context.__dict__.clear()
+    gamlib.workers.context.__dict__.update(previous)
+  if failures > 0:
+    sys.stderr.write('Error: %s of %s batch commands failed\n' % (failures, len(commands)))
+    sys.exit(1)
+
+# "gam serve" keeps gam running with its OAuth token, service objects, pooled
+# connections and directory cache loaded, and runs the commands gamclient.py
+# sends it over a UNIX socket, gam.sock next to gam.py unless a path is given.
+# Only the user running the server can connect. The commands run with the
+# server's working directory, environment and workers setting, each on its own
+# thread with the service objects it checks out of service_pool.
+def doServe():
+  try:
+    socket_path = sys.argv[2]
+  except IndexError:
+    socket_path = getGamPath()+'gam.sock'
+  if not hasattr(socket, 'AF_UNIX'):
+    print 'Error: gam serve needs UNIX sockets, which this system does not have'
+    sys.exit(2)
+  requireJson('gam serve')
+  if getOAuthToken() is None:
+    doRequestOAuth()
+  sys.argv = gamlib.workers.ThreadedArgv(sys.argv[:1])
+  stdout, stderr = gamlib.workers.InstallThreadedOutput()
+  def runCommand(argv, command_stdout, command_stderr):
+    sys.argv.set(sys.argv[:1] + argv)
+    stdout.capture(command_stdout)
+    stderr.capture(command_stderr)
+    try:
+      try:
+        processGAMCommand()
+      except IndexError:
+        showUsage()
+        return 2
+      except SystemExit, e:
+        if e.code is None:
+          return 0
+        if isinstance(e.code, int):
+          return e.code
+        sys.stderr.write('%s\n' % e.code)
+        return 1
+      except Exception, e:
+        sys.stderr.write(traceback.format_exc())
+        return 1
+      return 0
+    finally:
+      releaseServiceObjects()
+      gamlib.workers.context.__dict__.clear()
+      stdout.capture(None)
+      stderr.capture(None)
+  try:
+    server = gamlib.server.CommandServer(socket_path, runCommand)
+  except socket.error, e:
+    print 'Error: cannot serve on %s, %s' % (socket_path, e)
+    sys.exit(2)
+  sys.stderr.write('Serving gam commands on %s\n' % socket_path)
+  try:
+    server.serve_forever()
+  finally:
+    server.server_close()
+
+try:
+  if os.environ.get('GAM_RATE_LIMITS'):
+    setRateLimits(os.environ['GAM_RATE_LIMITS'])
+  setPrefetch(os.environ.get('GAM_PREFETCH', '1'))
+  if os.environ.get('GAM_CACHE'):
+    setCache(os.environ['GAM_CACHE'])
+  if 'GAM_WORKERS' in os.environ:
+    setWorkers(os.environ['GAM_WORKERS'])
+  if sys.argv[1].lower() == 'workers':
+    setWorkers(sys.argv[2])
+    del sys.argv[1:3]
+  if sys.argv[1].lower() == 'journal' or sys.argv[1].lower() == 'resume':
+    resume = sys.argv[1].lower() == 'resume'
+    del sys.argv[1]
+    # the journal belongs to one command, not to the commands of a batch or
+    # server running at the same time
+    if sys.argv[1].lower() in ['batch', 'serve']:
+      print 'Error: gam journal and gam resume cannot run gam %s' % sys.argv[1].lower()
+      sys.exit(2)
+    startJournal(resume)
+  if sys.argv[1].lower() == 'batch':
+    doBatch()
+  elif sys.argv[1].lower() == 'serve':
+    doServe()
+  else:
+    processGAMCommand()
+  finishJournal()
+except SystemExit, e:
+  if not e.code:
+    finishJournal()
+  raise
 except IndexError:
   showUsage()
   sys.exit(2)
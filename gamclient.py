@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+#
+# Google Apps Manager
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Runs a gam command on a running "gam serve" process.
+
+Takes the same arguments as gam.py, e.g. gamclient.py info user jsmith, and
+exits with the status of the command. The server's socket is gam.sock next
+to this script, or the path in GAM_SOCKET.
+
+"""
+
+import os, socket, sys
+import gamlib.server
+
+socket_path = os.environ.get('GAM_SOCKET', os.path.join(os.path.dirname(os.path.realpath(sys.argv[0])), 'gam.sock'))
+try:
+  status = gamlib.server.RunRemoteCommand(socket_path, sys.argv[1:], sys.stdout, sys.stderr)
+except socket.error, e:
+  sys.stderr.write('Error: cannot reach gam serve on %s, %s\n' % (socket_path, e))
+  sys.exit(2)
+except ImportError, e:
+  sys.stderr.write('Error: %s\n' % e)
+  sys.exit(3)
+except KeyboardInterrupt:
+  sys.exit(50)
+sys.exit(status)
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+#
+# Google Apps Manager
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Helper modules used by gam.py.
+
+  workers: Runs per-user commands on a pool of worker threads.
+  throttle: Limits the rate and concurrency of API requests.
+  cache: Caches directory listings in a local SQLite database.
+  output: Writes the rows of print commands as CSV, TSV or JSON Lines.
+  server: Runs gam commands sent over a local UNIX socket.
+  reports: Keeps downloaded reports and merges the reports of several days.
+  download: Downloads audit export files at once, resuming partial ones.
+"""
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+#
+# Google Apps Manager
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A local SQLite cache of the directory listings gam fetches.
+
+  DirectoryCache: Keeps the pages of the property feeds listing users, OUs,
+      aliases, groups and group members. A listing is served from the cache
+      while it is younger than the time to live of its entity, every request
+      changing data drops the cached listings it can make stale. Install it
+      as gdata.service.GDataService.directory_cache.
+"""
+
+import cPickle
+import re
+import sqlite3
+import threading
+import time
+
+
+# Patterns of request URLs and the entity they list or change, the first
+# match wins. Requests to other URLs are not cached.
+ENTITY_URL_PATTERNS = (
+    ('users', re.compile(r'/a/feeds/(orguser/|user/|[^/]+/user/)')),
+    ('orgunits', re.compile(r'/a/feeds/orgunit/')),
+    ('aliases', re.compile(r'/a/feeds/(alias/|[^/]+/nickname/)')),
+    ('members', re.compile(r'/a/feeds/group/([^?]*/(member|owner)|.*[?&]member=)')),
+    ('groups', re.compile(r'/a/feeds/group/')),
+    )
+
+# The cached entities a change to an entity can make stale. Deleting a user
+# removes their aliases and memberships, moving or renaming an OU changes
+# the OU of its users.
+AFFECTED_ENTITIES = {
+    'users': ('users', 'aliases', 'members'),
+    'orgunits': ('orgunits', 'users'),
+    'aliases': ('aliases',),
+    'groups': ('groups', 'members'),
+    'members': ('members',),
+    }
+
+# Seconds a listing of each entity is served from the cache, override them
+# with GAM_CACHE.
+DEFAULT_CACHE_TTLS = {
+    'users': 3600,
+    'orgunits': 3600,
+    'aliases': 3600,
+    'groups': 3600,
+    'members': 3600,
+    }
+
+
+def GetEntity(url):
+  """Returns the entity a URL lists or changes, None if it is not cached."""
+  url = str(url)
+  for entity, pattern in ENTITY_URL_PATTERNS:
+    if pattern.search(url):
+      return entity
+  return None
+
+
+def ParseCacheTtls(value, ttls=None):
+  """Parses a cache setting like "on", "600" or "users=600,groups=60".
+
+  Args:
+    value: string "on" for the default times to live, a number of seconds
+        for every entity, or comma separated entity=seconds pairs. A time to
+        live of 0 stops caching that entity.
+    ttls: dict (optional) The times to live to update, DEFAULT_CACHE_TTLS if
+        not given.
+
+  Returns:
+    A dict with the time to live of every entity.
+
+  Raises:
+    ValueError: if value is not valid.
+  """
+  if ttls is None:
+    ttls = DEFAULT_CACHE_TTLS
+  ttls = ttls.copy()
+  if value.strip().lower() == 'on':
+    return ttls
+  for setting in value.split(','):
+    if not setting.strip():
+      continue
+    entity, sep, ttl = setting.partition('=')
+    if not sep:
+      entity, ttl = None, entity
+    else:
+      entity = entity.strip().lower()
+      if entity not in DEFAULT_CACHE_TTLS:
+        raise ValueError('not an entity=seconds setting: %s' % setting)
+    ttl = float(ttl)
+    if ttl < 0:
+      raise ValueError('time to live can\'t be negative: %s' % setting)
+    if entity is None:
+      for entity in ttls:
+        ttls[entity] = ttl
+    else:
+      ttls[entity] = ttl
+  return ttls
+
+
+class DirectoryCache(object):
+  """Keeps the pages of directory listings in an SQLite database.
+
+  The feeds table has the URI, entity and fetch time of every listing, the
+  pages table one row per page of a listing holding its entries. Only whole
+  listings are stored, so a cached listing is always complete. The database
+  can be shared by gam processes, one connection is shared by the threads of
+  a process.
+  """
+
+  def __init__(self, path, ttls=None):
+    """Opens the cache, creating the database if needed.
+
+    Args:
+      path: string The SQLite database file.
+      ttls: dict (optional) Seconds a listing of each entity is served from
+          the cache, DEFAULT_CACHE_TTLS if not given.
+    """
+    if ttls is None:
+      ttls = DEFAULT_CACHE_TTLS
+    self.path = path
+    self.ttls = ttls
+    self._lock = threading.Lock()
+    # The time every entity was last changed by this process
+    self._changed = {}
+    self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+    self._db.execute('CREATE TABLE IF NOT EXISTS feeds '
+                     '(uri TEXT PRIMARY KEY, entity TEXT, fetched REAL)')
+    self._db.execute('CREATE TABLE IF NOT EXISTS pages '
+                     '(uri TEXT, page INTEGER, entries BLOB, '
+                     'PRIMARY KEY (uri, page))')
+    self._db.execute('CREATE INDEX IF NOT EXISTS feeds_entity ON feeds (entity)')
+    self._db.commit()
+
+  def GetPages(self, uri):
+    """Returns the cached pages of a listing as lists of dicts.
+
+    Args:
+      uri: string The URI of the first page of the listing.
+
+    Returns:
+      A list of pages, None if the listing is not cached or is older than
+      the time to live of its entity.
+    """
+    ttl = self.ttls.get(GetEntity(uri))
+    if not ttl:
+      return None
+    self._lock.acquire()
+    try:
+      row = self._db.execute('SELECT fetched FROM feeds WHERE uri = ?',
+                             (uri,)).fetchone()
+      if row is None or row[0] + ttl < time.time():
+        return None
+      rows = self._db.execute('SELECT entries FROM pages WHERE uri = ? '
+                              'ORDER BY page', (uri,)).fetchall()
+    finally:
+      self._lock.release()
+    return [cPickle.loads(str(entries)) for (entries,) in rows]
+
+  def AddPages(self, uri, pages, fetched):
+    """Stores all pages of a listing, replacing those stored before.
+
+    A listing which was being fetched while this process changed its entity
+    may be stale and is not stored.
+
+    Args:
+      uri: string The URI of the first page of the listing.
+      pages: list The pages of the listing, each a list of dicts.
+      fetched: float The time fetching the listing started.
+    """
+    entity = GetEntity(uri)
+    if not self.ttls.get(entity):
+      return
+    rows = [(uri, page_number,
+             sqlite3.Binary(cPickle.dumps(page, cPickle.HIGHEST_PROTOCOL)))
+            for page_number, page in enumerate(pages)]
+    self._lock.acquire()
+    try:
+      if self._changed.get(entity, 0) >= fetched:
+        return
+      self._db.execute('DELETE FROM pages WHERE uri = ?', (uri,))
+      self._db.executemany('INSERT INTO pages VALUES (?, ?, ?)', rows)
+      self._db.execute('INSERT OR REPLACE INTO feeds VALUES (?, ?, ?)',
+                       (uri, entity, fetched))
+      self._db.commit()
+    finally:
+      self._lock.release()
+
+  def Invalidate(self, url):
+    """Drops the cached listings a change sent to url can make stale."""
+    entities = AFFECTED_ENTITIES.get(GetEntity(url), ())
+    if not entities:
+      return
+    where = 'entity IN (%s)' % ','.join('?' * len(entities))
+    self._lock.acquire()
+    try:
+      now = time.time()
+      for entity in entities:
+        self._changed[entity] = now
+      self._db.execute('DELETE FROM pages WHERE uri IN '
+                       '(SELECT uri FROM feeds WHERE %s)' % where, entities)
+      self._db.execute('DELETE FROM feeds WHERE %s' % where, entities)
+      self._db.commit()
+    finally:
+      self._lock.release()
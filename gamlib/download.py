@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+#
+# Google Apps Manager
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Downloads large files, resuming partial downloads.
+
+  Download: Streams a URL to a file. A file left behind by an earlier try is
+      continued with an HTTP Range request, and the file is checked against
+      the size the server reports.
+
+  DownloadProgress: Shows the bytes, throughput and time left of a set of
+      downloads on one status line.
+
+  DownloadFiles: Downloads several files at once, sharing a progress line.
+
+  DownloadQueue: A pool of threads downloading files as they are added, for
+      callers which learn of the files to download one by one.
+"""
+
+import httplib
+import os
+import Queue
+import re
+import socket
+import sys
+import threading
+import time
+import urllib2
+
+from gamlib import workers
+
+# Bytes read from the network and written to disk at a time
+CHUNK_SIZE = 1024 * 1024
+
+# Tries of a download which broke off, each resuming where the last stopped
+RETRIES = 5
+
+_CONTENT_RANGE = re.compile(r'bytes\s+(\*|(\d+)-(\d+))/(\d+|\*)')
+
+
+class DownloadError(Exception):
+  """A file could not be downloaded completely."""
+
+
+class DownloadProgress(object):
+  """Sums up the progress of downloads running on several threads.
+
+  The status line is redrawn at most twice a second, and only when stream is
+  a terminal.
+  """
+
+  def __init__(self, files, stream=None):
+    """Starts counting.
+
+    Args:
+      files: int The number of files to download.
+      stream: file-like (optional) Where the status line goes, sys.stdout if
+          not given.
+    """
+    if stream is None:
+      stream = sys.stdout
+    self.files = files
+    self.stream = stream
+    self.done_files = 0
+    self.total_bytes = 0
+    self.done_bytes = 0
+    self.started = time.time()
+    self._new_bytes = 0
+    self._lock = threading.Lock()
+    self._drawn = 0
+    self._show = hasattr(stream, 'isatty') and stream.isatty()
+
+  def AddTotal(self, size):
+    """Adds the size of a file to the bytes to download."""
+    self._lock.acquire()
+    try:
+      self.total_bytes += size
+    finally:
+      self._lock.release()
+
+  def AddDone(self, size, fetched=True):
+    """Counts size bytes as downloaded.
+
+    Args:
+      size: int The number of bytes.
+      fetched: boolean False for bytes of a partial file which were already
+          on disk, they don't count towards the throughput.
+    """
+    self._lock.acquire()
+    try:
+      self.done_bytes += size
+      if fetched:
+        self._new_bytes += size
+      self._Draw(False)
+    finally:
+      self._lock.release()
+
+  def FileDone(self):
+    """Counts one more file as finished."""
+    self._lock.acquire()
+    try:
+      self.done_files += 1
+      self._Draw(True)
+    finally:
+      self._lock.release()
+
+  def Finish(self):
+    """Ends the status line."""
+    if self._show:
+      self.stream.write('\n')
+      self.stream.flush()
+
+  def _Draw(self, force):
+    if not self._show:
+      return
+    now = time.time()
+    if not force and now - self._drawn < 0.5:
+      return
+    self._drawn = now
+    elapsed = max(now - self.started, 0.001)
+    rate = self._new_bytes / elapsed
+    status = '%d of %d files, %s of %s, %s/s' % (
+        self.done_files, self.files, FormatBytes(self.done_bytes),
+        FormatBytes(self.total_bytes), FormatBytes(rate))
+    if rate > 0 and self.total_bytes >= self.done_bytes:
+      left = int((self.total_bytes - self.done_bytes) / rate)
+      status += ', %d:%02d:%02d left' % (left / 3600, left / 60 % 60, left % 60)
+    self.stream.write('\r' + status.ljust(79))
+    self.stream.flush()
+
+
+def FormatBytes(size):
+  """Returns a size in bytes as a short string like "12.3 MB"."""
+  for unit in ('bytes', 'KB', 'MB', 'GB'):
+    if size < 1024:
+      if unit == 'bytes':
+        return '%d %s' % (size, unit)
+      return '%.1f %s' % (size, unit)
+    size /= 1024.0
+  return '%.1f TB' % size
+
+
+def _OpenRange(url, offset):
+  """Requests url from offset on.
+
+  Returns:
+    A (response, offset, total) tuple. response is None if there is nothing
+    left to fetch. offset is where the response's data starts, 0 if the
+    server ignored the range, total is the size of the whole file or None if
+    the server did not tell.
+  """
+  request = urllib2.Request(url)
+  if offset:
+    request.add_header('Range', 'bytes=%d-' % offset)
+  try:
+    response = urllib2.urlopen(request)
+  except urllib2.HTTPError, e:
+    if e.code != 416:
+      raise
+    # Nothing at or past offset, the file is complete if it is as big as
+    # the server's copy. A bigger file is not a part of it, fetch it again.
+    match = _CONTENT_RANGE.match(e.info().getheader('Content-Range', ''))
+    if match and match.group(4) != '*' and int(match.group(4)) == offset:
+      return None, offset, offset
+    return _OpenRange(url, 0)
+  if response.code == 206:
+    match = _CONTENT_RANGE.match(response.info().getheader('Content-Range', ''))
+    if not match or match.group(2) is None:
+      response.close()
+      raise DownloadError('bad Content-Range from %s' % url)
+    total = None
+    if match.group(4) != '*':
+      total = int(match.group(4))
+    return response, int(match.group(2)), total
+  length = response.info().getheader('Content-Length')
+  if length is not None:
+    length = int(length)
+  return response, 0, length
+
+
+def Download(url, path, progress=None, retries=RETRIES):
+  """Downloads url to path, continuing what is already in path.
+
+  Data is written to disk as it arrives, CHUNK_SIZE bytes at a time. If the
+  server doesn't support ranges the file is downloaded again from the start.
+  A download which breaks off is resumed up to retries times.
+
+  Args:
+    url: string The URL of the file.
+    path: string The file to write.
+    progress: DownloadProgress (optional) Counts the bytes downloaded.
+    retries: int How often to resume a broken download.
+
+  Returns:
+    The size of the file.
+
+  Raises:
+    DownloadError: if the file could not be downloaded completely.
+  """
+  counted = False
+  tries = 0
+  while True:
+    offset = 0
+    if os.path.isfile(path):
+      offset = os.path.getsize(path)
+    try:
+      response, start, total = _OpenRange(url, offset)
+      if progress is not None and not counted:
+        progress.AddTotal(total or 0)
+        progress.AddDone(start, fetched=False)
+        counted = True
+      if response is None:
+        return offset
+      try:
+        out = open(path, start and 'r+b' or 'wb')
+        try:
+          out.seek(start)
+          out.truncate()
+          size = start
+          while True:
+            data = response.read(CHUNK_SIZE)
+            if not data:
+              break
+            out.write(data)
+            size += len(data)
+            if progress is not None:
+              progress.AddDone(len(data))
+        finally:
+          out.close()
+      finally:
+        response.close()
+      if total is None or size == total:
+        return size
+      raise DownloadError('%s ended after %d of %d bytes' % (url, size, total))
+    except (DownloadError, urllib2.URLError, httplib.HTTPException,
+            socket.error), e:
+      if isinstance(e, urllib2.HTTPError) and e.code < 500:
+        raise DownloadError('%s: %s' % (url, e))
+      tries += 1
+      if tries > retries:
+        raise DownloadError('%s: %s' % (url, e))
+      time.sleep(2 ** tries)
+      # The bytes written so far are counted again when the download
+      # resumes from them.
+      if progress is not None and counted:
+        if os.path.isfile(path):
+          progress.AddDone(-os.path.getsize(path), fetched=False)
+        progress.AddTotal(-(total or 0))
+      counted = False
+
+
+def DownloadFiles(downloads, max_workers, stream=None):
+  """Downloads files, up to max_workers of them at once.
+
+  Args:
+    downloads: list of (url, path) tuples.
+    max_workers: int The most files to download at once.
+    stream: file-like (optional) Where the progress line goes, sys.stdout if
+        not given.
+
+  Returns:
+    A list of (path, error) tuples in the order of downloads, error is None
+    for a file which was downloaded completely.
+  """
+  progress = DownloadProgress(len(downloads), stream)
+
+  def GetFile(url, path):
+    def Call():
+      try:
+        Download(url, path, progress)
+        return path, None
+      except (DownloadError, EnvironmentError), e:
+        return path, e
+      finally:
+        progress.FileDone()
+    return Call
+
+  try:
+    return list(workers.IterConcurrently(
+        [GetFile(url, path) for url, path in downloads], max_workers))
+  finally:
+    progress.Finish()
+
+
+class DownloadQueue(object):
+  """Downloads files on a pool of threads while more are being added.
+
+  Files are added in groups, like the files of one export, and a callback
+  learns when all files of a group are done.
+  """
+
+  def __init__(self, max_workers, progress=None):
+    """Starts the threads.
+
+    Args:
+      max_workers: int The most files to download at once.
+      progress: DownloadProgress (optional) Counts the bytes downloaded.
+    """
+    self.progress = progress
+    self._tasks = Queue.Queue()
+    self._lock = threading.Lock()
+    self._pending = 0
+    self._idle = threading.Event()
+    self._idle.set()
+    self._threads = []
+    for i in range(max_workers):
+      # The threads write where the thread creating the queue writes.
+      self._threads.append(workers.StartThread(self._Run, ()))
+
+  def Add(self, downloads, callback=None):
+    """Queues a group of files.
+
+    Args:
+      downloads: list of (url, path) tuples.
+      callback: (optional) Called as callback(errors) on a download thread
+          once all files of the group are done, errors is a list of (path,
+          error) tuples of the files which failed.
+    """
+    if not downloads:
+      if callback is not None:
+        callback([])
+      return
+    group = {'left': len(downloads), 'errors': [], 'callback': callback}
+    self._lock.acquire()
+    try:
+      self._pending += len(downloads)
+      self._idle.clear()
+    finally:
+      self._lock.release()
+    for url, path in downloads:
+      self._tasks.put((url, path, group))
+
+  def Join(self):
+    """Waits until every queued file is done and stops the threads."""
+    # A timeout keeps the main thread responsive to Ctrl-C.
+    while not self._idle.isSet():
+      self._idle.wait(1)
+    for thread in self._threads:
+      self._tasks.put(None)
+
+  def _Run(self):
+    while True:
+      task = self._tasks.get()
+      if task is None:
+        return
+      url, path, group = task
+      error = None
+      try:
+        Download(url, path, self.progress)
+      except (DownloadError, EnvironmentError), e:
+        error = e
+      self._lock.acquire()
+      try:
+        if error is not None:
+          group['errors'].append((path, error))
+        group['left'] -= 1
+        finished = group['left'] == 0
+      finally:
+        self._lock.release()
+      try:
+        if finished and group['callback'] is not None:
+          group['callback'](group['errors'])
+      finally:
+        self._lock.acquire()
+        try:
+          self._pending -= 1
+          if self._pending == 0:
+            self._idle.set()
+        finally:
+          self._lock.release()
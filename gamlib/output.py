@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+#
+# Google Apps Manager
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Writes the rows of gam's print commands.
+
+  RowWriter: Writes rows with a fixed list of columns one at a time as CSV,
+      TSV or JSON Lines, to stdout or to a file which can be gzipped.
+"""
+
+import csv
+import gzip
+import os
+import sys
+
+try:
+  import json
+except ImportError:
+  # Python 2.5, the jsonl format is not available
+  json = None
+
+try:
+  from collections import OrderedDict
+except ImportError:
+  OrderedDict = None
+
+FORMATS = ('csv', 'tsv', 'jsonl')
+
+# The line endings of csv and tsv rows. Files are written in binary mode and
+# get the line ending of the system. The console is in text mode, which on
+# Windows turns \n into \r\n by itself.
+if os.name == 'nt':
+  FILE_LINETERMINATOR = '\r\n'
+else:
+  FILE_LINETERMINATOR = '\n'
+CONSOLE_LINETERMINATOR = '\n'
+
+
+def _Cell(value):
+  """Returns value as a string the csv module can write, dicts and lists as
+  JSON."""
+  if value is None:
+    return ''
+  if isinstance(value, (dict, list)) and json is not None:
+    return json.dumps(value)
+  if isinstance(value, unicode):
+    return value.encode('utf-8')
+  return str(value)
+
+
+class RowWriter(object):
+  """Writes rows as they are produced, so nothing is kept in memory.
+
+  Every row has the columns of titles in that order. The csv and tsv
+  formats start with a row of the titles, jsonl writes one JSON object per
+  row with the titles as keys.
+  """
+
+  def __init__(self, titles, format='csv', path=None, compress=False):
+    """Opens the output and writes the header row.
+
+    Args:
+      titles: list The names of the columns, in order.
+      format: string One of FORMATS.
+      path: string (optional) The file to write, stdout if None.
+      compress: boolean Whether to gzip the file, it is also gzipped if path
+          ends with .gz.
+
+    Raises:
+      ValueError: if format is not one of FORMATS, or is jsonl and there is
+          no json module, which came with Python 2.6.
+      IOError: if the file can't be opened.
+    """
+    if format not in FORMATS:
+      raise ValueError('unknown format %s' % format)
+    if format == 'jsonl' and json is None:
+      raise ValueError('the jsonl format requires Python 2.6 or 2.7')
+    self.titles = list(titles)
+    self.format = format
+    lineterminator = FILE_LINETERMINATOR
+    if path is None:
+      self._out = sys.stdout
+      self._close = False
+      lineterminator = CONSOLE_LINETERMINATOR
+    elif compress or path.endswith('.gz'):
+      self._out = gzip.open(path, 'wb')
+      self._close = True
+    else:
+      self._out = open(path, 'wb')
+      self._close = True
+    self._writer = None
+    if format == 'csv':
+      self._writer = csv.writer(self._out, lineterminator=lineterminator,
+                                quoting=csv.QUOTE_MINIMAL)
+    elif format == 'tsv':
+      self._writer = csv.writer(self._out, delimiter='\t',
+                                lineterminator=lineterminator,
+                                quoting=csv.QUOTE_MINIMAL)
+    if self._writer is not None:
+      self._writer.writerow([_Cell(title) for title in self.titles])
+
+  def WriteRow(self, row):
+    """Writes one row.
+
+    Args:
+      row: dict The values of the row by title, missing titles are left
+          empty, or a list of the values in the order of titles. Values
+          which are dicts or lists are nested in jsonl and written as JSON
+          in csv and tsv.
+    """
+    if isinstance(row, dict):
+      values = [row.get(title) for title in self.titles]
+    else:
+      values = row
+    if self._writer is not None:
+      self._writer.writerow([_Cell(value) for value in values])
+      return
+    if OrderedDict is not None:
+      record = OrderedDict(zip(self.titles, values))
+    else:
+      record = dict(zip(self.titles, values))
+    self._out.write(json.dumps(record) + '\n')
+
+  def Close(self):
+    """Flushes the output and closes it if it is a file."""
+    if self._close:
+      self._out.close()
+    else:
+      self._out.flush()
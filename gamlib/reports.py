@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+#
+# Google Apps Manager
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Keeps downloaded reports and merges the reports of several days.
+
+  ReportCache: Stores the report of a day in a gzipped file named after the
+      hash of its domain, report name and date. A past day's report never
+      changes, so a stored one is used instead of downloading it again.
+
+  MergeReports: Writes the reports of several days as one CSV stream with a
+      date column.
+"""
+
+import csv
+import datetime
+import gzip
+import os
+import tempfile
+import time
+from hashlib import sha1
+
+
+def ParseDate(value):
+  """Returns the datetime.date of a YYYY-MM-DD string.
+
+  Raises:
+    ValueError: if value is not a YYYY-MM-DD date.
+  """
+  return datetime.date(*time.strptime(value, '%Y-%m-%d')[:3])
+
+
+def LatestReportDate(now=None):
+  """Returns the YYYY-MM-DD day of the newest report which is available.
+
+  The report of a day is generated at noon PST (20:00 UTC), before that the
+  newest report is the one of the day before, see
+  gdata.apps.reporting.service.ReportService.retrieve_report_pages.
+
+  Args:
+    now: float (optional) The time to check at, the current time if None.
+  """
+  if now is None:
+    now = time.time()
+  report_time = time.gmtime(now)
+  if report_time.tm_hour < 20:
+    report_time = time.gmtime(now - 60*60*24)
+  return time.strftime('%Y-%m-%d', report_time)
+
+
+def DateRange(start, end):
+  """Returns the YYYY-MM-DD strings of the days from start to end inclusive."""
+  days = []
+  day = start
+  while day <= end:
+    days.append(day.strftime('%Y-%m-%d'))
+    day += datetime.timedelta(days=1)
+  return days
+
+
+class ReportCache(object):
+  """Stores reports in a directory, one gzipped file per day."""
+
+  def __init__(self, directory):
+    """Creates the cache, making the directory if needed.
+
+    Args:
+      directory: string The directory the reports are stored in.
+    """
+    self.directory = directory
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+  def GetPath(self, domain, report, date):
+    """Returns the path of the file a report is stored in."""
+    key = '%s\n%s\n%s' % (domain.lower(), report.lower(), date)
+    return os.path.join(self.directory, sha1(key).hexdigest() + '.csv.gz')
+
+  def Has(self, domain, report, date):
+    """Returns True if the report of the day is stored."""
+    return os.path.isfile(self.GetPath(domain, report, date))
+
+  def Store(self, domain, report, date, pages, keep=True):
+    """Writes the pages of a report to a file.
+
+    The pages go to a temporary file first, so a failed download never
+    leaves a partial report behind. A report without rows below its header
+    is never stored, it may just not have been generated yet.
+
+    Args:
+      domain: string The domain of the report.
+      report: string The name of the report.
+      date: string The YYYY-MM-DD day of the report.
+      pages: iterable The pages of the report as strings.
+      keep: boolean Whether to store the report in the cache. If False the
+          report is left in a temporary file the caller removes.
+
+    Returns:
+      A (path, stored) tuple, the path of the file holding the report and
+      whether it is stored in the cache. If not, it is a temporary file the
+      caller removes.
+    """
+    handle, temp_path = tempfile.mkstemp(suffix='.csv.gz', dir=self.directory)
+    os.close(handle)
+    try:
+      lines = 0
+      last = '\n'
+      out = gzip.open(temp_path, 'wb')
+      try:
+        for page in pages:
+          if page:
+            out.write(page)
+            lines += page.count('\n')
+            last = page[-1]
+      finally:
+        out.close()
+      if last != '\n':
+        lines += 1
+      # the first line is the header
+      if not keep or lines < 2:
+        return temp_path, False
+      path = self.GetPath(domain, report, date)
+      if os.name == 'nt' and os.path.exists(path):
+        os.remove(path)
+      os.rename(temp_path, path)
+      return path, True
+    except:
+      if os.path.exists(temp_path):
+        os.remove(temp_path)
+      raise
+
+
+def MergeReports(dated_paths, out):
+  """Writes the reports of several days as one CSV stream.
+
+  Every row gets the day of its report as a first date column. The columns
+  follow the header of the first report, columns later reports add are left
+  out and columns they lack are left empty.
+
+  Args:
+    dated_paths: list of (date, path) tuples of gzipped reports, in the
+        order to write them.
+    out: file-like The stream to write the CSV to.
+  """
+  writer = csv.writer(out, lineterminator='\n')
+  titles = None
+  for date, path in dated_paths:
+    report_file = gzip.open(path, 'rb')
+    try:
+      reader = csv.reader(report_file)
+      try:
+        header = reader.next()
+      except StopIteration:
+        continue
+      if titles is None:
+        titles = header
+        writer.writerow(['date'] + titles)
+      if header == titles:
+        for row in reader:
+          writer.writerow([date] + row)
+      else:
+        columns = dict((title, i) for i, title in enumerate(header))
+        for row in reader:
+          writer.writerow([date] + [
+              (row[columns[title]] if title in columns and columns[title] < len(row) else '')
+              for title in titles])
+    finally:
+      report_file.close()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+#
+# Google Apps Manager
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Runs gam commands sent over a local UNIX socket.
+
+  CommandServer: Accepts connections on a UNIX socket, each sending one gam
+      command, and streams the command's stdout, stderr and exit status back.
+
+  RunRemoteCommand: Sends a command to a CommandServer and copies what comes
+      back to local streams, used by gamclient.py.
+
+A client sends its arguments as a JSON list on one line. The server answers
+with frames of one type byte, a 4 byte big-endian length and the data: 'o'
+for stdout, 'e' for stderr and a final 'x' holding the exit status.
+"""
+
+import os
+import socket
+import SocketServer
+import struct
+import threading
+
+try:
+  import json
+except ImportError:
+  # Python 2.5, commands can't be served
+  json = None
+
+STDOUT = 'o'
+STDERR = 'e'
+EXIT = 'x'
+
+_HEADER = struct.Struct('!cI')
+
+
+def WriteFrame(stream, kind, data):
+  """Writes one frame of data to a file-like stream and flushes it."""
+  stream.write(_HEADER.pack(kind, len(data)) + data)
+  stream.flush()
+
+
+def ReadFrame(stream):
+  """Reads one frame from a file-like stream.
+
+  Returns:
+    A (kind, data) tuple, None if the stream ended.
+  """
+  header = stream.read(_HEADER.size)
+  if len(header) < _HEADER.size:
+    return None
+  kind, length = _HEADER.unpack(header)
+  data = stream.read(length)
+  if len(data) < length:
+    return None
+  return kind, data
+
+
+class _FrameStream(object):
+  """A file-like object sending everything written to it as frames.
+
+  The threads of a command may write at once, lock keeps their frames
+  whole. It is shared by all _FrameStreams writing to the same stream.
+  """
+
+  def __init__(self, stream, kind, lock):
+    self.stream = stream
+    self.kind = kind
+    self.lock = lock
+
+  def write(self, data):
+    if isinstance(data, unicode):
+      data = data.encode('utf-8')
+    if data:
+      self.lock.acquire()
+      try:
+        WriteFrame(self.stream, self.kind, data)
+      finally:
+        self.lock.release()
+
+  def writelines(self, lines):
+    for line in lines:
+      self.write(line)
+
+  def flush(self):
+    pass
+
+
+class _CommandHandler(SocketServer.StreamRequestHandler):
+
+  def handle(self):
+    try:
+      argv = json.loads(self.rfile.readline())
+    except ValueError:
+      return
+    argv = [arg.encode('utf-8') for arg in argv]
+    lock = threading.Lock()
+    stdout = _FrameStream(self.wfile, STDOUT, lock)
+    stderr = _FrameStream(self.wfile, STDERR, lock)
+    try:
+      status = self.server.run_command(argv, stdout, stderr)
+      WriteFrame(self.wfile, EXIT, str(status))
+    except socket.error:
+      # The client went away, the command's output has nowhere to go.
+      pass
+
+
+class CommandServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+  """Runs every command it receives on its own thread.
+
+  Only the user running the server can connect, the socket is made
+  accessible to its owner alone.
+  """
+
+  daemon_threads = True
+
+  def __init__(self, path, run_command):
+    """Listens on a UNIX socket.
+
+    Args:
+      path: string The path of the socket. A socket left behind by a server
+          which is no longer running is replaced.
+      run_command: The function running a command, called as
+          run_command(argv, stdout, stderr) with the command's arguments
+          (without the program name) and file-like objects for its output.
+          It returns the exit status.
+
+    Raises:
+      ImportError: if there is no json module, which came with Python 2.6.
+      socket.error: if the socket can't be created or another server is
+          listening on it.
+    """
+    if json is None:
+      raise ImportError('serving commands requires Python 2.6 or 2.7')
+    if os.path.exists(path):
+      probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      try:
+        try:
+          probe.connect(path)
+        except socket.error:
+          os.remove(path)
+        else:
+          raise socket.error('a server is already listening on %s' % path)
+      finally:
+        probe.close()
+    self.path = path
+    self.run_command = run_command
+    old_umask = os.umask(0177)
+    try:
+      SocketServer.UnixStreamServer.__init__(self, path, _CommandHandler)
+    finally:
+      os.umask(old_umask)
+
+  def server_close(self):
+    SocketServer.UnixStreamServer.server_close(self)
+    try:
+      os.remove(self.path)
+    except OSError:
+      pass
+
+
+def RunRemoteCommand(path, argv, stdout, stderr):
+  """Runs a command on the CommandServer listening on path.
+
+  Args:
+    path: string The path of the server's socket.
+    argv: list The command's arguments, without the program name.
+    stdout: file-like The stream the command's stdout is copied to.
+    stderr: file-like The stream the command's stderr is copied to.
+
+  Returns:
+    The exit status of the command, 1 if the connection broke before it
+    finished.
+
+  Raises:
+    ImportError: if there is no json module, which came with Python 2.6.
+    socket.error: if no server is listening on path.
+  """
+  if json is None:
+    raise ImportError('running served commands requires Python 2.6 or 2.7')
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  sock.connect(path)
+  try:
+    stream = sock.makefile('rwb', 0)
+    stream.write(json.dumps([arg.decode('utf-8') for arg in argv]) + '\n')
+    streams = {STDOUT: stdout, STDERR: stderr}
+    while True:
+      frame = ReadFrame(stream)
+      if frame is None:
+        return 1
+      kind, data = frame
+      if kind == EXIT:
+        return int(data)
+      streams[kind].write(data)
+      streams[kind].flush()
+  finally:
+    sock.close()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+#
+# Google Apps Manager
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Controls how hard gam pushes the Google Apps APIs.
+
+  AIMDLimiter: Limits the number of requests in flight, adapting the limit
+      to the responses with additive increase, multiplicative decrease.
+      Install it as the concurrency_limiter of the
+      gdata.service.GDataService objects doing one job.
+
+  RateLimiter: Limits the number of requests per second sent to each API
+      with a token bucket per API. Install it as
+      gdata.service.GDataService.rate_limiter.
+"""
+
+import threading
+import time
+
+# Response statuses which mean the servers are overloaded or we are over
+# quota, 429 is sent by some of the newer APIs.
+OVERLOAD_STATUSES = (429, 500, 503)
+# Lower case text in the body of a 403 response which means we are over
+# quota rather than not allowed to do something. The reason phrase of such
+# a response is just "Forbidden".
+OVERLOAD_REASONS = ('quotaexceeded', 'ratelimitexceeded', 'quota exceeded',
+                    'rate limit exceeded')
+
+
+def IsOverloaded(status, body=None):
+  """Returns True if a response says to slow down.
+
+  Args:
+    status: int The HTTP status of the response.
+    body: string (optional) The body of the response.
+  """
+  if status in OVERLOAD_STATUSES:
+    return True
+  if status == 403 and body:
+    body = body.lower()
+    for overload_reason in OVERLOAD_REASONS:
+      if body.find(overload_reason) != -1:
+        return True
+  return False
+
+
+class AIMDLimiter(object):
+  """Limits requests in flight with additive increase/multiplicative decrease.
+
+  The limit grows by one for every limit successful responses, so roughly
+  by one per round of requests, and halves when a response says the servers
+  are overloaded or we are over quota. Overload responses to requests which
+  were sent before the last decrease don't decrease it again, as they tell
+  about the old limit.
+  """
+
+  def __init__(self, initial=4, maximum=100, minimum=1):
+    """Creates an AIMDLimiter.
+
+    Args:
+      initial: int The limit to start with.
+      maximum: int The limit never grows beyond this.
+      minimum: int The limit never shrinks below this.
+    """
+    self.minimum = max(1, minimum)
+    self.maximum = max(self.minimum, maximum)
+    self.limit = float(min(max(initial, self.minimum), self.maximum))
+    self.in_flight = 0
+    self.peak = int(self.limit)
+    self.decreases = 0
+    self._generation = 0
+    self._condition = threading.Condition()
+
+  def acquire(self):
+    """Waits until another request may be sent.
+
+    Returns:
+      A ticket to pass to release() once the request is done.
+    """
+    self._condition.acquire()
+    try:
+      while self.in_flight >= int(self.limit):
+        self._condition.wait()
+      self.in_flight += 1
+      return self._generation
+    finally:
+      self._condition.release()
+
+  def release(self, ticket, status, body=None):
+    """Records the outcome of a request allowed by acquire().
+
+    Args:
+      ticket: The value acquire() returned for this request.
+      status: int The HTTP status of the response, None if there was none.
+      body: string (optional) The body of an error response.
+    """
+    self._condition.acquire()
+    try:
+      self.in_flight -= 1
+      if IsOverloaded(status, body):
+        if ticket == self._generation:
+          self.limit = max(float(self.minimum), self.limit / 2)
+          self.decreases += 1
+          self._generation += 1
+      elif status is not None and status < 500:
+        self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+        self.peak = max(self.peak, int(self.limit))
+      self._condition.notifyAll()
+    finally:
+      self._condition.release()
+
+  def GetLimit(self):
+    """Returns the current limit on requests in flight."""
+    return int(self.limit)
+
+
+# Substrings of request URLs identifying the API they go to, the first match
+# wins. Requests to other APIs are not rate limited.
+API_URL_PATTERNS = (
+    ('emailsettings', '/feeds/emailsettings/'),
+    ('audit', '/feeds/compliance/audit/'),
+    ('calendar', '/calendar/feeds/'),
+    ('contacts', '/m8/feeds/'),
+    ('provisioning', '/a/feeds/'),
+    )
+
+# Requests per second for each API when GAM_RATE_LIMITS turns rate limiting
+# on, it can also override them.
+DEFAULT_RATE_LIMITS = {
+    'provisioning': 10,
+    'emailsettings': 10,
+    'audit': 5,
+    'calendar': 10,
+    'contacts': 10,
+    }
+
+
+def GetApi(url):
+  """Returns the name of the API a URL belongs to, None if it is unknown."""
+  url = str(url)
+  for api, pattern in API_URL_PATTERNS:
+    if url.find(pattern) != -1:
+      return api
+  return None
+
+
+def ParseRateLimits(value, rates=None):
+  """Parses a rate limit setting like "emailsettings=5,calendar=20".
+
+  Args:
+    value: string Comma separated api=rate pairs, the rate being requests
+        per second. A rate of 0 turns the limit for that API off, "on" keeps
+        the limits of rates.
+    rates: dict (optional) The limits to update, DEFAULT_RATE_LIMITS if
+        not given.
+
+  Returns:
+    A dict with the rate of every API.
+
+  Raises:
+    ValueError: if value is not valid.
+  """
+  if rates is None:
+    rates = DEFAULT_RATE_LIMITS
+  rates = rates.copy()
+  for setting in value.split(','):
+    if not setting.strip() or setting.strip().lower() == 'on':
+      continue
+    api, sep, rate = setting.partition('=')
+    api = api.strip().lower()
+    if not sep or api not in DEFAULT_RATE_LIMITS:
+      raise ValueError('not an api=rate setting: %s' % setting)
+    rate = float(rate)
+    if rate < 0:
+      raise ValueError('rate for %s can\'t be negative' % api)
+    rates[api] = rate
+  return rates
+
+
+class TokenBucket(object):
+  """Allows rate requests per second on average, bursts of up to burst."""
+
+  def __init__(self, rate, burst=None):
+    """Creates a TokenBucket.
+
+    Args:
+      rate: float The number of tokens added per second.
+      burst: float (optional) The most tokens the bucket holds, the same as
+          rate (but at least 1) by default.
+    """
+    self.rate = float(rate)
+    if burst is None:
+      burst = max(1.0, self.rate)
+    self.burst = float(burst)
+    self.tokens = self.burst
+    self._updated = time.time()
+    self._lock = threading.Lock()
+
+  def Take(self):
+    """Takes a token, sleeping until one is available.
+
+    Callers which have to wait reserve their token before sleeping, so
+    waiting threads are served in turn.
+    """
+    self._lock.acquire()
+    try:
+      now = time.time()
+      self.tokens = min(self.burst,
+                        self.tokens + (now - self._updated) * self.rate)
+      self._updated = now
+      self.tokens -= 1
+      wait = -self.tokens / self.rate
+    finally:
+      self._lock.release()
+    if wait > 0:
+      time.sleep(wait)
+
+
+class RateLimiter(object):
+  """Keeps requests to each API under its rate with a TokenBucket per API."""
+
+  def __init__(self, rates=None):
+    """Creates a RateLimiter.
+
+    Args:
+      rates: dict (optional) Requests per second for each API name in
+          API_URL_PATTERNS, DEFAULT_RATE_LIMITS if not given. APIs with a
+          rate of 0 are not limited.
+    """
+    if rates is None:
+      rates = DEFAULT_RATE_LIMITS
+    self.buckets = {}
+    for api, rate in rates.items():
+      if rate > 0:
+        self.buckets[api] = TokenBucket(rate)
+
+  def Wait(self, url):
+    """Sleeps until a request to url may be sent."""
+    bucket = self.buckets.get(GetApi(url))
+    if bucket is not None:
+      bucket.Take()
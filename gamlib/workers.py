@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+#
+# Google Apps Manager
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Runs gam tasks on a bounded pool of worker threads.
+
+  ThreadedOutput: A file-like object which sends whatever a thread writes to
+      a capture buffer registered for that thread, or to the real stream if
+      there is none. Threads started here write to the capture buffer of the
+      thread which started them. It is installed as sys.stdout and sys.stderr while tasks
+      run, so that the output of concurrent tasks never interleaves.
+
+  RunTasks: Calls a function for every item of a list on a pool of threads
+      and replays the output of each call in the order of the items.
+
+  CallConcurrently: Calls a few independent functions at once and returns
+      their results in order.
+
+  IterConcurrently: Like CallConcurrently, but hands out each result as soon
+      as it and the results before it are ready.
+
+  ThreadedArgv: A list-like object giving every thread its own arguments,
+      installed as sys.argv to run several gam commands at once.
+
+  context: Per-thread settings of the job a thread works for. The threads
+      started here begin with a copy of the settings of the thread starting
+      them, so work handed to them keeps its job's settings.
+
+  StartThread: Starts a thread which begins with the context of the thread
+      starting it, for other modules running work of the current job.
+
+  AddThreadCleanup: Registers a function the threads started here call when
+      they end, to give back what they held on to.
+"""
+
+import sys
+import threading
+import traceback
+import Queue
+
+context = threading.local()
+
+_thread_cleanups = []
+
+
+def AddThreadCleanup(func):
+  """Makes every thread started by this module call func() when it ends."""
+  _thread_cleanups.append(func)
+
+
+def StartThread(target, args):
+  """Starts a daemon thread calling target(*args) with the caller's context."""
+  settings = context.__dict__.copy()
+
+  def Run():
+    context.__dict__.update(settings)
+    try:
+      target(*args)
+    finally:
+      for cleanup in _thread_cleanups:
+        cleanup()
+
+  thread = threading.Thread(target=Run)
+  thread.setDaemon(True)
+  thread.start()
+  return thread
+
+
+class ThreadedOutput(object):
+  """Sends writes to a per-thread capture buffer when one is set."""
+
+  def __init__(self, stream):
+    self.stream = stream
+
+  def capture(self, buffer):
+    """Sends the current thread's writes to buffer (None to stop).
+
+    The capture is kept in the context, so the threads the current thread
+    starts with StartThread write to buffer too.
+    """
+    # Threads share the dict they copied from their parent's context, so it
+    # is replaced rather than changed.
+    captures = dict(getattr(context, 'captures', {}))
+    captures[self] = buffer
+    context.captures = captures
+
+  def _Buffer(self):
+    return getattr(context, 'captures', {}).get(self)
+
+  def write(self, data):
+    buffer = self._Buffer()
+    if buffer is None:
+      self.stream.write(data)
+    else:
+      buffer.write(data)
+
+  def writelines(self, lines):
+    for line in lines:
+      self.write(line)
+
+  def flush(self):
+    if self._Buffer() is None:
+      self.stream.flush()
+
+  def isatty(self):
+    buffer = self._Buffer()
+    if buffer is None:
+      return self.stream.isatty()
+    return hasattr(buffer, 'isatty') and buffer.isatty()
+
+  def __getattr__(self, name):
+    return getattr(self.stream, name)
+
+
+class ThreadedArgv(object):
+  """Acts as the argument list set for the current thread.
+
+  Threads which did not set() one see the default list, threads started by
+  this module see the list of the thread which started them. Reads and
+  changes like sys.argv[i], len(sys.argv) and del sys.argv[1:3] go to the
+  current thread's list.
+  """
+
+  def __init__(self, default):
+    self.default = list(default)
+
+  def set(self, argv):
+    """Makes argv the current thread's argument list."""
+    context.argv = list(argv)
+
+  def _Argv(self):
+    return getattr(context, 'argv', self.default)
+
+  def __getitem__(self, index):
+    return self._Argv()[index]
+
+  def __setitem__(self, index, value):
+    self._Argv()[index] = value
+
+  def __delitem__(self, index):
+    del self._Argv()[index]
+
+  def __len__(self):
+    return len(self._Argv())
+
+  def __iter__(self):
+    return iter(self._Argv())
+
+  def __contains__(self, value):
+    return value in self._Argv()
+
+  def __add__(self, other):
+    return self._Argv() + list(other)
+
+  def __repr__(self):
+    return repr(self._Argv())
+
+  def __getattr__(self, name):
+    return getattr(self._Argv(), name)
+
+
+class _TaskOutput(object):
+  """Records the output of one task, keeping stdout and stderr in order."""
+
+  def __init__(self):
+    self.chunks = []
+
+  def stream(self, name):
+    return _TaskStream(self.chunks, name)
+
+
+class _TaskStream(object):
+
+  def __init__(self, chunks, name):
+    self.chunks = chunks
+    self.name = name
+
+  def write(self, data):
+    self.chunks.append((self.name, data))
+
+
+def InstallThreadedOutput():
+  """Makes sys.stdout and sys.stderr ThreadedOutput objects.
+
+  Returns:
+    A (stdout, stderr) tuple of the ThreadedOutput objects.
+  """
+  if not isinstance(sys.stdout, ThreadedOutput):
+    sys.stdout = ThreadedOutput(sys.stdout)
+  if not isinstance(sys.stderr, ThreadedOutput):
+    sys.stderr = ThreadedOutput(sys.stderr)
+  return sys.stdout, sys.stderr
+
+
+def _Worker(func, items, tasks, results):
+  stdout, stderr = sys.stdout, sys.stderr
+  count = len(items)
+  while True:
+    index = tasks.get()
+    if index is None:
+      return
+    output = _TaskOutput()
+    stdout.capture(output.stream('stdout'))
+    stderr.capture(output.stream('stderr'))
+    failed = False
+    try:
+      try:
+        func(items[index], index + 1, count)
+      except SystemExit, e:
+        # gam reports errors with sys.exit(), only a clean exit is a success.
+        failed = e.code not in (None, 0)
+      except Exception, e:
+        failed = True
+        sys.stderr.write(traceback.format_exc())
+    finally:
+      stdout.capture(None)
+      stderr.capture(None)
+    results.put((index, output, failed))
+
+
+def RunTasks(func, items, workers):
+  """Calls func(item, i, count) for every item, on up to workers threads.
+
+  i counts from 1 like gam's "(i of count)" progress messages. Everything a
+  call prints is held back and written out in the order of items, so the
+  output reads as it would for a serial run. A call fails if it raises an
+  exception or exits with a non-zero status; the remaining items still run.
+
+  Args:
+    func: The function to call for every item.
+    items: list of the items to process.
+    workers: int The number of threads to use.
+
+  Returns:
+    The number of calls which failed.
+  """
+  stdout, stderr = InstallThreadedOutput()
+  # The output is replayed through the ThreadedOutput objects, so it goes
+  # wherever the calling thread's own output is captured to.
+  streams = {'stdout': stdout, 'stderr': stderr}
+  count = len(items)
+  tasks = Queue.Queue()
+  results = Queue.Queue()
+  threads = []
+  for i in range(min(workers, count)):
+    threads.append(StartThread(_Worker, (func, items, tasks, results)))
+  # Only queue a few tasks ahead of the output so that a slow item doesn't
+  # make the held back output of all later items pile up in memory.
+  window = len(threads) * 4
+  finished = {}
+  next_task = next_output = failures = 0
+  try:
+    while next_output < count:
+      while next_task < count and next_task - next_output < window:
+        tasks.put(next_task)
+        next_task += 1
+      # A timeout keeps the main thread responsive to Ctrl-C.
+      try:
+        index, output, failed = results.get(True, 1)
+      except Queue.Empty:
+        continue
+      finished[index] = (output, failed)
+      while next_output in finished:
+        output, failed = finished.pop(next_output)
+        for name, data in output.chunks:
+          streams[name].write(data)
+        if failed:
+          failures += 1
+        next_output += 1
+  finally:
+    for thread in threads:
+      tasks.put(None)
+  stdout.flush()
+  return failures
+
+
+def _CallWorker(calls, indexes, results, errors):
+  while True:
+    try:
+      index = indexes.get_nowait()
+    except Queue.Empty:
+      return
+    try:
+      results[index] = calls[index]()
+    except:
+      errors[index] = sys.exc_info()
+
+
+def CallConcurrently(calls, workers=None):
+  """Calls every function in calls, up to workers of them at once.
+
+  The functions are called without arguments. What they print goes where
+  the caller's output goes, but lines of different functions may come in
+  any order. Anything they share, like gam's service objects, has to be
+  safe to use from several threads.
+
+  Args:
+    calls: list of the functions to call.
+    workers: int (optional) The most threads to use, one per call if None.
+
+  Returns:
+    A list of the values the functions returned, in the order of calls.
+
+  Raises:
+    The exception raised by the first function in calls which raised one,
+    once all functions are done.
+  """
+  count = len(calls)
+  if workers is None or workers > count:
+    workers = count
+  results = [None] * count
+  errors = [None] * count
+  indexes = Queue.Queue()
+  for index in range(count):
+    indexes.put(index)
+  threads = []
+  for i in range(workers):
+    threads.append(StartThread(_CallWorker,
+                               (calls, indexes, results, errors)))
+  for thread in threads:
+    # A timeout keeps the main thread responsive to Ctrl-C.
+    while thread.isAlive():
+      thread.join(1)
+  for error in errors:
+    if error is not None:
+      raise error[0], error[1], error[2]
+  return results
+
+
+def _IterWorker(calls, indexes, results, errors, done):
+  while True:
+    try:
+      index = indexes.get_nowait()
+    except Queue.Empty:
+      return
+    try:
+      results[index] = calls[index]()
+    except:
+      errors[index] = sys.exc_info()
+    done[index].set()
+
+
+def IterConcurrently(calls, workers=None):
+  """Calls every function in calls, up to workers of them at once.
+
+  The same as CallConcurrently, except that the results are yielded in the
+  order of calls as soon as they are ready, so the caller can work on the
+  first results while later calls still run. Results are dropped once they
+  have been yielded.
+
+  Args:
+    calls: list of the functions to call.
+    workers: int (optional) The most threads to use, one per call if None.
+
+  Returns:
+    A generator yielding the values the functions returned, in the order of
+    calls.
+
+  Raises:
+    The exception raised by a function, when its result is next in order.
+  """
+  count = len(calls)
+  if workers is None or workers > count:
+    workers = count
+  results = [None] * count
+  errors = [None] * count
+  done = [threading.Event() for index in range(count)]
+  indexes = Queue.Queue()
+  for index in range(count):
+    indexes.put(index)
+  for i in range(workers):
+    StartThread(_IterWorker, (calls, indexes, results, errors, done))
+  for index in range(count):
+    # A timeout keeps the main thread responsive to Ctrl-C.
+    while not done[index].isSet():
+      done[index].wait(1)
+    error = errors[index]
+    if error is not None:
+      raise error[0], error[1], error[2]
+    result = results[index]
+    results[index] = None
+    yield result
@@ -26,6 +26,7 @@ import gdata.apps
 import gdata.apps.service
 import gdata.service
 import json
+import urllib
 
 
 class AdminAuditService(gdata.apps.service.PropertyService):
@@ -54,35 +55,62 @@ class AdminAuditService(gdata.apps.service.PropertyService):
     self.port = 443
     self.domain = domain
 
-  def retrieve_audit(self, customer_id, admin=None, event=None, start_date=None, end_date=None):
-    """Retrieves an audit
-
-    """
+  def _audit_uri(self, customer_id, admin=None, event=None, start_date=None,
+                 end_date=None, continuation_token=None):
     uri = '/apps/reporting/audit/v1/%s/207535951991' % customer_id
-    amp = False
+    params = []
     if admin != None:
-      uri += '?actorEmail=%s' % admin
-      amp = True
+      params.append(('actorEmail', admin))
     if event != None:
-      if not amp:
-        uri += '&eventName=%s' % event
-        amp = True
-      else:
-        uri += '?eventName=%s' % event
+      params.append(('eventName', event))
     if start_date != None:
-      if not amp:
-        uri += '&startTime=%s' % start_date
-        amp = True
-      else:
-        uri += '?startTime=%s' % start_date
+      params.append(('startTime', start_date))
     if end_date != None:
-      if not amp:
-        uri += '&endTime=%s' % end_date
-      else:
-        uri += '?endTime=%s' % end_date
-        
+      params.append(('endTime', end_date))
+    if continuation_token != None:
+      params.append(('continuationToken', continuation_token))
+    if params:
+      uri += '?' + urllib.urlencode(params)
+    return uri
+
+  def retrieve_audit(self, customer_id, admin=None, event=None, start_date=None, end_date=None):
+    """Retrieves an audit
+
+    Returns:
+      String, the JSON of the first page of admin activities
+    """
+    uri = self._audit_uri(customer_id, admin=admin, event=event,
+                          start_date=start_date, end_date=end_date)
     json_data = self.Get(uri, converter=str)
     #return json.loads(json_data)
     return json_data
 
-  RetrieveAudit = retrieve_audit
\ No newline at end of file
+  def retrieve_audit_pages(self, customer_id, admin=None, event=None, start_date=None, end_date=None):
+    """Retrieves an audit one page at a time, following continuation tokens
+
+    Args:
+      customer_id: string, the customer ID of the Google Apps account
+      admin: string, only the activities of this admin's email address
+      event: string, only activities with this event name
+      start_date: string, RFC 3339 time of the earliest activity
+      end_date: string, RFC 3339 time of the latest activity
+
+    Returns:
+      A generator yielding the list of activity dicts of each page
+    """
+    uri = self._audit_uri(customer_id, admin=admin, event=event,
+                          start_date=start_date, end_date=end_date)
+    while uri is not None:
+      audit_page = json.loads(self.Get(uri, converter=str))
+      yield audit_page.get('items', [])
+      if audit_page.get('next'):
+        uri = audit_page['next']
+      elif audit_page.get('continuationToken'):
+        uri = self._audit_uri(customer_id, admin=admin, event=event,
+                              start_date=start_date, end_date=end_date,
+                              continuation_token=audit_page['continuationToken'])
+      else:
+        uri = None
+
+  RetrieveAudit = retrieve_audit
+  RetrieveAuditPages = retrieve_audit_pages
@@ -180,6 +180,56 @@ class GroupsService(gdata.apps.service.PropertyService):
     property_feed = self._GetPropertyFeed(uri)
     return property_feed
 
+  def GetGeneratorForAllGroups(self, noUserManagedGroups=False):
+    """Retrieve all groups in the domain, one page at a time.
+
+    Args:
+      noUserManagedGroups: A boolean; should groups created by users be
+        left out of the listing?
+
+    Returns:
+      A generator yielding a list of group dicts for each page of groups.
+    """
+    uri = self._ServiceUrl('group', True, '', '', '')
+    if noUserManagedGroups:
+      uri = uri + '?skipUserCreatedGroups=True'
+    return self._GetPropertiesPages(uri)
+
+  def RetrieveRangeOfGroups(self, start_group=None, stop_group=None,
+                            noUserManagedGroups=False):
+    """Retrieve the groups whose IDs fall in a range.
+
+    Args:
+      start_group: The first group ID of the range, None to start at the
+        first group of the domain.
+      stop_group: The range ends before this group ID, None to end at the
+        last group of the domain.
+      noUserManagedGroups: A boolean; should groups created by users be
+        left out of the listing?
+
+    Returns:
+      A list of group dicts in the order of the group feed.
+    """
+    uri = self._ServiceUrl('group', True, '', '', '')
+    params = []
+    if noUserManagedGroups:
+      params.append('skipUserCreatedGroups=True')
+    if start_group is not None:
+      params.append('start=' + urllib.quote(start_group))
+    if params:
+      uri += '?' + '&'.join(params)
+    pages = self._GetPropertiesPages(uri)
+    groups = []
+    try:
+      for page in pages:
+        for group in page:
+          if stop_group is not None and group['groupId'].lower() >= stop_group:
+            return groups
+          groups.append(group)
+    finally:
+      pages.close()
+    return groups
+
   def RetrieveGroups(self, member_id, direct_only=False):
     """Retrieve all groups that belong to the given member_id.
 
@@ -260,6 +310,21 @@ class GroupsService(gdata.apps.service.PropertyService):
     uri = self._ServiceUrl('member', True, group_id, '', '',
                            suspended_users=suspended_users)
     return self._GetPropertiesList(uri)
+
+  def GetGeneratorForAllMembers(self, group_id, suspended_users=False):
+    """Retrieve all members in the given group, one page at a time.
+
+    Args:
+      group_id: The ID of the group (e.g. us-sales).
+      suspended_users: A boolean; should we include any suspended users in
+        the membership list returned?
+
+    Returns:
+      A generator yielding a list of member dicts for each page of members.
+    """
+    uri = self._ServiceUrl('member', True, group_id, '', '',
+                           suspended_users=suspended_users)
+    return self._GetPropertiesPages(uri)
     
   def RetrievePageOfMembers(self, group_id, suspended_users=False, start=None):
     """Retrieve one page of members of a given group.
@@ -92,6 +92,11 @@ class MultiDomainService(gdata.apps.service.PropertyService):
     uri = self._serviceUrl('alias', self.domain)
     return self._GetPropertiesList(uri)
 
+  def GetGeneratorForAllAliases(self):
+
+    uri = self._serviceUrl('alias', self.domain)
+    return self._GetPropertiesPages(uri)
+
   def DeleteAlias(self, alias_email):
   
     alias_domain = alias_email[alias_email.find('@')+1:]
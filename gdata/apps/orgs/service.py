@@ -146,6 +146,30 @@ class OrganizationService(gdata.apps.service.PropertyService):
         pass
     return all_users
 
+  def GetGeneratorForAllOrganizationUsers(self):
+
+    customer_id = self.RetrieveCustomerId()['customerId']
+    uri = '/a/feeds/orguser/2.0/%s?get=all' % customer_id
+    for page in self._GetPropertiesPages(uri):
+      for user in page:
+        try:
+          user['orgUnitPath'] = urllib.unquote_plus(user['orgUnitPath'])
+        except AttributeError:
+          pass
+      yield page
+
+  def GetGeneratorForAllOrganizationUnitUsers(self, name):
+
+    customer_id = self.RetrieveCustomerId()['customerId']
+    uri = '/a/feeds/orguser/2.0/%s?get=children&orgUnitPath=%s' % (customer_id, urllib.quote_plus(name))
+    for page in self._GetPropertiesPages(uri):
+      for user in page:
+        try:
+          user['orgUnitPath'] = urllib.unquote_plus(user['orgUnitPath'])
+        except AttributeError:
+          pass
+      yield page
+
   def RetrieveAllOrganizationUnitUsers(self, name):
   
     customer_id = self.RetrieveCustomerId()['customerId']
@@ -53,15 +53,18 @@ class ReportService(gdata.apps.service.PropertyService):
     self.port = 443
     self.domain = domain
 
-  def retrieve_report(self, report, date=None):
-    """Retrieves a report
+  def retrieve_report_pages(self, report, date=None):
+    """Retrieves a report one page at a time
+
+    The next page is fetched in the background while the caller works on
+    the current one if prefetch_depth is set.
 
     Args:
       report: string, accounts, activity, disk_space, email_clients or summary
       date: string: YYYY-MM-DD. If not specified, most recent day that has past 12pm PST will be used (in other words, today if it's after 12pm PST or yesterday if not)
-      
+
     Returns:
-      String, the report data
+      A generator yielding the report data of each page as a string
     """
     uri = '/hosted/services/v1.0/reports/ReportingData'
     if date == None:
@@ -70,10 +73,10 @@ class ReportService(gdata.apps.service.PropertyService):
       if report_time.tm_hour < 20:
         report_time = time.gmtime(now - 60*60*24)
       date = '%s-%s-0%s' % (report_time.tm_year, report_time.tm_mon, report_time.tm_mday)
-    page = 1
-    report_data = ''
-    while True:
-      xml = '''<?xml version="1.0" encoding="UTF-8"?>
+    def GetPages():
+      page = 1
+      while True:
+        xml = '''<?xml version="1.0" encoding="UTF-8"?>
 <rest xmlns="google:accounts:rest:protocol"
     xmlns:xsi=" http://www.w3.org/2001/XMLSchema-instance ">
     <type>Report</type>
@@ -83,11 +86,31 @@ class ReportService(gdata.apps.service.PropertyService):
     <reportType>daily</reportType>
     <reportName>%s</reportName>
 </rest>''' % (self.domain, date, page, report)
-      report_page = self.Post(xml, uri, converter=str)
-      if report_page == 'End-Of-Report':
-        return report_data
-      else:
-        report_data += report_page
+        report_page = self.Post(xml, uri, converter=str)
+        if report_page == 'End-Of-Report':
+          return
+        yield report_page
         page = page + 1
 
-  RetrieveReport = retrieve_report
\ No newline at end of file
+    pages = self.ReadAhead(GetPages())
+    try:
+      for report_page in pages:
+        yield report_page
+    finally:
+      if isinstance(pages, gdata.service.ReadAhead):
+        pages.close()
+
+  def retrieve_report(self, report, date=None):
+    """Retrieves a report
+
+    Args:
+      report: string, accounts, activity, disk_space, email_clients or summary
+      date: string: YYYY-MM-DD. If not specified, most recent day that has past 12pm PST will be used (in other words, today if it's after 12pm PST or yesterday if not)
+      
+    Returns:
+      String, the report data
+    """
+    return ''.join(self.retrieve_report_pages(report, date=date))
+
+  RetrieveReportPages = retrieve_report_pages
+  RetrieveReport = retrieve_report
@@ -26,6 +26,15 @@ except ImportError:
       from xml.etree import ElementTree
     except ImportError:
       from elementtree import ElementTree
+try:
+  import json
+except ImportError:
+  # Python 2.5, PageJournal is not available
+  json = None
+import os
+import StringIO
+import threading
+import time
 import urllib
 import gdata
 import atom.service
@@ -59,6 +68,10 @@ TOO_MANY_RECIPIENTS_ON_EMAIL_LIST=1500
 
 DEFAULT_QUOTA_LIMIT='2048'
 
+_ATOM_ENTRY_TAG = '{%s}entry' % atom.ATOM_NAMESPACE
+_ATOM_LINK_TAG = '{%s}link' % atom.ATOM_NAMESPACE
+_APPS_PROPERTY_TAG = '{%s}property' % gdata.apps.APPS_NAMESPACE
+
 
 class Error(Exception):
   pass
@@ -81,6 +94,11 @@ class AppsForYourDomainException(Error):
 class AppsService(gdata.service.GDataService):
   """Client for the Google Apps Provisioning service."""
 
+  # A PageJournal recording the pages of the listing of all users as they
+  # are fetched and resuming a listing recorded before, None records
+  # nothing.
+  page_journal = None
+
   def __init__(self, email=None, password=None, domain=None, source=None,
                server='apps-apis.google.com', additional_headers=None,
                **kwargs):
@@ -109,12 +127,15 @@ class AppsService(gdata.service.GDataService):
 
   def AddAllElementsFromAllPages(self, link_finder, func):
     """retrieve all pages and add all elements"""
-    next = link_finder.GetNextLink()
-    while next is not None:
-      next_feed = self.Get(next.href, converter=func)
+    def GetNextPages(next):
+      while next is not None:
+        next_feed = self.Get(next.href, converter=func)
+        yield next_feed
+        next = next_feed.GetNextLink()
+
+    for next_feed in self.ReadAhead(GetNextPages(link_finder.GetNextLink())):
       for a_entry in next_feed.entry:
         link_finder.entry.append(a_entry)
-      next = next_feed.GetNextLink()
     return link_finder
 
   def RetrievePageOfEmailLists(self, start_email_list_name=None,
@@ -446,13 +467,84 @@ class AppsService(gdata.service.GDataService):
                               num_retries=gdata.service.DEFAULT_NUM_RETRIES,
                               delay=gdata.service.DEFAULT_DELAY,
                               backoff=gdata.service.DEFAULT_BACKOFF):
-    """Retrieve a generator for all users in this domain."""
+    """Retrieve a generator for all users in this domain.
+
+    With a page_journal the pages are recorded as they are fetched, and a
+    listing recorded before is continued from the last page it fetched.
+    """
+    if self.page_journal is not None:
+      return self._GetJournaledPagesOfUsers()
     first_page = self.RetrievePageOfUsers(num_retries=num_retries, delay=delay,
                                           backoff=backoff)
     return self.GetGeneratorFromLinkFinder(
       first_page, gdata.apps.UserFeedFromString, num_retries=num_retries,
       delay=delay, backoff=backoff)
 
+  def _GetJournaledPagesOfUsers(self):
+    """Yields the UserFeed pages of all users, see GetGeneratorForAllUsers.
+
+    The journal holds the XML of each page, as a single entry under 'xml'.
+    """
+    journal = self.page_journal
+    feed_uri = "%s/user/%s" % (self._baseURL(), API_VER)
+    recorded_pages, uri = journal.GetPages(feed_uri)
+    for recorded_page in recorded_pages:
+      yield gdata.apps.UserFeedFromString(recorded_page[0]['xml'])
+
+    def GetPages(uri, page_number):
+      while uri is not None:
+        try:
+          xml = self.Get(uri, converter=str)
+        except gdata.service.RequestError, e:
+          raise AppsForYourDomainException(e.args[0])
+        page = gdata.apps.UserFeedFromString(xml)
+        next = page.GetNextLink()
+        if next is None:
+          uri = None
+        else:
+          uri = next.href
+        journal.AddPage(feed_uri, page_number, [{'xml': xml}], uri)
+        page_number += 1
+        yield page
+
+    pages = self.ReadAhead(GetPages(uri, len(recorded_pages)))
+    try:
+      for page in pages:
+        yield page
+    finally:
+      if isinstance(pages, gdata.service.ReadAhead):
+        pages.close()
+
+  def RetrieveRangeOfUsers(self, start_username=None, stop_username=None):
+    """Retrieve the users whose usernames fall in a range.
+
+    Listings of different ranges can be fetched at once, which is faster than
+    paging through every user of a large domain one page after the other.
+
+    Args:
+      start_username: The first username of the range, None to start at the
+          first user of the domain.
+      stop_username: The range ends before this username, None to end at the
+          last user of the domain.
+
+    Returns:
+      A list of UserEntry objects in the order of the user feed.
+    """
+    first_page = self.RetrievePageOfUsers(start_username=start_username)
+    pages = self.GetGeneratorFromLinkFinder(first_page,
+                                            gdata.apps.UserFeedFromString)
+    users = []
+    try:
+      for page in pages:
+        for user in page.entry:
+          if (stop_username is not None and
+              user.login.user_name.lower() >= stop_username):
+            return users
+          users.append(user)
+    finally:
+      pages.close()
+    return users
+
   def RetrieveAllUsers(self):
     """Retrieve all users in this domain. OBSOLETE"""
 
@@ -462,9 +554,178 @@ class AppsService(gdata.service.GDataService):
       ret, gdata.apps.UserFeedFromString)
 
 
+def _PropertyElement2Dict(element):
+  """Returns the properties of an entry element, encoded the way AtomBase
+  members are, so both parsers give the same dicts."""
+  properties = {}
+  for property in element.findall(_APPS_PROPERTY_TAG):
+    name = property.get('name')
+    value = property.get('value')
+    if atom.MEMBER_STRING_ENCODING is not unicode:
+      if name:
+        name = name.encode(atom.MEMBER_STRING_ENCODING)
+      if value:
+        value = value.encode(atom.MEMBER_STRING_ENCODING)
+    if not value:
+      value = None
+    properties[name] = value
+  return properties
+
+
+def PropertyPageFromString(xml_string):
+  """Parses a property feed page straight into dicts.
+
+  This is a single ElementTree pass over the XML. Going through
+  PropertyFeedFromString builds an AtomBase object for every entry and
+  property instead.
+
+  Args:
+    xml_string: string The XML of a property feed page.
+
+  Returns:
+    A (properties_list, next_uri) tuple. properties_list holds a dict of
+    the properties of each entry. next_uri is the href of the next link,
+    or None on the last page.
+  """
+  properties_list = []
+  next_uri = None
+  depth = 0
+  for event, element in ElementTree.iterparse(StringIO.StringIO(xml_string),
+                                              events=('start', 'end')):
+    if event == 'start':
+      depth += 1
+      continue
+    depth -= 1
+    if element.tag == _ATOM_ENTRY_TAG and depth == 1:
+      properties_list.append(_PropertyElement2Dict(element))
+      element.clear()
+    elif (element.tag == _ATOM_LINK_TAG and depth == 1 and
+          element.get('rel') == 'next'):
+      next_uri = element.get('href')
+  return properties_list, next_uri
+
+
+def PropertiesFromString(xml_string):
+  """Parses a property entry straight into a dict of its properties."""
+  return _PropertyElement2Dict(ElementTree.fromstring(xml_string))
+
+
+def _EncodeJournalValue(value):
+  """Turns a string read back from a PageJournal into the type AtomBase
+  members have."""
+  if value is None or atom.MEMBER_STRING_ENCODING is unicode:
+    return value
+  return value.encode(atom.MEMBER_STRING_ENCODING)
+
+
+class PageJournal(object):
+  """Records the pages of property feeds in a file as they are fetched.
+
+  AppsService records the pages of the listing of all users in it as well.
+  Each line of the file is a JSON object with the URI the feed was listed
+  from, the number of the page, the page's entries and the link to the next
+  page. A journal opened with resume=True reads the pages recorded before, so
+  a listing which failed part way is continued from the last page it
+  fetched instead of from the start. A line cut short by the failure is
+  dropped.
+  """
+
+  def __init__(self, path, resume=False):
+    """Opens the journal, emptying it unless resume is True.
+
+    Args:
+      path: string The file the pages are recorded in.
+      resume: boolean Whether to read the pages recorded in the file before.
+
+    Raises:
+      ImportError: if there is no json module, which came with Python 2.6.
+      IOError: if the file can't be opened.
+    """
+    if json is None:
+      raise ImportError('the page journal requires Python 2.6 or 2.7')
+    self.path = path
+    self._feeds = {}
+    self._lock = threading.Lock()
+    good_size = 0
+    if resume and os.path.isfile(path):
+      journal_file = open(path, 'rb')
+      try:
+        for line in journal_file:
+          try:
+            page = json.loads(line)
+          except ValueError:
+            break
+          self._AddLoadedPage(page)
+          good_size += len(line)
+      finally:
+        journal_file.close()
+    self._file = open(path, 'ab')
+    self._file.truncate(good_size)
+
+  def _AddLoadedPage(self, page):
+    feed_uri = _EncodeJournalValue(page['feed'])
+    if page['page'] == 0:
+      self._feeds[feed_uri] = ([], feed_uri)
+    pages = self._feeds[feed_uri][0]
+    pages.append([dict((_EncodeJournalValue(name), _EncodeJournalValue(value))
+                       for name, value in entry.iteritems())
+                  for entry in page['entries']])
+    self._feeds[feed_uri] = (pages, _EncodeJournalValue(page['next']))
+
+  def GetPages(self, feed_uri):
+    """Returns the pages recorded for a feed when the journal was opened.
+
+    The pages are handed out once, so listing the feed again fetches it
+    again.
+
+    Args:
+      feed_uri: string The URI the feed is listed from.
+
+    Returns:
+      A (pages, next_uri) tuple, next_uri is the page to continue from or
+      None if the whole feed was recorded.
+    """
+    self._lock.acquire()
+    try:
+      return self._feeds.pop(feed_uri, ([], feed_uri))
+    finally:
+      self._lock.release()
+
+  def AddPage(self, feed_uri, page_number, properties_list, next_uri):
+    """Records one page of a feed.
+
+    Args:
+      feed_uri: string The URI the feed is listed from.
+      page_number: int The number of the page in the feed, from 0.
+      properties_list: list The entries of the page as dicts.
+      next_uri: string The URI of the next page, None for the last page.
+    """
+    line = json.dumps({'feed': feed_uri, 'page': page_number,
+                       'entries': properties_list, 'next': next_uri})
+    self._lock.acquire()
+    try:
+      self._file.write(line + '\n')
+      self._file.flush()
+      os.fsync(self._file.fileno())
+    finally:
+      self._lock.release()
+
+  def Remove(self):
+    """Closes and deletes the journal, once it is no longer needed."""
+    self._file.close()
+    os.remove(self.path)
+
+
 class PropertyService(gdata.service.GDataService):
   """Client for the Google Apps Property service."""
 
+  # Property feeds and entries are parsed straight into dicts, set this to
+  # False to parse them into PropertyFeed and PropertyEntry objects first.
+  fast_property_parser = True
+  # A PageJournal recording the pages of property feeds as they are fetched
+  # and resuming listings recorded before, None records nothing.
+  page_journal = None
+
   def __init__(self, email=None, password=None, domain=None, source=None,
                server='apps-apis.google.com', additional_headers=None):
     gdata.service.GDataService.__init__(self, email=email, password=password,
@@ -477,12 +738,15 @@ class PropertyService(gdata.service.GDataService):
 
   def AddAllElementsFromAllPages(self, link_finder, func):
     """retrieve all pages and add all elements"""
-    next = link_finder.GetNextLink()
-    while next is not None:
-      next_feed = self.Get(next.href, converter=func)
+    def GetNextPages(next):
+      while next is not None:
+        next_feed = self.Get(next.href, converter=func)
+        yield next_feed
+        next = next_feed.GetNextLink()
+
+    for next_feed in self.ReadAhead(GetNextPages(link_finder.GetNextLink())):
       for a_entry in next_feed.entry:
         link_finder.entry.append(a_entry)
-      next = next_feed.GetNextLink()
     return link_finder
 
   def _GetPropertyEntry(self, properties):
@@ -506,20 +770,80 @@ class PropertyService(gdata.service.GDataService):
     except gdata.service.RequestError, e:
       raise gdata.apps.service.AppsForYourDomainException(e.args[0])
 
+  def _GetPropertyPage(self, uri):
+    """Retrieves one page of a property feed.
+
+    Returns:
+      A (properties_list, next_uri) tuple, see PropertyPageFromString.
+    """
+    if not self.fast_property_parser:
+      property_feed = self._GetPropertyFeed(uri)
+      properties_list = [self._PropertyEntry2Dict(property_entry)
+                         for property_entry in property_feed.entry]
+      next = property_feed.GetNextLink()
+      if next is None:
+        return properties_list, None
+      return properties_list, next.href
+    try:
+      return self.Get(uri, converter=PropertyPageFromString)
+    except gdata.service.RequestError, e:
+      raise gdata.apps.service.AppsForYourDomainException(e.args[0])
+
+  def _GetPropertiesPages(self, uri):
+    """Yields the entries of each page of a feed as a list of dicts."""
+    def GetPages(uri):
+      cache = self.directory_cache
+      journal = self.page_journal
+      feed_uri = uri
+      page_number = 0
+      fetched_pages = []
+      fetched = time.time()
+      resumed = False
+      if cache is not None:
+        cached_pages = cache.GetPages(feed_uri)
+        if cached_pages is not None:
+          for properties_list in cached_pages:
+            yield properties_list
+          return
+      if journal is not None:
+        recorded_pages, uri = journal.GetPages(feed_uri)
+        for properties_list in recorded_pages:
+          page_number += 1
+          resumed = True
+          yield properties_list
+      while uri is not None:
+        properties_list, uri = self._GetPropertyPage(uri)
+        if journal is not None:
+          journal.AddPage(feed_uri, page_number, properties_list, uri)
+        if cache is not None:
+          fetched_pages.append(properties_list)
+        page_number += 1
+        yield properties_list
+      # A listing resumed from the journal has pages fetched by an earlier
+      # run, it is not cached as if it had been fetched now.
+      if cache is not None and not resumed:
+        cache.AddPages(feed_uri, fetched_pages, fetched)
+
+    pages = self.ReadAhead(GetPages(uri))
+    try:
+      for properties_list in pages:
+        yield properties_list
+    finally:
+      if isinstance(pages, gdata.service.ReadAhead):
+        pages.close()
+
   def _GetPropertiesList(self, uri):
-    property_feed = self._GetPropertyFeed(uri)
-    # pagination
-    property_feed = self.AddAllElementsFromAllPages(
-      property_feed, gdata.apps.PropertyFeedFromString)
     properties_list = []
-    for property_entry in property_feed.entry:
-      properties_list.append(self._PropertyEntry2Dict(property_entry))
+    for page in self._GetPropertiesPages(uri):
+      properties_list.extend(page)
     return properties_list
 
   def _GetProperties(self, uri):
     try:
-      return self._PropertyEntry2Dict(gdata.apps.PropertyEntryFromString(
-        str(self.Get(uri))))
+      if not self.fast_property_parser:
+        return self._PropertyEntry2Dict(gdata.apps.PropertyEntryFromString(
+          str(self.Get(uri))))
+      return self.Get(uri, converter=PropertiesFromString)
     except gdata.service.RequestError, e:
       raise gdata.apps.service.AppsForYourDomainException(e.args[0])
 
@@ -60,7 +60,17 @@
 
 __author__ = 'api.jscudder (Jeffrey Scudder)'
 
+import collections
+import errno
+import httplib
+import Queue
+import random
 import re
+import socket
+import StringIO
+import sys
+import threading
+import time
 import urllib
 import urlparse
 try:
@@ -183,6 +193,236 @@ class RanOutOfTries(Error):
   pass
 
 
+class RetryPolicy(object):
+  """Decides which failed requests GDataService.request tries again.
+
+  A request is retried when no response was received (socket errors and
+  broken connections), when the response has one of the retry_statuses, or
+  when an error response's body names one of the retry_reasons. Requests
+  wait between tries with exponential backoff and full jitter. All requests
+  sharing a policy draw from one budget of retries per budget_window
+  seconds, so an outage makes a run fail instead of retrying every request
+  to the limit, while a long running process gets its budget back over time.
+
+  Only idempotent_operations are retried after any failure. Other requests,
+  like the POSTs creating users and groups, may have been carried out when
+  no response or a server error came back, and sending them again could
+  create things twice. They are only retried when the request never reached
+  the server or the server turned it away for one of the rejected_reasons.
+  """
+
+  retry_statuses = (500, 502, 503, 504)
+  retry_reasons = ('quotaExceeded', 'rateLimitExceeded',
+                   'userRateLimitExceeded', 'backendError',
+                   'reason="UnknownError"')
+  idempotent_operations = ('GET', 'HEAD', 'PUT', 'DELETE')
+  rejected_reasons = ('quotaExceeded', 'rateLimitExceeded',
+                      'userRateLimitExceeded')
+  # socket errors raised before anything was sent
+  unsent_errnos = (errno.ECONNREFUSED,)
+
+  def __init__(self, max_tries=DEFAULT_NUM_RETRIES + 2, delay=DEFAULT_DELAY,
+               backoff=DEFAULT_BACKOFF, max_delay=60, budget=500,
+               budget_window=600):
+    """Creates a RetryPolicy.
+
+    Args:
+      max_tries: int The most times one request is sent.
+      delay: int The longest wait in seconds before the first retry.
+      backoff: int The longest wait grows by this factor with every retry.
+      max_delay: int The longest wait never exceeds this many seconds.
+      budget: int The number of retries all requests may make together
+          within budget_window.
+      budget_window: int The seconds after which a retry no longer counts
+          against the budget.
+    """
+    self.max_tries = max_tries
+    self.delay = delay
+    self.backoff = backoff
+    self.max_delay = max_delay
+    self.budget = budget
+    self.budget_window = budget_window
+    self._retry_times = collections.deque()
+    self._lock = threading.Lock()
+
+  def IsRetryable(self, status=None, body=None, operation='GET', error=None):
+    """Returns True if a failed request is worth trying again.
+
+    Args:
+      status: int The status of the response, None if there was none.
+      body: string (optional) The body of the error response.
+      operation: string (optional) The HTTP method of the request.
+      error: Exception (optional) The error raised when there was no
+          response.
+    """
+    if operation.upper() in self.idempotent_operations:
+      if status is None or status in self.retry_statuses:
+        return True
+      reasons = self.retry_reasons
+    else:
+      if status is None:
+        return (isinstance(error, socket.error) and bool(error.args) and
+                error.args[0] in self.unsent_errnos)
+      reasons = self.rejected_reasons
+    if status >= 400 and body:
+      for reason in reasons:
+        if body.find(reason) != -1:
+          return True
+    return False
+
+  def Wait(self, tries):
+    """Uses up one retry from the budget and sleeps before it.
+
+    Args:
+      tries: int The number of times the request has been sent so far.
+
+    Returns:
+      False without sleeping if the request should not be sent again, as
+      it was sent max_tries times or the budget is used up.
+    """
+    if tries >= self.max_tries:
+      return False
+    self._lock.acquire()
+    try:
+      now = time.time()
+      while (self._retry_times and
+             self._retry_times[0] <= now - self.budget_window):
+        self._retry_times.popleft()
+      if len(self._retry_times) >= self.budget:
+        return False
+      self._retry_times.append(now)
+    finally:
+      self._lock.release()
+    longest = min(self.max_delay, self.delay * self.backoff ** (tries - 1))
+    time.sleep(random.uniform(0, longest))
+    return True
+
+
+def _BufferedResponse(response, body):
+  """Returns a response which can be read again after its body was read.
+
+  Args:
+    response: The response the body was read from.
+    body: string The body, None is taken for an empty one.
+  """
+  if hasattr(response, 'getheaders'):
+    headers = dict(response.getheaders())
+  else:
+    # A response buffered before, like the error responses _LimitedRequest
+    # reads for the concurrency_limiter.
+    headers = response._headers
+  return atom.http_interface.HttpResponse(
+      body=StringIO.StringIO(body or ''), status=response.status,
+      reason=response.reason, headers=headers)
+
+
+def _IsReplayable(data):
+  """Returns True if data can be sent again, False for file-like parts."""
+  if isinstance(data, list):
+    parts = data
+  else:
+    parts = [data]
+  for part in parts:
+    if hasattr(part, 'read'):
+      return False
+  return True
+
+
+def _StartDaemonThread(target, args):
+  """Starts a daemon thread calling target(*args) and returns it."""
+  thread = threading.Thread(target=target, args=args)
+  thread.setDaemon(True)
+  thread.start()
+  return thread
+
+
+class ReadAhead(object):
+  """Iterates over pages which a background thread fetches in advance.
+
+  The pages iterator is consumed on a daemon thread which stays up to depth
+  pages ahead of the caller, so the next page is requested as soon as the
+  link to it is known and downloads while the caller works on the current
+  one. Errors raised while fetching are raised to the caller in place of the
+  page that failed. The thread stops when the pages run out or when the
+  ReadAhead is closed.
+  """
+
+  # The function starting the thread, called as start_thread(target, args)
+  # and returning the started daemon thread. Replace it to start the thread
+  # the way the application starts its own, for example to hand thread-local
+  # settings over to it.
+  start_thread = staticmethod(_StartDaemonThread)
+
+  def __init__(self, pages, depth=1):
+    """Starts fetching pages in the background.
+
+    Args:
+      pages: iterator Yields the pages, fetching each when it is asked for.
+      depth: int The most pages fetched before the caller asks for them.
+    """
+    self._queue = Queue.Queue(max(depth, 1))
+    self._stopped = threading.Event()
+    self._done = False
+    self._thread = self.start_thread(self._Fetch, (pages,))
+
+  def _Put(self, item):
+    """Queues item, returns False if the ReadAhead was closed meanwhile."""
+    while not self._stopped.isSet():
+      try:
+        self._queue.put(item, True, 0.5)
+        return not self._stopped.isSet()
+      except Queue.Full:
+        pass
+    return False
+
+  def _Fetch(self, pages):
+    try:
+      try:
+        for page in pages:
+          if not self._Put((True, page)):
+            return
+      except Exception:
+        self._Put((False, sys.exc_info()))
+        return
+      self._Put((False, None))
+    finally:
+      if hasattr(pages, 'close'):
+        # Lets a generator fetching the pages clean up at once.
+        pages.close()
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    if self._done:
+      raise StopIteration
+    ok, value = self._queue.get()
+    if ok:
+      return value
+    self._done = True
+    self._stopped.set()
+    if value is None:
+      raise StopIteration
+    raise value[0], value[1], value[2]
+
+  def close(self):
+    """Stops the background thread and waits for it to end.
+
+    Pages fetched but not yet handed out are dropped. A page being fetched
+    when close is called is waited for.
+    """
+    self._done = True
+    self._stopped.set()
+    # Emptying the queue frees a thread waiting to queue a page.
+    while True:
+      try:
+        self._queue.get_nowait()
+      except Queue.Empty:
+        break
+    if self._thread is not threading.currentThread():
+      self._thread.join()
+
+
 class GDataService(atom.service.AtomService):
   """Contains elements needed for GData login and CRUD request headers.
 
@@ -195,6 +435,25 @@ class GDataService(atom.service.AtomService):
   auth_token = None
   # The tokens dict is deprecated in favor of the token_store.
   tokens = None
+  # An object with acquire() and release(ticket, status, body) methods
+  # which is consulted around every request, for example to limit how many
+  # requests are in flight at once. Set it on the objects doing the work of
+  # one job, so that concurrent jobs don't share it.
+  concurrency_limiter = None
+  # An object with a Wait(url) method which is called before every request
+  # is sent, for example to keep to a rate of requests per second.
+  rate_limiter = None
+  # The RetryPolicy deciding which failed requests are sent again, None
+  # disables retries.
+  retry_policy = RetryPolicy()
+  # An object with an Invalidate(url) method which is called after every
+  # request that is not a GET. PropertyService also serves whole listings of
+  # property feeds from it with its GetPages(uri) and
+  # AddPages(uri, pages, fetched) methods.
+  directory_cache = None
+  # How many pages of a feed are fetched ahead of the caller while it pages
+  # through the feed, see ReadAhead. 0 fetches each page when it is needed.
+  prefetch_depth = 0
 
   def __init__(self, email=None, password=None, account_type='HOSTED_OR_GOOGLE',
                service=None, auth_service_url=None, source=None, server=None, 
@@ -315,14 +574,40 @@ class GDataService(atom.service.AtomService):
                                  num_retries=DEFAULT_NUM_RETRIES,
                                  delay=DEFAULT_DELAY,
                                  backoff=DEFAULT_BACKOFF):
-    """returns a generator for pagination"""
-    yield link_finder
-    next = link_finder.GetNextLink()
-    while next is not None:
-      next_feed = func(str(self.GetWithRetries(
-            next.href, num_retries=num_retries, delay=delay, backoff=backoff)))
-      yield next_feed
-      next = next_feed.GetNextLink()
+    """returns a generator for pagination
+
+    The pages are retried as the retry_policy allows, num_retries, delay and
+    backoff are no longer used.
+    """
+    def GetNextPages(next):
+      while next is not None:
+        next_feed = self.Get(next.href, converter=func)
+        yield next_feed
+        next = next_feed.GetNextLink()
+
+    next_pages = self.ReadAhead(GetNextPages(link_finder.GetNextLink()))
+    try:
+      yield link_finder
+      for next_feed in next_pages:
+        yield next_feed
+    finally:
+      if isinstance(next_pages, ReadAhead):
+        next_pages.close()
+
+  def ReadAhead(self, pages):
+    """Returns the pages iterator, fetched ahead if prefetch_depth is set.
+
+    Args:
+      pages: iterator Yields the pages of a feed, fetching each when it is
+          asked for.
+
+    Returns:
+      A ReadAhead over pages if prefetch_depth is above 0, otherwise pages
+      itself.
+    """
+    if self.prefetch_depth > 0:
+      return ReadAhead(pages, self.prefetch_depth)
+    return pages
 
   def _GetElementGeneratorFromLinkFinder(self, link_finder, func,
                                         num_retries=DEFAULT_NUM_RETRIES,
@@ -969,7 +1254,15 @@ class GDataService(atom.service.AtomService):
     Raises:
       ValueError if any of the parameters has an invalid value.
       RanOutOfTries on failure after number of retries.
+
+    A service with a retry_policy already retries every request, so the
+    request is then only sent once through Get, instead of retrying the
+    retries.
     """
+    if self.retry_policy is not None:
+      return self.Get(uri, extra_headers=extra_headers,
+                      redirects_remaining=redirects_remaining,
+                      encoding=encoding, converter=converter)
     # Moved import for time module inside this method since time is not a
     # default module in Python2.2. This method will not be usable in
     # Python2.2.
@@ -1015,6 +1308,85 @@ class GDataService(atom.service.AtomService):
       mdelay *= backoff
     raise RanOutOfTries('Ran out of tries.')
 
+  def request(self, operation, url, data=None, headers=None,
+      url_params=None):
+    """Performs an HTTP request, see atom.service.AtomService.request.
+
+    Failed requests are sent again as the retry_policy allows. Error
+    responses are read to check them for retryable reasons, so the response
+    returned for them is an atom.http_interface.HttpResponse holding the
+    body. Requests with file-like data are never retried, and requests
+    which are not idempotent only when the server never carried them out.
+    Requests other than GET invalidate what the directory_cache holds for
+    url.
+    """
+    cache = self.directory_cache
+    if cache is None or operation == 'GET':
+      return self._RetriedRequest(operation, url, data=data, headers=headers,
+                                  url_params=url_params)
+    try:
+      return self._RetriedRequest(operation, url, data=data, headers=headers,
+                                  url_params=url_params)
+    finally:
+      cache.Invalidate(url)
+
+  def _RetriedRequest(self, operation, url, data=None, headers=None,
+      url_params=None):
+    """Performs an HTTP request, sending it again as retry_policy allows."""
+    policy = self.retry_policy
+    if policy is not None and not _IsReplayable(data):
+      policy = None
+    tries = 1
+    while True:
+      try:
+        response = self._LimitedRequest(operation, url, data=data,
+            headers=headers, url_params=url_params)
+      except (socket.error, httplib.HTTPException), e:
+        if (policy is None or
+            not policy.IsRetryable(operation=operation, error=e) or
+            not policy.Wait(tries)):
+          raise
+      else:
+        if policy is None or response.status < 400:
+          return response
+        body = response.read()
+        response = _BufferedResponse(response, body)
+        if not policy.IsRetryable(response.status, body, operation):
+          return response
+        if not policy.Wait(tries):
+          return response
+      tries += 1
+
+  def _LimitedRequest(self, operation, url, data=None, headers=None,
+      url_params=None):
+    """Performs one HTTP request within the rate and concurrency limiters.
+
+    The rate_limiter is asked to wait before the request is sent. The
+    concurrency_limiter waits for its turn to allow the request and then
+    hears how it went: the status and, for error responses, the body of the
+    response, or a status of None if no response was received. The body of
+    an error response is read for it, so the response returned is an
+    atom.http_interface.HttpResponse holding the body.
+    """
+    if self.rate_limiter is not None:
+      self.rate_limiter.Wait(url)
+    limiter = self.concurrency_limiter
+    if limiter is None:
+      return atom.service.AtomService.request(self, operation, url, data=data,
+          headers=headers, url_params=url_params)
+    ticket = limiter.acquire()
+    status = body = None
+    try:
+      response = atom.service.AtomService.request(self, operation, url,
+          data=data, headers=headers, url_params=url_params)
+      status = response.status
+      if status >= 400:
+        body = response.read()
+        response = _BufferedResponse(response, body)
+      return response
+    finally:
+      limiter.release(ticket, status, body)
+
   # CRUD operations
   def Get(self, uri, extra_headers=None, redirects_remaining=4, 
       encoding='UTF-8', converter=None):
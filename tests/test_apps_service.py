@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+#
+# Google Apps Manager
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests the feed handling of gdata.apps.service."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import gdata.apps
+import gdata.apps.service
+import gdata.service
+
+_FEED = """<?xml version='1.0' encoding='UTF-8'?>
+<feed xmlns='http://www.w3.org/2005/Atom'
+    xmlns:apps='http://schemas.google.com/apps/2006'>
+  <id>https://apps-apis.google.com/a/feeds/group/2.0/example.com</id>
+  <link rel='self' type='application/atom+xml'
+      href='https://apps-apis.google.com/a/feeds/group/2.0/example.com'/>
+  <link rel='next' type='application/atom+xml'
+      href='https://apps-apis.google.com/a/feeds/group/2.0/example.com?start=b'/>
+  <entry>
+    <id>https://apps-apis.google.com/a/feeds/group/2.0/example.com/a</id>
+    <link rel='self' type='application/atom+xml'
+        href='https://apps-apis.google.com/a/feeds/group/2.0/example.com/a'/>
+    <apps:property name='groupId' value='a@example.com'/>
+    <apps:property name='groupName' value='Caf\xc3\xa9 &amp; friends'/>
+    <apps:property name='description' value=''/>
+    <apps:property name='emailPermission' value='Member'/>
+  </entry>
+  <entry>
+    <id>https://apps-apis.google.com/a/feeds/group/2.0/example.com/b</id>
+    <link rel='next' href='https://apps-apis.google.com/not/the/next/page'/>
+    <apps:property name='groupId' value='b@example.com'/>
+    <apps:property name='groupName' value='B'/>
+  </entry>
+</feed>
+"""
+
+_LAST_PAGE = """<?xml version='1.0' encoding='UTF-8'?>
+<feed xmlns='http://www.w3.org/2005/Atom'
+    xmlns:apps='http://schemas.google.com/apps/2006'>
+  <id>https://apps-apis.google.com/a/feeds/group/2.0/example.com</id>
+</feed>
+"""
+
+_ENTRY = """<?xml version='1.0' encoding='UTF-8'?>
+<entry xmlns='http://www.w3.org/2005/Atom'
+    xmlns:apps='http://schemas.google.com/apps/2006'>
+  <id>https://apps-apis.google.com/a/feeds/group/2.0/example.com/a</id>
+  <apps:property name='groupId' value='a@example.com'/>
+  <apps:property name='groupName' value='Caf\xc3\xa9'/>
+  <apps:property name='description' value=''/>
+</entry>
+"""
+
+
+_USER_PAGE = """<?xml version='1.0' encoding='UTF-8'?>
+<feed xmlns='http://www.w3.org/2005/Atom'
+    xmlns:apps='http://schemas.google.com/apps/2006'>
+  %s
+  <entry>
+    <apps:login userName='%s'/>
+  </entry>
+</feed>
+"""
+
+_NEXT_LINK = "<link rel='next' type='application/atom+xml' href='%s'/>"
+
+
+def _SlowPage(xml_string):
+  """Parses a page the way PropertyService did before PropertyPageFromString."""
+  service = gdata.apps.service.PropertyService()
+  feed = gdata.apps.PropertyFeedFromString(xml_string)
+  properties_list = [service._PropertyEntry2Dict(entry)
+                     for entry in feed.entry]
+  next = feed.GetNextLink()
+  if next is None:
+    return properties_list, None
+  return properties_list, next.href
+
+
+class PropertyPageFromStringTest(unittest.TestCase):
+
+  def testSameAsPropertyFeed(self):
+    self.assertEqual(gdata.apps.service.PropertyPageFromString(_FEED),
+                     _SlowPage(_FEED))
+
+  def testValues(self):
+    properties_list, next_uri = gdata.apps.service.PropertyPageFromString(
+        _FEED)
+    self.assertEqual(next_uri, 'https://apps-apis.google.com/a/feeds/group/'
+                     '2.0/example.com?start=b')
+    self.assertEqual(len(properties_list), 2)
+    self.assertEqual(properties_list[0]['groupName'], 'Caf\xc3\xa9 & friends')
+    self.assertEqual(properties_list[0]['description'], None)
+    self.assertEqual(type(properties_list[0]['groupId']),
+                     type(_SlowPage(_FEED)[0][0]['groupId']))
+
+  def testLastPage(self):
+    self.assertEqual(gdata.apps.service.PropertyPageFromString(_LAST_PAGE),
+                     ([], None))
+    self.assertEqual(_SlowPage(_LAST_PAGE), ([], None))
+
+  def testPropertiesFromString(self):
+    service = gdata.apps.service.PropertyService()
+    self.assertEqual(
+        gdata.apps.service.PropertiesFromString(_ENTRY),
+        service._PropertyEntry2Dict(
+            gdata.apps.PropertyEntryFromString(_ENTRY)))
+
+
+class _FakePropertyService(gdata.apps.service.PropertyService):
+  """Serves property feed pages from a dict of uri -> (page, next uri)."""
+
+  def __init__(self, feed):
+    gdata.apps.service.PropertyService.__init__(self)
+    self.feed = feed
+    self.fetched = []
+
+  def _GetPropertyPage(self, uri):
+    self.fetched.append(uri)
+    page, next_uri = self.feed[uri]
+    if page is None:
+      raise gdata.apps.service.AppsForYourDomainException(
+          {'status': 503, 'reason': 'Service Unavailable', 'body': ''})
+    return page, next_uri
+
+
+class _FakeAppsService(gdata.apps.service.AppsService):
+  """Serves user feed pages from a dict of uri -> (username, next uri)."""
+
+  def __init__(self, feed):
+    gdata.apps.service.AppsService.__init__(self, domain='example.com')
+    self.feed = feed
+    self.fetched = []
+
+  def Get(self, uri, converter=None):
+    self.fetched.append(uri)
+    username, next_uri = self.feed[uri]
+    if username is None:
+      raise gdata.service.RequestError(
+          {'status': 503, 'reason': 'Service Unavailable', 'body': ''})
+    link = ''
+    if next_uri is not None:
+      link = _NEXT_LINK % next_uri
+    return converter(_USER_PAGE % (link, username))
+
+
+class PageJournalTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'journal.gam')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def testResume(self):
+    journal = gdata.apps.service.PageJournal(self.path)
+    journal.AddPage('feed', 0, [{'groupId': 'a'}], 'page1')
+    journal.AddPage('feed', 1, [{'groupId': 'b', 'description': None}],
+                    'page2')
+    journal._file.close()
+    journal = gdata.apps.service.PageJournal(self.path, resume=True)
+    self.assertEqual(journal.GetPages('feed'),
+                     ([[{'groupId': 'a'}],
+                       [{'groupId': 'b', 'description': None}]], 'page2'))
+    # the pages are handed out once
+    self.assertEqual(journal.GetPages('feed'), ([], 'feed'))
+    journal.Remove()
+    self.assertFalse(os.path.exists(self.path))
+
+  def testStartsEmptyWithoutResume(self):
+    journal = gdata.apps.service.PageJournal(self.path)
+    journal.AddPage('feed', 0, [{'groupId': 'a'}], None)
+    journal._file.close()
+    journal = gdata.apps.service.PageJournal(self.path)
+    self.assertEqual(journal.GetPages('feed'), ([], 'feed'))
+    journal.Remove()
+
+  def testDropsCutOffLine(self):
+    journal = gdata.apps.service.PageJournal(self.path)
+    journal.AddPage('feed', 0, [{'groupId': 'a'}], 'page1')
+    journal._file.write('{"feed": "feed", "page": 1, "entr')
+    journal._file.close()
+    journal = gdata.apps.service.PageJournal(self.path, resume=True)
+    self.assertEqual(journal.GetPages('feed'), ([[{'groupId': 'a'}]], 'page1'))
+    journal.AddPage('feed', 1, [{'groupId': 'b'}], None)
+    journal._file.close()
+    journal = gdata.apps.service.PageJournal(self.path, resume=True)
+    self.assertEqual(journal.GetPages('feed'),
+                     ([[{'groupId': 'a'}], [{'groupId': 'b'}]], None))
+    journal.Remove()
+
+  def testListingContinuesWhereItStopped(self):
+    feed = {'feed': ([{'groupId': 'a'}], 'page1'),
+            'page1': (None, None)}
+    service = _FakePropertyService(feed)
+    service.page_journal = gdata.apps.service.PageJournal(self.path)
+    self.assertRaises(gdata.apps.service.AppsForYourDomainException,
+                      service._GetPropertiesList, 'feed')
+    service.page_journal._file.close()
+    feed['page1'] = ([{'groupId': 'b'}], None)
+    service = _FakePropertyService(feed)
+    service.page_journal = gdata.apps.service.PageJournal(self.path,
+                                                          resume=True)
+    self.assertEqual(service._GetPropertiesList('feed'),
+                     [{'groupId': 'a'}, {'groupId': 'b'}])
+    self.assertEqual(service.fetched, ['page1'])
+
+  def testUserListingContinuesWhereItStopped(self):
+    feed = {'/a/feeds/example.com/user/2.0': ('a', 'page1'),
+            'page1': (None, None)}
+    service = _FakeAppsService(feed)
+    service.page_journal = gdata.apps.service.PageJournal(self.path)
+    pages = service.GetGeneratorForAllUsers()
+    self.assertEqual(pages.next().entry[0].login.user_name, 'a')
+    self.assertRaises(gdata.apps.service.AppsForYourDomainException,
+                      pages.next)
+    service.page_journal._file.close()
+    feed['page1'] = ('b', None)
+    service = _FakeAppsService(feed)
+    service.page_journal = gdata.apps.service.PageJournal(self.path,
+                                                          resume=True)
+    self.assertEqual([page.entry[0].login.user_name
+                      for page in service.GetGeneratorForAllUsers()],
+                     ['a', 'b'])
+    self.assertEqual(service.fetched, ['page1'])
+    service.page_journal.Remove()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+#
+# Google Apps Manager
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests the keep-alive connection pool of atom.http.
+
+Run the tests of gam from its top directory with
+python -m unittest discover -s tests
+"""
+
+import BaseHTTPServer
+import SocketServer
+import threading
+import unittest
+
+import atom.http
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def setup(self):
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+    self.server.connections += 1
+    self.requests = 0
+
+  def do_GET(self):
+    self.requests += 1
+    if self.path.endswith('/drop') and self.requests > 1:
+      # The server has closed the connection by the time the request
+      # arrives, after the client found it still open.
+      self.close_connection = 1
+      return
+    body = 'hello'
+    self.send_response(200)
+    self.send_header('Content-Length', str(len(body)))
+    if self.path.endswith('/close'):
+      self.send_header('Connection', 'close')
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_POST(self):
+    self.rfile.read(int(self.headers['Content-Length']))
+    self.server.posts += 1
+    body = 'created'
+    self.send_response(201)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+  daemon_threads = True
+
+  def __init__(self):
+    BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _Handler)
+    self.connections = 0
+    self.posts = 0
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+  def setUp(self):
+    self.server = _Server()
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.setDaemon(True)
+    self.thread.start()
+    self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+    self.client = atom.http.HttpClient()
+
+  def tearDown(self):
+    self.client.connection_pool.clear()
+    self.server.shutdown()
+    self.server.server_close()
+
+  def testReusesConnection(self):
+    for i in range(3):
+      response = self.client.request('GET', self.url + '/')
+      self.assertEqual(response.read(), 'hello')
+    self.assertEqual(self.server.connections, 1)
+
+  def testUnreadResponseKeepsConnection(self):
+    first = self.client.request('GET', self.url + '/')
+    second = self.client.request('GET', self.url + '/')
+    self.assertEqual(first.read(), 'hello')
+    self.assertEqual(second.read(), 'hello')
+    self.assertEqual(self.server.connections, 2)
+
+  def testConnectionCloseIsHonored(self):
+    self.assertEqual(self.client.request('GET', self.url + '/close').read(),
+                     'hello')
+    self.assertEqual(self.client.request('GET', self.url + '/').read(),
+                     'hello')
+    self.assertEqual(self.server.connections, 2)
+
+  def testDroppedConnectionIsReplaced(self):
+    self.client.request('GET', self.url + '/').read()
+    for connections in self.client.connection_pool._idle.values():
+      for connection, released_at in connections:
+        connection.sock.close()
+    self.assertEqual(self.client.request('GET', self.url + '/').read(),
+                     'hello')
+    self.assertEqual(self.server.connections, 2)
+
+  def testConnectionClosedAfterStaleCheckIsReplaced(self):
+    self.client.request('GET', self.url + '/').read()
+    self.assertEqual(self.client.request('GET', self.url + '/drop').read(),
+                     'hello')
+    self.assertEqual(self.server.connections, 2)
+
+  def testPostGetsFreshConnection(self):
+    self.client.request('GET', self.url + '/').read()
+    response = self.client.request('POST', self.url + '/', data='<entry/>')
+    self.assertEqual(response.read(), 'created')
+    self.assertEqual(self.server.connections, 2)
+    self.assertEqual(self.server.posts, 1)
+    # the connection of the POST is kept for later requests
+    self.client.request('GET', self.url + '/').read()
+    self.assertEqual(self.server.connections, 2)
+
+
+class _FakeConnection(object):
+
+  def __init__(self):
+    self.sock = None
+    self.closed = False
+
+  def close(self):
+    self.closed = True
+
+
+class PoolLimitsTest(unittest.TestCase):
+
+  def testMaxIdle(self):
+    pool = atom.http.ConnectionPool(max_idle=1)
+    first = _FakeConnection()
+    second = _FakeConnection()
+    pool.put('key', first)
+    pool.put('key', second)
+    self.assertFalse(first.closed)
+    self.assertTrue(second.closed)
+
+  def testIdleTimeout(self):
+    pool = atom.http.ConnectionPool(idle_timeout=0)
+    connection = _FakeConnection()
+    pool.put('key', connection)
+    self.assertEqual(pool.get('key'), None)
+    self.assertTrue(connection.closed)
+
+
+if __name__ == '__main__':
+  unittest.main()
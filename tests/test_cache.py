@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+#
+# Google Apps Manager
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests gamlib.cache."""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import gdata.apps.service
+from gamlib import cache
+
+_USERS = 'https://apps-apis.google.com/a/feeds/orguser/2.0/C01'
+_GROUPS = 'https://apps-apis.google.com/a/feeds/group/2.0/example.com'
+_MEMBERS = _GROUPS + '/staff%40example.com/member'
+
+
+class GetEntityTest(unittest.TestCase):
+
+  def testEntities(self):
+    self.assertEqual(cache.GetEntity(_USERS), 'users')
+    self.assertEqual(cache.GetEntity(_GROUPS), 'groups')
+    self.assertEqual(cache.GetEntity(_MEMBERS), 'members')
+    self.assertEqual(cache.GetEntity(
+        _GROUPS + '?member=a%40example.com'), 'members')
+    self.assertEqual(cache.GetEntity(
+        'https://apps-apis.google.com/a/feeds/example.com/nickname/2.0'),
+        'aliases')
+    self.assertEqual(cache.GetEntity(
+        'https://apps-apis.google.com/a/feeds/emailsettings/2.0/example.com/'
+        'a/label'), None)
+
+
+class ParseCacheTtlsTest(unittest.TestCase):
+
+  def testSettings(self):
+    self.assertEqual(cache.ParseCacheTtls('on'), cache.DEFAULT_CACHE_TTLS)
+    self.assertEqual(set(cache.ParseCacheTtls('600').values()), set([600]))
+    ttls = cache.ParseCacheTtls('users=60,groups=0')
+    self.assertEqual(ttls['users'], 60)
+    self.assertEqual(ttls['groups'], 0)
+    self.assertEqual(ttls['members'], cache.DEFAULT_CACHE_TTLS['members'])
+    self.assertRaises(ValueError, cache.ParseCacheTtls, 'nosuch=1')
+    self.assertRaises(ValueError, cache.ParseCacheTtls, 'users=-1')
+    self.assertRaises(ValueError, cache.ParseCacheTtls, 'soon')
+
+
+class DirectoryCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.cache = cache.DirectoryCache(os.path.join(self.directory,
+                                                   'cache.gam'))
+    self.pages = [[{'groupId': 'a'}], [{'groupId': 'b', 'description': None}]]
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def testStoresWholeListings(self):
+    self.assertEqual(self.cache.GetPages(_GROUPS), None)
+    self.cache.AddPages(_GROUPS, self.pages, time.time())
+    self.assertEqual(self.cache.GetPages(_GROUPS), self.pages)
+    other = cache.DirectoryCache(self.cache.path)
+    self.assertEqual(other.GetPages(_GROUPS), self.pages)
+
+  def testExpires(self):
+    self.cache.AddPages(_GROUPS, self.pages, time.time() - 7200)
+    self.assertEqual(self.cache.GetPages(_GROUPS), None)
+
+  def testChangesInvalidateAffectedEntities(self):
+    self.cache.AddPages(_GROUPS, self.pages, time.time())
+    self.cache.AddPages(_MEMBERS, self.pages, time.time())
+    self.cache.AddPages(_USERS, self.pages, time.time())
+    self.cache.Invalidate(_MEMBERS)
+    self.assertEqual(self.cache.GetPages(_MEMBERS), None)
+    self.assertEqual(self.cache.GetPages(_GROUPS), self.pages)
+    self.cache.Invalidate(_USERS + '/a%40example.com')
+    self.assertEqual(self.cache.GetPages(_USERS), None)
+    self.assertEqual(self.cache.GetPages(_GROUPS), self.pages)
+
+  def testListingFetchedDuringChangeIsNotStored(self):
+    fetched = time.time()
+    self.cache.Invalidate(_GROUPS)
+    self.cache.AddPages(_GROUPS, self.pages, fetched)
+    self.assertEqual(self.cache.GetPages(_GROUPS), None)
+
+  def testZeroTtlIsNotCached(self):
+    uncached = cache.DirectoryCache(self.cache.path,
+                                    cache.ParseCacheTtls('groups=0'))
+    uncached.AddPages(_GROUPS, self.pages, time.time())
+    self.assertEqual(uncached.GetPages(_GROUPS), None)
+
+
+class _FakePropertyService(gdata.apps.service.PropertyService):
+
+  def __init__(self, feed):
+    gdata.apps.service.PropertyService.__init__(self)
+    self.feed = feed
+    self.fetched = []
+
+  def _GetPropertyPage(self, uri):
+    self.fetched.append(uri)
+    return self.feed[uri]
+
+
+class PropertyServiceCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.feed = {_GROUPS: ([{'groupId': 'a'}], 'page1'),
+                 'page1': ([{'groupId': 'b'}], None)}
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def testServesListingsFromCache(self):
+    service = _FakePropertyService(self.feed)
+    service.directory_cache = cache.DirectoryCache(
+        os.path.join(self.directory, 'cache.gam'))
+    self.assertEqual(service._GetPropertiesList(_GROUPS),
+                     [{'groupId': 'a'}, {'groupId': 'b'}])
+    self.assertEqual(service._GetPropertiesList(_GROUPS),
+                     [{'groupId': 'a'}, {'groupId': 'b'}])
+    self.assertEqual(service.fetched, [_GROUPS, 'page1'])
+
+  def testResumedListingIsNotCached(self):
+    journal = gdata.apps.service.PageJournal(
+        os.path.join(self.directory, 'journal.gam'))
+    journal.AddPage(_GROUPS, 0, [{'groupId': 'a'}], 'page1')
+    journal._file.close()
+    service = _FakePropertyService(self.feed)
+    service.directory_cache = cache.DirectoryCache(
+        os.path.join(self.directory, 'cache.gam'))
+    service.page_journal = gdata.apps.service.PageJournal(
+        journal.path, resume=True)
+    self.assertEqual(service._GetPropertiesList(_GROUPS),
+                     [{'groupId': 'a'}, {'groupId': 'b'}])
+    self.assertEqual(service.directory_cache.GetPages(_GROUPS), None)
+    service.page_journal.Remove()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+#
+# Google Apps Manager
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests gamlib.download."""
+
+import BaseHTTPServer
+import os
+import re
+import shutil
+import SocketServer
+import StringIO
+import tempfile
+import threading
+import time
+import unittest
+
+from gamlib import download
+
+_DATA = ''.join([chr(i % 251) for i in range(100000)])
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+  def do_GET(self):
+    self.server.ranges.append(self.headers.getheader('Range'))
+    if self.path == '/missing':
+      self.send_error(404)
+      return
+    start = 0
+    match = re.match(r'bytes=(\d+)-$', self.headers.getheader('Range', ''))
+    if match and self.path != '/norange':
+      start = int(match.group(1))
+      if start >= len(_DATA):
+        self.send_response(416)
+        self.send_header('Content-Range', 'bytes */%d' % len(_DATA))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return
+      self.send_response(206)
+      self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+          start, len(_DATA) - 1, len(_DATA)))
+    else:
+      self.send_response(200)
+    self.send_header('Content-Length', str(len(_DATA) - start))
+    self.end_headers()
+    data = _DATA[start:]
+    if self.path == '/break' and len(self.server.ranges) == 1:
+      # the connection breaks off half way through the first try
+      data = data[:len(data) / 2]
+    self.wfile.write(data)
+
+  def log_message(self, *args):
+    pass
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+  daemon_threads = True
+
+  def __init__(self):
+    BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _Handler)
+    self.ranges = []
+
+
+class DownloadTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'export.mbox.gpg')
+    self.server = _Server()
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+    self.sleep = time.sleep
+    time.sleep = lambda seconds: None
+
+  def tearDown(self):
+    time.sleep = self.sleep
+    self.server.shutdown()
+    self.server.server_close()
+    shutil.rmtree(self.directory)
+
+  def _Partial(self, data):
+    partial = open(self.path, 'wb')
+    partial.write(data)
+    partial.close()
+
+  def _Downloaded(self):
+    return open(self.path, 'rb').read()
+
+  def testDownloads(self):
+    progress = download.DownloadProgress(1, StringIO.StringIO())
+    self.assertEqual(download.Download(self.url + '/file', self.path,
+                                       progress), len(_DATA))
+    self.assertEqual(self._Downloaded(), _DATA)
+    self.assertEqual(self.server.ranges, [None])
+    self.assertEqual(progress.done_bytes, len(_DATA))
+    self.assertEqual(progress.total_bytes, len(_DATA))
+
+  def testResumesPartialFile(self):
+    self._Partial(_DATA[:1000])
+    progress = download.DownloadProgress(1, StringIO.StringIO())
+    download.Download(self.url + '/file', self.path, progress)
+    self.assertEqual(self._Downloaded(), _DATA)
+    self.assertEqual(self.server.ranges, ['bytes=1000-'])
+    self.assertEqual(progress.done_bytes, len(_DATA))
+
+  def testCompleteFileIsKept(self):
+    self._Partial(_DATA)
+    self.assertEqual(download.Download(self.url + '/file', self.path),
+                     len(_DATA))
+    self.assertEqual(self.server.ranges, ['bytes=%d-' % len(_DATA)])
+    self.assertEqual(self._Downloaded(), _DATA)
+
+  def testBiggerFileIsFetchedAgain(self):
+    self._Partial(_DATA + 'more')
+    download.Download(self.url + '/file', self.path)
+    self.assertEqual(self._Downloaded(), _DATA)
+    self.assertEqual(self.server.ranges[-1], None)
+
+  def testServerIgnoringRange(self):
+    self._Partial('garbage')
+    download.Download(self.url + '/norange', self.path)
+    self.assertEqual(self._Downloaded(), _DATA)
+
+  def testResumesBrokenDownload(self):
+    download.Download(self.url + '/break', self.path)
+    self.assertEqual(self._Downloaded(), _DATA)
+    self.assertEqual(len(self.server.ranges), 2)
+    self.assertEqual(self.server.ranges[1], 'bytes=%d-' % (len(_DATA) / 2))
+
+  def testGivesUpOnClientErrors(self):
+    self.assertRaises(download.DownloadError, download.Download,
+                      self.url + '/missing', self.path)
+    self.assertEqual(len(self.server.ranges), 1)
+
+  def testDownloadFiles(self):
+    paths = [os.path.join(self.directory, name) for name in ('a', 'b')]
+    results = download.DownloadFiles(
+        [(self.url + '/file', paths[0]), (self.url + '/missing', paths[1])],
+        2, StringIO.StringIO())
+    self.assertEqual(results[0], (paths[0], None))
+    self.assertEqual(results[1][0], paths[1])
+    self.assertTrue(isinstance(results[1][1], download.DownloadError))
+
+  def testDownloadFilesReportsFileErrors(self):
+    path = os.path.join(self.directory, 'missing', 'a')
+    results = download.DownloadFiles([(self.url + '/file', path)], 1,
+                                     StringIO.StringIO())
+    self.assertEqual(results[0][0], path)
+    self.assertTrue(isinstance(results[0][1], EnvironmentError))
+
+  def testDownloadQueue(self):
+    queue = download.DownloadQueue(2)
+    done = []
+    paths = [os.path.join(self.directory, name) for name in ('a', 'b')]
+    queue.Add([(self.url + '/file', path) for path in paths], done.append)
+    queue.Add([], done.append)
+    queue.Join()
+    self.assertEqual(done, [[], []])
+    for path in paths:
+      self.assertEqual(open(path, 'rb').read(), _DATA)
+
+
+class FormatBytesTest(unittest.TestCase):
+
+  def testUnits(self):
+    self.assertEqual(download.FormatBytes(512), '512 bytes')
+    self.assertEqual(download.FormatBytes(1536), '1.5 KB')
+    self.assertEqual(download.FormatBytes(3 * 1024 ** 3), '3.0 GB')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+#
+# Google Apps Manager
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests helper functions of gam.py.
+
+gam.py is a script, not a module, so it is run as "gam version" and the
+helpers are taken from its globals.
+"""
+
+import datetime
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+import gdata.apps.service
+import gdata.service
+
+
+def _LoadGam():
+  """Runs gam.py as "gam version" and returns its globals."""
+  path = os.path.join(os.path.dirname(os.path.dirname(
+      os.path.abspath(__file__))), 'gam.py')
+  argv, stdout = sys.argv, sys.stdout
+  # gam.py sets up these class attributes of gdata for itself
+  prefetch_depth = gdata.service.GDataService.prefetch_depth
+  start_thread = gdata.service.ReadAhead.__dict__['start_thread']
+  sys.argv = [path, 'version']
+  sys.stdout = StringIO.StringIO()
+  gam = {'__name__': 'gam'}
+  try:
+    try:
+      execfile(path, gam)
+    except SystemExit:
+      pass
+  finally:
+    sys.argv, sys.stdout = argv, stdout
+    gdata.service.GDataService.prefetch_depth = prefetch_depth
+    gdata.service.ReadAhead.start_thread = start_thread
+  return gam
+
+gam = _LoadGam()
+
+
+class _FakeGroups(object):
+  """Answers the group requests of gam from dicts."""
+
+  def __init__(self, members, failing=()):
+    # members maps a group id to the member ids of the group
+    self.members = members
+    self.failing = failing
+    self.domain = None
+    self.member_requests = 0
+    self.group_requests = 0
+
+  def GetGeneratorForAllGroups(self):
+    group_ids = sorted(self.members)
+    for i in range(0, len(group_ids), 2):
+      yield [{'groupId': group_id} for group_id in group_ids[i:i + 2]]
+
+  def RetrieveAllMembers(self, group_id, suspended_users=False):
+    self.member_requests += 1
+    if group_id in self.failing:
+      raise gdata.apps.service.AppsForYourDomainException(
+          {'status': 500, 'reason': 'Error', 'body': 'failed'})
+    return [{'memberId': member} for member in self.members[group_id]]
+
+  def RetrieveGroups(self, user):
+    self.group_requests += 1
+    email = '%s@example.com' % user
+    groups = []
+    for group_id in sorted(self.members):
+      found = set()
+      todo = [group_id]
+      while todo:
+        member_group = todo.pop()
+        found.add(member_group)
+        todo.extend(self.members.get(member_group, []))
+      if email in found or '*' in found:
+        groups.append({'groupId': group_id})
+    return groups
+
+
+class GroupsForUsersTest(unittest.TestCase):
+
+  def setUp(self):
+    self.stderr = sys.stderr
+    sys.stderr = StringIO.StringIO()
+    self.groups = _FakeGroups({
+        'a@example.com': ['u1@example.com', 'b@example.com'],
+        'b@example.com': ['u2@example.com'],
+        'all@example.com': ['*'],
+        })
+    self.getGroupsObject = gam['getGroupsObject']
+    gam['getGroupsObject'] = lambda: self.groups
+
+  def tearDown(self):
+    sys.stderr = self.stderr
+    gam['getGroupsObject'] = self.getGroupsObject
+
+  def testInvertsMembers(self):
+    groups = gam['invertGroupMembers'](
+        'example.com', ['a@example.com', 'all@example.com', 'b@example.com'],
+        ['u1@example.com', 'u2@example.com', 'u3@example.com'])
+    self.assertEqual(groups, {
+        'u1@example.com': ['a@example.com', 'all@example.com'],
+        'u2@example.com': ['a@example.com', 'all@example.com',
+                           'b@example.com'],
+        'u3@example.com': ['all@example.com'],
+        })
+
+  def testInvertingFailsForMissingGroup(self):
+    self.groups.failing = ['b@example.com']
+    self.assertEqual(gam['invertGroupMembers'](
+        'example.com', ['a@example.com', 'b@example.com'],
+        ['u1@example.com']), None)
+    self.assertTrue('b@example.com' in sys.stderr.getvalue())
+
+  def testManyUsersInvert(self):
+    emails = ['u%d@example.com' % i for i in range(1, 9)]
+    groups = gam['getGroupsForUsers'](emails)
+    self.assertEqual(self.groups.group_requests, 0)
+    self.assertEqual(self.groups.member_requests, 3)
+    self.assertEqual(groups['u2@example.com'],
+                     ['a@example.com', 'all@example.com', 'b@example.com'])
+    self.assertEqual(groups['u8@example.com'], ['all@example.com'])
+
+  def testFewUsersAskPerUser(self):
+    groups = gam['getGroupsForUsers'](['u1@example.com'])
+    self.assertEqual(self.groups.member_requests, 0)
+    self.assertEqual(self.groups.group_requests, 1)
+    self.assertEqual(groups['u1@example.com'],
+                     ['a@example.com', 'all@example.com'])
+
+  def testFailedInvertAsksPerUser(self):
+    self.groups.failing = ['b@example.com']
+    emails = ['u%d@example.com' % i for i in range(1, 9)]
+    groups = gam['getGroupsForUsers'](emails)
+    self.assertEqual(self.groups.group_requests, len(emails))
+    self.assertEqual(groups['u2@example.com'],
+                     ['a@example.com', 'all@example.com', 'b@example.com'])
+
+
+class _FakeTime(object):
+
+  def __init__(self):
+    self.sleeps = []
+
+  def sleep(self, seconds):
+    self.sleeps.append(seconds)
+
+
+class WaitUntilTest(unittest.TestCase):
+
+  def setUp(self):
+    self.time = gam['time']
+    self.max_wait = gam['max_wait']
+    gam['time'] = _FakeTime()
+    gam['max_wait'] = 10
+
+  def tearDown(self):
+    gam['time'] = self.time
+    gam['max_wait'] = self.max_wait
+
+  def testWaitsLongerEachTry(self):
+    answers = [False, False, True]
+    self.assertTrue(gam['waitUntil'](lambda: answers.pop(0), settle=5))
+    self.assertEqual(gam['time'].sleeps, [1, 2, 5])
+
+  def testGivesUpAfterMaxWait(self):
+    self.assertFalse(gam['waitUntil'](lambda: False, settle=5))
+    self.assertEqual(gam['time'].sleeps, [1, 2, 4, 3])
+
+
+class SplitBatchLineTest(unittest.TestCase):
+
+  def setUp(self):
+    self.os_name = os.name
+
+  def tearDown(self):
+    os.name = self.os_name
+
+  def testSplitsLikeShell(self):
+    os.name = 'posix'
+    self.assertEqual(gam['splitBatchLine'](
+        'gam update user "a b" firstname O\\\'Brien # comment\n'),
+        ['gam', 'update', 'user', 'a b', 'firstname', "O'Brien"])
+    self.assertEqual(gam['splitBatchLine']('# only a comment\n'), [])
+
+  def testKeepsWindowsBackslashes(self):
+    os.name = 'nt'
+    self.assertEqual(gam['splitBatchLine'](
+        'gam user a signature file "C:\\My Files\\sig.txt" C:\\temp\n'),
+        ['gam', 'user', 'a', 'signature', 'file', 'C:\\My Files\\sig.txt',
+         'C:\\temp'])
+
+
+
+class ListPartitionedTest(unittest.TestCase):
+
+  def setUp(self):
+    self.partitions = gam['listing_partitions']
+
+  def tearDown(self):
+    gam['listing_partitions'] = self.partitions
+
+  def testKeyspaceRanges(self):
+    self.assertEqual(gam['keyspaceRanges'](1), [(None, None)])
+    self.assertEqual(gam['keyspaceRanges'](2), [(None, 'n'), ('n', None)])
+    self.assertEqual(gam['keyspaceRanges'](4),
+                     [(None, 'g'), ('g', 'n'), ('n', 't'), ('t', None)])
+    # no more ranges than letters, and at least one
+    self.assertEqual(len(gam['keyspaceRanges'](100)), 26)
+    self.assertEqual(gam['keyspaceRanges'](0), [(None, None)])
+
+  def testListsRangesInOrderWithoutDuplicates(self):
+    gam['listing_partitions'] = 2
+    names = ['1st', 'alice', 'mallory', 'nancy', 'zoe']
+    def retrieveRange(start, stop):
+      # the boundary name turns up in both ranges, like a listing which
+      # stops after its last page rather than at stop
+      return [name for name in names
+              if (start is None or name >= start) and
+                 (stop is None or name <= stop + 'zzz')]
+    lists = list(gam['listPartitioned'](retrieveRange, lambda name: name))
+    self.assertEqual(lists, [['1st', 'alice', 'mallory', 'nancy'], ['zoe']])
+
+
+class AuditTimeTest(unittest.TestCase):
+
+  def testParsesDatesAndTimes(self):
+    parse = gam['parseAuditTime']
+    self.assertEqual(parse('2012-05-31'), datetime.datetime(2012, 5, 31))
+    self.assertEqual(parse('2012-05-31', end=True),
+                     datetime.datetime(2012, 5, 31, 23, 59, 59, 999000))
+    self.assertEqual(parse('2012-05-31T14:30:00Z'),
+                     datetime.datetime(2012, 5, 31, 14, 30))
+    self.assertEqual(parse('2012-05-31 14:30'),
+                     datetime.datetime(2012, 5, 31, 14, 30))
+    self.assertEqual(parse('2012-05-31T14:30:05.1234567Z'),
+                     datetime.datetime(2012, 5, 31, 14, 30, 5, 123456))
+
+  def testRejectsOtherTimes(self):
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+      for value in ['31/05/2012', '2012-05-31T14', '2012-13-01']:
+        self.assertRaises(SystemExit, gam['parseAuditTime'], value)
+    finally:
+      sys.stdout = stdout
+
+  def testShards(self):
+    start = datetime.datetime(2012, 5, 1)
+    end = datetime.datetime(2012, 5, 4) - datetime.timedelta(milliseconds=1)
+    shards = gam['auditShards'](start, end, 3)
+    self.assertEqual(len(shards), 3)
+    # newest first, without gaps or overlaps
+    self.assertEqual(shards[0][1], end)
+    self.assertEqual(shards[-1][0], start)
+    for newer, older in zip(shards[:-1], shards[1:]):
+      self.assertEqual(newer[0] - older[1], datetime.timedelta(milliseconds=1))
+
+  def testShortSpanIsOneShard(self):
+    start = datetime.datetime(2012, 5, 1)
+    end = start + datetime.timedelta(seconds=2)
+    self.assertEqual(gam['auditShards'](start, end, 4), [(start, end)])
+
+
+class _FakeAudit(object):
+  """Answers export requests, the request of a user goes through the
+  statuses listed for the user. NO_FILES stands for COMPLETED without
+  files."""
+
+  def __init__(self, statuses):
+    self.statuses = statuses
+    self.domain = 'example.com'
+    self.requested = []
+
+  def createMailboxExportRequest(self, user, **request):
+    self.requested.append(user)
+    return {'requestId': 'R' + user, 'status': 'PENDING'}
+
+  def getAllMailboxExportRequestsStatus(self):
+    return []
+
+  def getMailboxExportRequestStatus(self, user, request_id):
+    statuses = self.statuses[user]
+    status = statuses[0]
+    if len(statuses) > 1:
+      statuses.pop(0)
+    results = {'userEmailAddress': user + '@example.com',
+               'requestId': request_id, 'status': status}
+    if status == 'NO_FILES':
+      results['status'] = 'COMPLETED'
+    elif status == 'COMPLETED':
+      results['numberOfFiles'] = '1'
+      results['fileUrl0'] = 'https://example.com/' + user
+    return results
+
+
+class _FakeDownloadQueue(object):
+  """Downloads nothing, files from failing urls fail."""
+
+  def __init__(self, failing=()):
+    self.failing = failing
+    self.urls = []
+
+  def Add(self, downloads, callback=None):
+    errors = []
+    for url, path in downloads:
+      self.urls.append(url)
+      if url in self.failing:
+        errors.append((path, IOError('failed')))
+    callback(errors)
+
+  def Join(self):
+    pass
+
+
+class RequestExportsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.state_file = os.path.join(self.directory, 'exports.json')
+    self.stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    self.saved = {}
+    for name in ['getAuditObject', 'time']:
+      self.saved[name] = gam[name]
+    self.DownloadQueue = gam['gamlib'].download.DownloadQueue
+    gam['time'] = _FakeTime()
+    self.queue = _FakeDownloadQueue()
+    gam['gamlib'].download.DownloadQueue = lambda workers: self.queue
+
+  def tearDown(self):
+    sys.stdout = self.stdout
+    gam.update(self.saved)
+    gam['gamlib'].download.DownloadQueue = self.DownloadQueue
+    shutil.rmtree(self.directory)
+
+  def _Run(self, users, statuses):
+    self.audit = _FakeAudit(statuses)
+    gam['getAuditObject'] = lambda: self.audit
+    try:
+      gam['doRequestExports'](users, self.state_file)
+    except SystemExit, e:
+      return e.code
+    return 0
+
+  def _Statuses(self):
+    exports = gam['loadExportState'](self.state_file)
+    return dict((email, export['status'])
+                for email, export in exports.items())
+
+  def testRequestsAndDownloads(self):
+    status = self._Run(['a', 'b@example.com', 'A'],
+                       {'a': ['COMPLETED'], 'b': ['PENDING', 'COMPLETED']})
+    self.assertEqual(status, 0)
+    self.assertEqual(self.audit.requested, ['a', 'b'])
+    self.assertEqual(self._Statuses(), {'a@example.com': 'DOWNLOADED',
+                                        'b@example.com': 'DOWNLOADED'})
+    # one wait while b was pending
+    self.assertEqual(gam['time'].sleeps, [gam['EXPORT_POLL_MIN']])
+
+  def testFailuresExitNonZero(self):
+    self.queue.failing = ['https://example.com/c']
+    status = self._Run(['a', 'b', 'c'],
+                       {'a': ['EXPIRED'], 'b': ['NO_FILES'],
+                        'c': ['COMPLETED']})
+    self.assertEqual(status, 1)
+    self.assertEqual(self._Statuses(), {'a@example.com': 'EXPIRED',
+                                        'b@example.com': 'NO_FILES',
+                                        'c@example.com': 'DOWNLOAD_FAILED'})
+
+  def testRerunPicksUpWhereItStopped(self):
+    self.queue.failing = ['https://example.com/c']
+    self._Run(['a', 'b', 'c'],
+              {'a': ['COMPLETED'], 'b': ['EXPIRED'], 'c': ['COMPLETED']})
+    self.queue = _FakeDownloadQueue()
+    status = self._Run(['a', 'b', 'c'],
+                       {'b': ['COMPLETED'], 'c': ['COMPLETED']})
+    self.assertEqual(status, 0)
+    # the expired export is requested again, the failed download is
+    # fetched again and the downloaded export is left alone
+    self.assertEqual(self.audit.requested, ['b'])
+    self.assertEqual(sorted(self.queue.urls), ['https://example.com/b',
+                                               'https://example.com/c'])
+    self.assertEqual(self._Statuses(), {'a@example.com': 'DOWNLOADED',
+                                        'b@example.com': 'DOWNLOADED',
+                                        'c@example.com': 'DOWNLOADED'})
+
+if __name__ == '__main__':
+  unittest.main()
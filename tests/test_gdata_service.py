@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+#
+# Google Apps Manager
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests the request handling added to gdata.service."""
+
+import errno
+import socket
+import StringIO
+import threading
+import unittest
+
+import atom.http_interface
+import gdata.service
+
+
+class _FakeHttpClient(object):
+  """Answers requests from a list of responses and errors."""
+
+  def __init__(self, answers):
+    self.answers = list(answers)
+    self.requests = []
+
+  def request(self, operation, url, data=None, headers=None):
+    self.requests.append(operation)
+    answer = self.answers.pop(0)
+    if isinstance(answer, Exception):
+      raise answer
+    status, body = answer
+    return atom.http_interface.HttpResponse(
+        body=StringIO.StringIO(body), status=status, reason='Reason',
+        headers={})
+
+
+class _FakeLimiter(object):
+  """Records what the requests it allowed ended with."""
+
+  def __init__(self):
+    self.released = []
+
+  def acquire(self):
+    return None
+
+  def release(self, ticket, status, body=None):
+    self.released.append((status, body))
+
+
+def _Service(answers, policy):
+  service = gdata.service.GDataService(server='apps-apis.google.com')
+  service.http_client = _FakeHttpClient(answers)
+  service.retry_policy = policy
+  return service
+
+
+class RetryPolicyTest(unittest.TestCase):
+
+  def setUp(self):
+    self.policy = gdata.service.RetryPolicy(max_tries=3, delay=0)
+
+  def testRetryableResponses(self):
+    self.assertTrue(self.policy.IsRetryable(503))
+    self.assertTrue(self.policy.IsRetryable(None))
+    self.assertTrue(self.policy.IsRetryable(403, 'rateLimitExceeded'))
+    self.assertFalse(self.policy.IsRetryable(403, 'Forbidden'))
+    self.assertFalse(self.policy.IsRetryable(404, ''))
+
+  def testPostsOnlyRetriedWhenNotCarriedOut(self):
+    self.assertFalse(self.policy.IsRetryable(503, '', 'POST'))
+    self.assertFalse(self.policy.IsRetryable(
+        None, operation='POST', error=socket.error(errno.ECONNRESET, 'reset')))
+    self.assertTrue(self.policy.IsRetryable(
+        None, operation='POST',
+        error=socket.error(errno.ECONNREFUSED, 'refused')))
+    self.assertTrue(self.policy.IsRetryable(403, 'quotaExceeded', 'POST'))
+    self.assertFalse(self.policy.IsRetryable(403, 'backendError', 'POST'))
+
+  def testMaxTries(self):
+    self.assertTrue(self.policy.Wait(1))
+    self.assertTrue(self.policy.Wait(2))
+    self.assertFalse(self.policy.Wait(3))
+
+  def testBudget(self):
+    policy = gdata.service.RetryPolicy(delay=0, budget=2, budget_window=600)
+    self.assertTrue(policy.Wait(1))
+    self.assertTrue(policy.Wait(1))
+    self.assertFalse(policy.Wait(1))
+
+  def testBudgetRefills(self):
+    policy = gdata.service.RetryPolicy(delay=0, budget=1, budget_window=0)
+    self.assertTrue(policy.Wait(1))
+    self.assertTrue(policy.Wait(1))
+
+
+class RetriedRequestTest(unittest.TestCase):
+
+  def setUp(self):
+    self.policy = gdata.service.RetryPolicy(max_tries=3, delay=0)
+
+  def testRetriesServerErrors(self):
+    service = _Service([(503, 'busy'), (200, 'ok')], self.policy)
+    response = service.request('GET', 'https://apps-apis.google.com/feed')
+    self.assertEqual(response.status, 200)
+    self.assertEqual(response.read(), 'ok')
+    self.assertEqual(len(service.http_client.requests), 2)
+
+  def testReturnsLastErrorReadable(self):
+    service = _Service([(503, 'busy')] * 3, self.policy)
+    response = service.request('GET', 'https://apps-apis.google.com/feed')
+    self.assertEqual(response.status, 503)
+    self.assertEqual(response.read(), 'busy')
+    self.assertEqual(len(service.http_client.requests), 3)
+
+  def testDoesNotReplayPosts(self):
+    service = _Service([(503, 'busy'), (201, 'created')], self.policy)
+    response = service.request('POST', 'https://apps-apis.google.com/feed',
+                               data='<entry/>')
+    self.assertEqual(response.status, 503)
+    self.assertEqual(len(service.http_client.requests), 1)
+
+  def testRetriesSocketErrors(self):
+    service = _Service([socket.error(errno.ECONNRESET, 'reset'),
+                        (200, 'ok')], self.policy)
+    response = service.request('GET', 'https://apps-apis.google.com/feed')
+    self.assertEqual(response.status, 200)
+
+  def testRaisesWhenTriesRunOut(self):
+    service = _Service([socket.error(errno.ECONNRESET, 'reset')] * 3,
+                       self.policy)
+    self.assertRaises(socket.error, service.request, 'GET',
+                      'https://apps-apis.google.com/feed')
+
+  def testLimiterHearsErrorBodies(self):
+    limiter = _FakeLimiter()
+    service = _Service([(403, 'rateLimitExceeded'), (200, 'ok')], self.policy)
+    service.concurrency_limiter = limiter
+    response = service.request('GET', 'https://apps-apis.google.com/feed')
+    self.assertEqual(response.read(), 'ok')
+    self.assertEqual(limiter.released, [(403, 'rateLimitExceeded'),
+                                        (200, None)])
+
+  def testGetWithRetriesKeepsToThePolicy(self):
+    service = _Service([(503, 'busy')] * 9, self.policy)
+    self.assertRaises(gdata.service.RequestError, service.GetWithRetries,
+                      'https://apps-apis.google.com/feed', delay=0.01)
+    self.assertEqual(len(service.http_client.requests), 3)
+
+  def testNoPolicy(self):
+    service = _Service([(503, 'busy')], None)
+    response = service.request('GET', 'https://apps-apis.google.com/feed')
+    self.assertEqual(response.status, 503)
+
+
+class ReadAheadTest(unittest.TestCase):
+
+  def testFetchesAhead(self):
+    fetched = []
+    second_fetched = threading.Event()
+    def Pages():
+      for page in range(3):
+        fetched.append(page)
+        if page == 1:
+          second_fetched.set()
+        yield page
+    pages = gdata.service.ReadAhead(Pages(), depth=1)
+    self.assertEqual(pages.next(), 0)
+    self.assertTrue(second_fetched.wait(5))
+    self.assertEqual(list(pages), [1, 2])
+    self.assertEqual(fetched, [0, 1, 2])
+
+  def testRaisesErrorInPlace(self):
+    def Pages():
+      yield 'first'
+      raise ValueError('failed')
+    pages = gdata.service.ReadAhead(Pages())
+    self.assertEqual(pages.next(), 'first')
+    self.assertRaises(ValueError, pages.next)
+    self.assertRaises(StopIteration, pages.next)
+
+  def testCloseStopsFetching(self):
+    fetched = []
+    closed = []
+    def Pages():
+      try:
+        while True:
+          fetched.append(len(fetched))
+          yield len(fetched)
+      finally:
+        closed.append(True)
+    pages = gdata.service.ReadAhead(Pages(), depth=2)
+    pages.next()
+    pages.close()
+    self.assertRaises(StopIteration, pages.next)
+    # close waits for the thread, which closes the pages on its way out
+    self.assertEqual(closed, [True])
+    count = len(fetched)
+    threading.Event().wait(0.5)
+    self.assertEqual(len(fetched), count)
+
+  def testDepthZeroFetchesOnDemand(self):
+    service = gdata.service.GDataService()
+    service.prefetch_depth = 0
+    pages = iter([1, 2])
+    self.assertTrue(service.ReadAhead(pages) is pages)
+    service.prefetch_depth = 1
+    pages = service.ReadAhead(pages)
+    self.assertTrue(isinstance(pages, gdata.service.ReadAhead))
+    pages.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#
+# Google Apps Manager
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests gamlib.output."""
+
+import gzip
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+from gamlib import output
+
+try:
+  import json
+except ImportError:
+  json = None
+
+
+class RowWriterTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+
+  def tearDown(self):
+    sys.stdout = self.stdout
+    shutil.rmtree(self.directory)
+
+  def _Write(self, format, path=None, compress=False):
+    writer = output.RowWriter(['Email', 'Name', 'Groups'], format, path,
+                              compress)
+    writer.WriteRow({'Email': 'a@example.com', 'Name': u'Caf\xe9, Bar'})
+    writer.WriteRow(['b@example.com', None, ['x', 'y']])
+    writer.Close()
+
+  def testCsvToStdout(self):
+    self._Write('csv')
+    self.assertEqual(sys.stdout.getvalue(),
+                     'Email,Name,Groups\n'
+                     'a@example.com,"Caf\xc3\xa9, Bar",\n'
+                     'b@example.com,,"[""x"", ""y""]"\n')
+
+  def testConsoleLineTerminator(self):
+    terminator = output.FILE_LINETERMINATOR
+    output.FILE_LINETERMINATOR = '\r\n'
+    try:
+      self._Write('tsv')
+    finally:
+      output.FILE_LINETERMINATOR = terminator
+    # the console adds any \r itself
+    self.assertEqual(sys.stdout.getvalue().split('\n')[0],
+                     'Email\tName\tGroups')
+    self.assertFalse('\r' in sys.stdout.getvalue())
+
+  def testFileLineTerminator(self):
+    path = os.path.join(self.directory, 'users.tsv')
+    terminator = output.FILE_LINETERMINATOR
+    output.FILE_LINETERMINATOR = '\r\n'
+    try:
+      self._Write('tsv', path)
+    finally:
+      output.FILE_LINETERMINATOR = terminator
+    self.assertEqual(open(path, 'rb').read().split('\r\n')[0],
+                     'Email\tName\tGroups')
+    self.assertEqual(sys.stdout.getvalue(), '')
+
+  def testJsonLines(self):
+    if json is None:
+      return
+    self._Write('jsonl')
+    lines = sys.stdout.getvalue().splitlines()
+    self.assertEqual(len(lines), 2)
+    self.assertEqual(json.loads(lines[1]),
+                     {'Email': 'b@example.com', 'Name': None,
+                      'Groups': ['x', 'y']})
+    self.assertTrue(lines[0].startswith('{"Email": '))
+
+  def testGzip(self):
+    path = os.path.join(self.directory, 'users.csv')
+    self._Write('csv', path, compress=True)
+    self.assertEqual(gzip.open(path, 'rb').read().splitlines()[0],
+                     'Email,Name,Groups')
+    path = os.path.join(self.directory, 'users.csv.gz')
+    self._Write('csv', path)
+    self.assertEqual(len(gzip.open(path, 'rb').read().splitlines()), 3)
+
+  def testUnknownFormat(self):
+    self.assertRaises(ValueError, output.RowWriter, ['Email'], 'xml')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+#
+# Google Apps Manager
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests gamlib.reports."""
+
+import calendar
+import datetime
+import gzip
+import os
+import shutil
+import StringIO
+import tempfile
+import unittest
+
+from gamlib import reports
+
+
+def _Time(value):
+  """Returns the seconds since the epoch of a UTC YYYY-MM-DD HH:MM string."""
+  return calendar.timegm(
+      datetime.datetime.strptime(value, '%Y-%m-%d %H:%M').timetuple())
+
+
+class DatesTest(unittest.TestCase):
+
+  def testParseDate(self):
+    self.assertEqual(reports.ParseDate('2012-02-29'),
+                     datetime.date(2012, 2, 29))
+    self.assertRaises(ValueError, reports.ParseDate, '2012-02-30')
+    self.assertRaises(ValueError, reports.ParseDate, 'yesterday')
+
+  def testDateRange(self):
+    self.assertEqual(reports.DateRange(datetime.date(2012, 2, 28),
+                                       datetime.date(2012, 3, 1)),
+                     ['2012-02-28', '2012-02-29', '2012-03-01'])
+    self.assertEqual(reports.DateRange(datetime.date(2012, 3, 1),
+                                       datetime.date(2012, 2, 28)), [])
+
+  def testLatestReportDate(self):
+    self.assertEqual(reports.LatestReportDate(_Time('2012-03-01 19:59')),
+                     '2012-02-29')
+    self.assertEqual(reports.LatestReportDate(_Time('2012-03-01 20:00')),
+                     '2012-03-01')
+    self.assertEqual(reports.LatestReportDate(_Time('2012-03-01 00:30')),
+                     '2012-02-29')
+
+
+class ReportCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.cache = reports.ReportCache(os.path.join(self.directory, 'reports'))
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def testStoresReports(self):
+    path, stored = self.cache.Store('Example.com', 'accounts', '2012-03-01',
+                                    ['date,account\n', '2012-03-01,a\n'])
+    self.assertTrue(stored)
+    self.assertTrue(self.cache.Has('example.com', 'Accounts', '2012-03-01'))
+    self.assertFalse(self.cache.Has('example.com', 'accounts', '2012-03-02'))
+    self.assertEqual(gzip.open(path, 'rb').read(),
+                     'date,account\n2012-03-01,a\n')
+
+  def testLastRowWithoutNewline(self):
+    path, stored = self.cache.Store('example.com', 'accounts', '2012-03-01',
+                                    ['date,account\n2012-03-01,a'])
+    self.assertTrue(stored)
+
+  def testNeverStoresEmptyReports(self):
+    for pages in ([], ['date,account\n'], ['date,account']):
+      path, stored = self.cache.Store('example.com', 'accounts',
+                                      '2012-03-01', pages)
+      self.assertFalse(stored)
+      self.assertTrue(os.path.isfile(path))
+      os.remove(path)
+    self.assertFalse(self.cache.Has('example.com', 'accounts', '2012-03-01'))
+
+  def testKeepFalseLeavesTemporaryFile(self):
+    path, stored = self.cache.Store('example.com', 'accounts', '2012-03-01',
+                                    ['date,account\n', '2012-03-01,a\n'],
+                                    keep=False)
+    self.assertFalse(stored)
+    self.assertFalse(self.cache.Has('example.com', 'accounts', '2012-03-01'))
+    os.remove(path)
+
+  def testFailedDownloadLeavesNothing(self):
+    def Pages():
+      yield 'date,account\n'
+      raise IOError('connection reset')
+    self.assertRaises(IOError, self.cache.Store, 'example.com', 'accounts',
+                      '2012-03-01', Pages())
+    self.assertEqual(os.listdir(self.cache.directory), [])
+
+
+class MergeReportsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def _Report(self, name, data):
+    path = os.path.join(self.directory, name)
+    report_file = gzip.open(path, 'wb')
+    report_file.write(data)
+    report_file.close()
+    return path
+
+  def testMergesWithDateColumn(self):
+    first = self._Report('first', 'account,quota\na,10\n')
+    second = self._Report('second', 'quota,account,used\n20,b,5\n')
+    empty = self._Report('empty', '')
+    out = StringIO.StringIO()
+    reports.MergeReports([('2012-03-01', first), ('2012-03-02', empty),
+                          ('2012-03-03', second)], out)
+    self.assertEqual(out.getvalue(),
+                     'date,account,quota\n'
+                     '2012-03-01,a,10\n'
+                     '2012-03-03,b,20\n')
+
+
+if __name__ == '__main__':
+  unittest.main()
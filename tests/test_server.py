@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+#
+# Google Apps Manager
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests gamlib.server."""
+
+import os
+import shutil
+import socket
+import stat
+import StringIO
+import tempfile
+import threading
+import unittest
+
+from gamlib import server
+
+
+class FrameTest(unittest.TestCase):
+
+  def testRoundTrip(self):
+    stream = StringIO.StringIO()
+    server.WriteFrame(stream, server.STDOUT, 'hello\n')
+    server.WriteFrame(stream, server.EXIT, '0')
+    stream.seek(0)
+    self.assertEqual(server.ReadFrame(stream), (server.STDOUT, 'hello\n'))
+    self.assertEqual(server.ReadFrame(stream), (server.EXIT, '0'))
+    self.assertEqual(server.ReadFrame(stream), None)
+
+  def testCutOffFrame(self):
+    stream = StringIO.StringIO()
+    server.WriteFrame(stream, server.STDERR, 'error')
+    stream = StringIO.StringIO(stream.getvalue()[:-1])
+    self.assertEqual(server.ReadFrame(stream), None)
+
+
+class CommandServerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'gam.sock')
+    self.server = None
+
+  def tearDown(self):
+    if self.server is not None:
+      self.server.shutdown()
+      self.server.server_close()
+    shutil.rmtree(self.directory)
+
+  def _Serve(self, run_command):
+    self.server = server.CommandServer(self.path, run_command)
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+
+  def _Run(self, argv):
+    stdout = StringIO.StringIO()
+    stderr = StringIO.StringIO()
+    status = server.RunRemoteCommand(self.path, argv, stdout, stderr)
+    return status, stdout.getvalue(), stderr.getvalue()
+
+  def testRunsCommands(self):
+    def run_command(argv, stdout, stderr):
+      stdout.write(' '.join(argv) + '\n')
+      stderr.write(u'caf\xe9\n')
+      return len(argv)
+    self._Serve(run_command)
+    self.assertEqual(self._Run(['info', 'user', 'caf\xc3\xa9']),
+                     (3, 'info user caf\xc3\xa9\n', 'caf\xc3\xa9\n'))
+
+  def testConcurrentCommands(self):
+    both_running = threading.Event()
+    running = []
+    lock = threading.Lock()
+    def run_command(argv, stdout, stderr):
+      lock.acquire()
+      running.append(argv[0])
+      if len(running) == 2:
+        both_running.set()
+      lock.release()
+      # each command only finishes once the other one has started
+      both_running.wait(5)
+      stdout.write(argv[0])
+      return 0
+    self._Serve(run_command)
+    results = []
+    def run(name):
+      results.append(self._Run([name]))
+    threads = [threading.Thread(target=run, args=(name,))
+               for name in ('first', 'second')]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertTrue(both_running.isSet())
+    self.assertEqual(sorted(results),
+                     [(0, 'first', ''), (0, 'second', '')])
+
+  def testSocketOnlyForOwner(self):
+    self._Serve(lambda argv, stdout, stderr: 0)
+    self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode) & 0077, 0)
+
+  def testReplacesStaleSocket(self):
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(self.path)
+    stale.close()
+    self._Serve(lambda argv, stdout, stderr: 0)
+    self.assertEqual(self._Run([])[0], 0)
+
+  def testRefusesSecondServer(self):
+    self._Serve(lambda argv, stdout, stderr: 0)
+    self.assertRaises(socket.error, server.CommandServer, self.path,
+                      lambda argv, stdout, stderr: 0)
+
+  def testNoServer(self):
+    self.assertRaises(socket.error, self._Run, ['version'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+#
+# Google Apps Manager
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests gamlib.throttle."""
+
+import threading
+import time
+import unittest
+
+from gamlib import throttle
+
+
+class IsOverloadedTest(unittest.TestCase):
+
+  def testStatuses(self):
+    self.assertTrue(throttle.IsOverloaded(503))
+    self.assertTrue(throttle.IsOverloaded(429))
+    self.assertFalse(throttle.IsOverloaded(200))
+    self.assertFalse(throttle.IsOverloaded(None))
+
+  def testForbiddenNeedsOverloadBody(self):
+    self.assertFalse(throttle.IsOverloaded(403))
+    self.assertFalse(throttle.IsOverloaded(403, 'Forbidden'))
+    self.assertTrue(throttle.IsOverloaded(
+        403, '<error><reason>rateLimitExceeded</reason></error>'))
+    self.assertTrue(throttle.IsOverloaded(403, 'Quota exceeded for domain'))
+
+
+class AIMDLimiterTest(unittest.TestCase):
+
+  def testGrowsWithSuccesses(self):
+    limiter = throttle.AIMDLimiter(initial=2, maximum=10)
+    for i in range(20):
+      limiter.release(limiter.acquire(), 200)
+    self.assertTrue(limiter.GetLimit() > 2)
+    self.assertTrue(limiter.peak >= limiter.GetLimit())
+
+  def testHalvesOnOverload(self):
+    limiter = throttle.AIMDLimiter(initial=8)
+    limiter.release(limiter.acquire(), 503)
+    self.assertEqual(limiter.GetLimit(), 4)
+    self.assertEqual(limiter.decreases, 1)
+
+  def testNeverBelowMinimumOrAboveMaximum(self):
+    limiter = throttle.AIMDLimiter(initial=2, maximum=3, minimum=1)
+    for i in range(5):
+      limiter.release(limiter.acquire(), 503)
+    self.assertEqual(limiter.GetLimit(), 1)
+    for i in range(50):
+      limiter.release(limiter.acquire(), 200)
+    self.assertEqual(limiter.GetLimit(), 3)
+
+  def testOneDecreasePerRound(self):
+    limiter = throttle.AIMDLimiter(initial=8)
+    tickets = [limiter.acquire() for i in range(4)]
+    for ticket in tickets:
+      limiter.release(ticket, 503)
+    self.assertEqual(limiter.GetLimit(), 4)
+    self.assertEqual(limiter.decreases, 1)
+
+  def testServerErrorsDontGrowLimit(self):
+    limiter = throttle.AIMDLimiter(initial=2)
+    for i in range(10):
+      limiter.release(limiter.acquire(), 502)
+    self.assertEqual(limiter.GetLimit(), 2)
+
+  def testBlocksAtLimit(self):
+    limiter = throttle.AIMDLimiter(initial=1, maximum=1)
+    ticket = limiter.acquire()
+    acquired = threading.Event()
+    def acquire():
+      limiter.release(limiter.acquire(), 200)
+      acquired.set()
+    thread = threading.Thread(target=acquire)
+    thread.setDaemon(True)
+    thread.start()
+    self.assertFalse(acquired.wait(0.1))
+    limiter.release(ticket, 200)
+    self.assertTrue(acquired.wait(5))
+
+
+class TokenBucketTest(unittest.TestCase):
+
+  def testBurstThenRate(self):
+    bucket = throttle.TokenBucket(20)
+    started = time.time()
+    for i in range(20):
+      bucket.Take()
+    self.assertTrue(time.time() - started < 0.5)
+    for i in range(5):
+      bucket.Take()
+    self.assertTrue(time.time() - started >= 0.2)
+
+
+class RateLimiterTest(unittest.TestCase):
+
+  def testGetApi(self):
+    self.assertEqual(throttle.GetApi(
+        'https://apps-apis.google.com/a/feeds/emailsettings/2.0/example.com/'
+        'user/label'), 'emailsettings')
+    self.assertEqual(throttle.GetApi(
+        'https://apps-apis.google.com/a/feeds/example.com/user/2.0'),
+        'provisioning')
+    self.assertEqual(throttle.GetApi('https://www.example.com/'), None)
+
+  def testParseRateLimits(self):
+    rates = throttle.ParseRateLimits('emailsettings=5, audit=0')
+    self.assertEqual(rates['emailsettings'], 5)
+    self.assertEqual(rates['audit'], 0)
+    self.assertEqual(rates['calendar'],
+                     throttle.DEFAULT_RATE_LIMITS['calendar'])
+    self.assertEqual(throttle.ParseRateLimits('on'),
+                     throttle.DEFAULT_RATE_LIMITS)
+    self.assertRaises(ValueError, throttle.ParseRateLimits, 'nosuchapi=1')
+    self.assertRaises(ValueError, throttle.ParseRateLimits, 'audit')
+    self.assertRaises(ValueError, throttle.ParseRateLimits, 'audit=-1')
+
+  def testZeroRateIsNotLimited(self):
+    limiter = throttle.RateLimiter({'audit': 0, 'calendar': 1})
+    self.assertEqual(limiter.buckets.keys(), ['calendar'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+#
+# Google Apps Manager
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests gamlib.workers."""
+
+import StringIO
+import sys
+import threading
+import time
+import unittest
+
+from gamlib import workers
+
+
+class RunTasksTest(unittest.TestCase):
+
+  def setUp(self):
+    self.stdout, self.stderr = sys.stdout, sys.stderr
+    sys.stdout = StringIO.StringIO()
+    sys.stderr = StringIO.StringIO()
+    self.out = sys.stdout
+
+  def tearDown(self):
+    sys.stdout, sys.stderr = self.stdout, self.stderr
+
+  def testOutputComesOutInOrder(self):
+    def func(item, i, count):
+      # later items finish first
+      time.sleep((count - i) * 0.01)
+      print '%s %s of %s' % (item, i, count)
+    failures = workers.RunTasks(func, ['a', 'b', 'c', 'd'], 4)
+    self.assertEqual(failures, 0)
+    self.assertEqual(self.out.getvalue(),
+                     'a 1 of 4\nb 2 of 4\nc 3 of 4\nd 4 of 4\n')
+
+  def testCountsFailures(self):
+    def func(item, i, count):
+      if item == 'exit':
+        sys.exit(2)
+      if item == 'raise':
+        raise ValueError(item)
+      sys.exit(0)
+    failures = workers.RunTasks(func, ['ok', 'exit', 'raise', 'ok'], 2)
+    self.assertEqual(failures, 2)
+
+  def testBoundsThreads(self):
+    lock = threading.Lock()
+    running = [0, 0]
+    def func(item, i, count):
+      lock.acquire()
+      running[0] += 1
+      running[1] = max(running[1], running[0])
+      lock.release()
+      time.sleep(0.01)
+      lock.acquire()
+      running[0] -= 1
+      lock.release()
+    workers.RunTasks(func, range(20), 3)
+    self.assertTrue(running[1] <= 3)
+
+  def testNestedThreadsWriteToTheirTask(self):
+    def func(item, i, count):
+      time.sleep((count - i) * 0.01)
+      def part():
+        sys.stdout.write('%s part\n' % item)
+      workers.CallConcurrently([part])
+      print '%s done' % item
+    workers.RunTasks(func, ['a', 'b', 'c'], 3)
+    self.assertEqual(self.out.getvalue(),
+                     'a part\na done\nb part\nb done\nc part\nc done\n')
+
+
+class CallConcurrentlyTest(unittest.TestCase):
+
+  def testResultsInOrder(self):
+    calls = [lambda i=i: (time.sleep((5 - i) * 0.01), i)[1] for i in range(5)]
+    self.assertEqual(workers.CallConcurrently(calls, 3), range(5))
+
+  def testRaisesFirstError(self):
+    def fail(message):
+      def call():
+        raise ValueError(message)
+      return call
+    calls = [lambda: 1, fail('first'), fail('second')]
+    try:
+      workers.CallConcurrently(calls)
+    except ValueError, e:
+      self.assertEqual(str(e), 'first')
+    else:
+      self.fail('no error raised')
+
+  def testNoCalls(self):
+    self.assertEqual(workers.CallConcurrently([]), [])
+
+
+class IterConcurrentlyTest(unittest.TestCase):
+
+  def testYieldsInOrder(self):
+    calls = [lambda i=i: (time.sleep((5 - i) * 0.01), i)[1] for i in range(5)]
+    self.assertEqual(list(workers.IterConcurrently(calls, 2)), range(5))
+
+  def testFirstResultBeforeLastCallEnds(self):
+    release = threading.Event()
+    calls = [lambda: 'first', lambda: release.wait(5) and 'last']
+    results = workers.IterConcurrently(calls)
+    self.assertEqual(results.next(), 'first')
+    release.set()
+    self.assertEqual(list(results), ['last'])
+
+  def testRaisesInOrder(self):
+    def fail():
+      raise ValueError('failed')
+    results = workers.IterConcurrently([lambda: 1, fail])
+    self.assertEqual(results.next(), 1)
+    self.assertRaises(ValueError, results.next)
+
+
+class ContextTest(unittest.TestCase):
+
+  def tearDown(self):
+    workers.context.__dict__.clear()
+
+  def testThreadsInheritContext(self):
+    workers.context.setting = 'job'
+    calls = [lambda: getattr(workers.context, 'setting', None)] * 3
+    self.assertEqual(workers.CallConcurrently(calls), ['job'] * 3)
+
+  def testThreadsInheritCapture(self):
+    stream = StringIO.StringIO()
+    buffer = StringIO.StringIO()
+    output = workers.ThreadedOutput(stream)
+    output.capture(buffer)
+    workers.CallConcurrently([lambda: output.write('captured\n')])
+    output.capture(None)
+    output.write('not captured\n')
+    self.assertEqual(buffer.getvalue(), 'captured\n')
+    self.assertEqual(stream.getvalue(), 'not captured\n')
+
+  def testThreadedArgv(self):
+    argv = workers.ThreadedArgv(['gam'])
+    results = []
+    def run(args):
+      argv.set(['gam'] + args)
+      del argv[1]
+      results.append(list(argv))
+    thread = threading.Thread(target=run, args=(['info', 'user'],))
+    thread.start()
+    thread.join()
+    self.assertEqual(results, [['gam', 'user']])
+    self.assertEqual(list(argv), ['gam'])
+    argv.set(['gam', 'version'])
+    self.assertEqual(workers.CallConcurrently([lambda: list(argv)]),
+                     [['gam', 'version']])
+
+
+if __name__ == '__main__':
+  unittest.main()